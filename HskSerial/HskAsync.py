@@ -0,0 +1,193 @@
+# asyncio flavor of HskSerial/HskEthernet, so one event loop can
+# babysit a whole pile of links without a thread each.
+#
+# async def main():
+#     tf = await openEthernet(remoteIp="10.68.65.81")
+#     pkt = await tf.request(0x40, "eTemps", timeout=1)
+#     print(pkt.pretty())
+#     async for pkt in tf:
+#         print("unsolicited:", pkt.pretty())
+#
+# Ethernet is a datagram endpoint on the TH port, serial is a
+# non-blocking Serial with its fd registered with the loop.
+import asyncio
+from collections import deque
+
+from serial import Serial
+from cobs import cobs
+from HskSerial import HskEthernet, HskPacket, HskFramer
+
+class HskAsyncProtocol(asyncio.DatagramProtocol):
+    """ Housekeeping protocol: frames/decodes packets and matches replies to requests by (src, cmd). """
+    def __init__(self, srcId=None):
+        self.src = srcId
+        self.transport = None
+        self.framer = HskFramer()
+        # (src, cmd) -> deque of futures, oldest first
+        self.pending = {}
+        self.unsolicited = asyncio.Queue()
+        self.exc = None
+
+    # asyncio callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+        # datagram transports don't all derive from DatagramTransport
+        self._writeImpl = transport.sendto if hasattr(transport, 'sendto') else transport.write
+
+    def datagram_received(self, data, addr):
+        # one datagram is one frame
+        try:
+            pkt = HskPacket.fromFrame(cobs.decode(data.strip(b'\x00')))
+        except (IOError, cobs.DecodeError):
+            return
+        self.dispatch(pkt)
+
+    def data_received(self, data):
+        self.framer.feed(data)
+        frames = self.framer.frames()
+        while True:
+            # a bad frame (line noise) kills the generator, but the framer's
+            # already past it, so start again with whatever's after it
+            try:
+                rx = next(frames, None)
+            except cobs.DecodeError:
+                frames = self.framer.frames()
+                continue
+            if rx is None:
+                break
+            try:
+                pkt = HskPacket.fromFrame(rx)
+            except IOError:
+                continue
+            self.dispatch(pkt)
+
+    def error_received(self, exc):
+        # ICMP unreachable and friends: the request will just time out
+        pass
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.exc = exc if exc is not None else ConnectionError("link closed")
+        for waiting in self.pending.values():
+            for fut in waiting:
+                if not fut.done():
+                    fut.set_exception(self.exc)
+        self.pending = {}
+        # wake up anyone iterating
+        self.unsolicited.put_nowait(None)
+
+    def dispatch(self, pkt):
+        """ Hand a packet to the oldest request waiting on it, or queue it as unsolicited. """
+        key = (pkt.src, pkt.cmd)
+        waiting = self.pending.get(key)
+        while waiting:
+            fut = waiting.popleft()
+            if not fut.done():
+                fut.set_result(pkt)
+                return
+        self.unsolicited.put_nowait(pkt)
+
+    # user stuff
+    def send(self, pkt, override=False):
+        """ Send a housekeeping packet. Uses our srcId as source unless override is true or no source was provided """
+        if self.transport is None:
+            raise self.exc if self.exc is not None else ConnectionError("not connected")
+        if not override and self.src is not None:
+            pkt.src = self.src
+        self._writeImpl(pkt.encode()+b'\x00')
+
+    async def request(self, dest, cmd, data=None, timeout=None):
+        """ Send cmd to dest and wait for its reply. Raises TimeoutError after timeout seconds. """
+        pkt = HskPacket(dest, cmd, data=data)
+        key = (pkt.dest, pkt.cmd)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(key, deque()).append(fut)
+        try:
+            self.send(pkt)
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("no reply from %2.2x to %s" %
+                               (pkt.dest, HskPacket.strings.get(pkt.cmd, pkt.cmd))) from None
+        finally:
+            # a late reply should go to unsolicited, not the next request
+            waiting = self.pending.get(key)
+            if waiting is not None and fut in waiting:
+                waiting.remove(fut)
+            if not waiting and key in self.pending:
+                del self.pending[key]
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """ Next unsolicited packet. Stops when the link closes. """
+        if self.transport is None and self.unsolicited.empty():
+            raise StopAsyncIteration
+        pkt = await self.unsolicited.get()
+        if pkt is None:
+            raise StopAsyncIteration
+        return pkt
+
+class HskSerialTransport(asyncio.Transport):
+    """ Minimal asyncio transport over a non-blocking Serial. """
+    def __init__(self, loop, ser, protocol):
+        super().__init__()
+        self.loop = loop
+        self.serial = ser
+        self.protocol = protocol
+        self.closing = False
+        self.loop.add_reader(self.serial.fileno(), self._readReady)
+        self.loop.call_soon(self.protocol.connection_made, self)
+
+    def _readReady(self):
+        try:
+            data = self.serial.read(max(1, self.serial.in_waiting))
+        except Exception as e:
+            self._close(e)
+            return
+        if len(data):
+            self.protocol.data_received(data)
+
+    def write(self, data):
+        # housekeeping packets are tiny, so just let the write go through
+        self.serial.write(data)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self._close(None)
+
+    def _close(self, exc):
+        if self.closing:
+            return
+        self.closing = True
+        self.loop.remove_reader(self.serial.fileno())
+        self.serial.close()
+        self.loop.call_soon(self.protocol.connection_lost, exc)
+
+async def openEthernet(srcId=0xFE,
+                       localIp="10.68.65.1",
+                       remoteIp="10.68.65.81",
+                       localPort=21352):
+    """ Open a housekeeping link to a TURFIO's TH port. Returns the HskAsyncProtocol. """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda : HskAsyncProtocol(srcId),
+        local_addr=(localIp, localPort),
+        remote_addr=(remoteIp, HskEthernet.TH_PORT))
+    return protocol
+
+async def openSerial(path, baudrate=500000, srcId=None):
+    """ Open a housekeeping link on a tty. Returns the HskAsyncProtocol. """
+    loop = asyncio.get_running_loop()
+    ser = Serial(path, baudrate=baudrate, timeout=0)
+    protocol = HskAsyncProtocol(srcId)
+    HskSerialTransport(loop, ser, protocol)
+    # let connection_made run
+    await asyncio.sleep(0)
+    return protocol
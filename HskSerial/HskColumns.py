@@ -0,0 +1,172 @@
+# Columnar export of decoded housekeeping: one array per channel
+# (T_APU_SURF_3, V_SURF1IN_0, ...) plus timestamps, so plotting a day
+# of temperatures is one read instead of re-decoding every packet.
+#
+# with HskLogReader('crate.hsklog') as log:
+#     cols = HskColumns()
+#     cols.add(log.packets(direction=HskBase.RX))
+#     cols.save('crate_columns')
+#
+# t, T = load('crate_columns')['T_APU_SURF_3']
+#
+# Packets get sorted into per-(src, cmd) groups as raw ADC values
+# (array('H'), so a day of telemetry stays small), and the scale/offset
+# conversion is done once per channel at the end - with numpy if it's
+# around, otherwise in plain Python. Short payloads (a VDAQ TURFIO's
+# eVolts only has 6 SURFs) still get a row, with NaN for the fields
+# that weren't there.
+#
+# On disk it's a directory with one little-endian float64 file per
+# channel, one int64 nanosecond timestamp file per (src, cmd) group and
+# a manifest.json tying them together, so numpy.fromfile or
+# array.fromfile can read them directly.
+from array import array
+import json
+import os
+import sys
+
+from HskSerial import HskPacket, deviceType, boardNum
+import HskSchema
+
+np = None
+try:
+    import numpy as np
+except ImportError:
+    pass
+
+class HskGroup:
+    """ Raw samples from one (src, cmd): a timestamp array plus one raw array per field. """
+    def __init__(self, schema, n):
+        self.schema = schema
+        self.channels = [ c.format(n=n) for c in schema.channels ]
+        self.times = array('q')
+        self.raw = [ array('H') for c in self.channels ]
+        # how many fields each row really had, and how many rows were short
+        self.nfields = array('H')
+        self.short = 0
+
+    def add(self, t, data):
+        raw = self.schema.raw(data)
+        if not len(raw):
+            return False
+        self.times.append(t)
+        for col, v in zip(self.raw, raw):
+            col.append(v)
+        # the columns have to line up: missing fields become NaN in columns()
+        for col in self.raw[len(raw):]:
+            col.append(0)
+        self.nfields.append(len(raw))
+        if len(raw) < len(self.raw):
+            self.short += 1
+        return True
+
+    def columns(self):
+        """ Returns a list of (channel, values) with the conversions applied. """
+        out = []
+        nfields = np.frombuffer(self.nfields, dtype=np.uint16) if np is not None and self.short else None
+        for i, (c, raw, s, o) in enumerate(zip(self.channels, self.raw, self.schema.scales, self.schema.offsets)):
+            if np is not None:
+                vals = np.frombuffer(raw, dtype=np.uint16)*s + o
+                if self.short:
+                    vals[nfields <= i] = np.nan
+            else:
+                vals = array('d', [ v*s+o if n > i else float('nan') for v, n in zip(raw, self.nfields) ])
+            out.append((c, vals))
+        return out
+
+class HskColumns:
+    """ Accumulates decoded housekeeping into per-channel columns. """
+    def __init__(self):
+        # (src, cmd) -> HskGroup, or None if there's no schema for it
+        self.groups = {}
+        # packets with nothing we could decode
+        self.skipped = 0
+
+    def add(self, packets):
+        """ Add packets: an iterable of (time, direction, HskPacket) as from HskLogReader.packets(), or (time, HskPacket). """
+        groups = self.groups
+        for item in packets:
+            t = item[0]
+            pkt = item[-1]
+            key = (pkt.src, pkt.cmd)
+            grp = groups.get(key, False)
+            if grp is False:
+                grp = self._group(pkt)
+                groups[key] = grp
+            if grp is None or not grp.add(t, pkt.data):
+                self.skipped += 1
+
+    def short(self):
+        """ Returns a dict of (src, cmd) -> how many of its rows came in short (and got NaN padding). """
+        return { k : g.short for k, g in self.groups.items() if g is not None and g.short }
+
+    def _group(self, pkt):
+        if pkt.cmd not in HskPacket.strings:
+            return None
+        schema = HskSchema.lookup(HskPacket.strings[pkt.cmd], deviceType(pkt.src))
+        if schema is None:
+            return None
+        return HskGroup(schema, boardNum(pkt.src))
+
+    def columns(self):
+        """ Returns a dict of channel -> (times, values). """
+        out = {}
+        for grp in self.groups.values():
+            if grp is None or not len(grp.times):
+                continue
+            times = np.frombuffer(grp.times, dtype=np.int64) if np is not None else grp.times
+            for c, vals in grp.columns():
+                out[c] = (times, vals)
+        return out
+
+    def save(self, path):
+        """ Write the columns into directory path. """
+        os.makedirs(path, exist_ok=True)
+        manifest = { 'byteorder' : 'little', 'channels' : {} }
+        for (src, cmd), grp in self.groups.items():
+            if grp is None or not len(grp.times):
+                continue
+            tname = 'times_%2.2x_%2.2x.i8' % (src, cmd)
+            _write(os.path.join(path, tname), grp.times)
+            for c, vals in grp.columns():
+                vname = c + '.f8'
+                if np is not None:
+                    vals = array('d', vals.tobytes())
+                _write(os.path.join(path, vname), vals)
+                manifest['channels'][c] = { 'times' : tname,
+                                            'values' : vname,
+                                            'count' : len(grp.times) }
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+def _write(fn, arr):
+    if sys.byteorder != 'little':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    with open(fn, 'wb') as f:
+        arr.tofile(f)
+
+def _read(fn, typecode, count):
+    if np is not None:
+        return np.fromfile(fn, dtype='<i8' if typecode == 'q' else '<f8', count=count)
+    arr = array(typecode)
+    with open(fn, 'rb') as f:
+        arr.fromfile(f, count)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+def load(path, channels=None):
+    """ Read columns saved by HskColumns.save. Returns a dict of channel -> (times, values). """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    out = {}
+    times = {}
+    for c, info in manifest['channels'].items():
+        if channels is not None and c not in channels:
+            continue
+        if info['times'] not in times:
+            times[info['times']] = _read(os.path.join(path, info['times']), 'q', info['count'])
+        out[c] = (times[info['times']],
+                  _read(os.path.join(path, info['values']), 'd', info['count']))
+    return out
@@ -0,0 +1,134 @@
+# Cached board inventory: what eIdentify said about each board, kept in
+# a JSON file so version audits don't have to ask every SURF every time.
+#
+# inv = HskInventory('~/.hskinventory.json', ttl=3600)
+# hsk.addTap(inv)
+# info = inv.refresh(hsk, surfs)
+# print(info[0x89]['sqfsVersion'])
+#
+# refresh() only sends eIdentify to boards which are missing or older
+# than ttl seconds. As a tap it also picks up any eIdentify replies
+# going by, and forgets a board's identity when we send it eRestart or
+# eReloadFirmware (since it'll come back with whatever it boots). A
+# board's location is remembered separately and survives invalidation.
+import json
+import os
+import threading
+import time
+
+from HskSerial import HskPacket, HskBase, deviceType
+
+# SURF eIdentify strings, in order
+SURF_FIELDS = ( 'dna', 'mac', 'petalinux', 'sqfsVersion', 'sqfsHash', 'sqfsDate' )
+
+# commands after which a board's identity can't be trusted
+INVALIDATE = ( HskPacket.cmds['eRestart'], HskPacket.cmds['eReloadFirmware'] )
+IDENTIFY = HskPacket.cmds['eIdentify']
+
+DEFAULT_PATH = '~/.hskinventory.json'
+
+def parseIdentify(addr, data):
+    """ Turn an eIdentify payload into a dict. """
+    if deviceType(addr) == 'SURF':
+        vals = bytes(data).split(b'\x00') + [b'']*len(SURF_FIELDS)
+        return { f : v.decode('utf-8', 'replace') for f, v in zip(SURF_FIELDS, vals) }
+    return { 'hskVersion' : data[0] if len(data) > 0 else None,
+             'bits' : data[1] if len(data) > 1 else None }
+
+class HskInventory:
+    """ Persistent cache of eIdentify results keyed by address. Use it as a tap to keep it honest. """
+    def __init__(self, path=DEFAULT_PATH, ttl=3600):
+        """ path is the JSON file (None to keep it in memory), ttl how long (s) an entry stays fresh. """
+        self.path = os.path.expanduser(path) if path is not None else None
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # addr -> { 'time' : ..., 'location' : ..., plus the parseIdentify fields }
+        self.entries = {}
+        if self.path is not None and os.path.exists(self.path):
+            # a broken cache just means asking everyone again
+            try:
+                with open(self.path) as f:
+                    self.entries = { int(k, 16) : v for k, v in json.load(f).items() }
+            except (ValueError, AttributeError, OSError):
+                self.entries = {}
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = { '%2.2x' % k : v for k, v in sorted(self.entries.items()) }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def fresh(self, addr):
+        e = self.entries.get(addr)
+        return e is not None and e.get('time', 0) + self.ttl > time.time()
+
+    def get(self, addr):
+        """ The entry for addr if it's fresh, otherwise None. """
+        with self.lock:
+            return dict(self.entries[addr]) if self.fresh(addr) else None
+
+    def peek(self, addr):
+        """ The entry for addr however old it is (None if we've never seen it). """
+        with self.lock:
+            e = self.entries.get(addr)
+            return dict(e) if e is not None else None
+
+    def stale(self, addrs):
+        """ The addresses in addrs which need asking again. """
+        with self.lock:
+            return [ a for a in addrs if not self.fresh(a) ]
+
+    def update(self, addr, data, save=True):
+        """ Store an eIdentify payload from addr. """
+        info = parseIdentify(addr, data)
+        with self.lock:
+            e = { 'location' : self.entries.get(addr, {}).get('location') }
+            e.update(info)
+            e['time'] = time.time()
+            self.entries[addr] = e
+        if save:
+            self.save()
+
+    def locate(self, addr, location):
+        """ Record where addr lives (e.g. 'VR slot 3'). """
+        with self.lock:
+            self.entries.setdefault(addr, { 'time' : 0 })['location'] = location
+
+    def invalidate(self, addr=None):
+        """ Mark addr (or everything) as needing a re-query. Locations are kept. """
+        with self.lock:
+            for a in ([addr] if addr is not None else list(self.entries)):
+                if a in self.entries:
+                    self.entries[a]['time'] = 0
+
+    def refresh(self, query, addrs, force=False):
+        """ Make sure every address in addrs is fresh, sending eIdentify to the ones that aren't.
+            query is either a link (HskSerial/HskEthernet) or a callable taking a list of
+            addresses and returning a dict of address -> eIdentify payload (None if no answer).
+            Returns a dict of address -> entry (None for boards which didn't answer). """
+        ask = list(addrs) if force else self.stale(addrs)
+        if ask:
+            if isinstance(query, HskBase):
+                replies = { a : (p.data if p is not None else None)
+                            for a, p in query.poll(ask, IDENTIFY).items() }
+            else:
+                replies = query(ask)
+            for a, data in replies.items():
+                if data is not None:
+                    self.update(a, data, save=False)
+            self.save()
+        return { a : self.get(a) for a in addrs }
+
+    def __call__(self, direction, frame):
+        # tap: catch eIdentify replies and commands which reboot things
+        if len(frame) < 5:
+            return
+        if direction == HskBase.TX and frame[2] in INVALIDATE:
+            self.invalidate(frame[1])
+            self.save()
+        elif direction == HskBase.RX and frame[2] == IDENTIFY and not sum(frame[4:]) & 0xFF:
+            self.update(frame[0], bytes(frame[4:-1]), save=False)
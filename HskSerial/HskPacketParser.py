@@ -1,5 +1,6 @@
 import time 
 from HskSerial import HskSerial, HskPacket
+import HskSchema
 
 # SURFs in Hpol LRACK --> SOCID
 surfsHL = [ 0x97, 0xa0, 0x99, 0x8d, 0x9d, 0x94, 0x8a ]
@@ -29,7 +30,7 @@ class HskParser:
         self.dest = dest
         self.pkt = pkt
 
-        if dest == 0x40 or dest == 0.48 or dest == 0x50 or dest == 0x58: 
+        if dest == 0x40 or dest == 0x48 or dest == 0x50 or dest == 0x58: 
             if cmd == 0x12: 
                 self.tfIdentify()
             elif cmd == 0x10: 
@@ -68,46 +69,31 @@ class HskParser:
     
     def tfTemp(self):
 
-        tfiotemp = int.from_bytes(self.pkt[0:2])
-        srftemp = []
-        for iter in range(2,16,2): 
-            srftemp.append(int.from_bytes(self.pkt[iter:iter+2]))
+        schema = HskSchema.lookup('eTemps', 'TURFIO')
+        raw = schema.raw(self.pkt)
+        temps = schema.convert(raw)
 
-        temparray = []
-        tfiotemp = ((tfiotemp * 503.975) / 2 ** 12) - 273.15
-        temparray.append(tfiotemp)
-        
-            
-        for iter in range(len(srftemp)): 
-            if srftemp[iter] != 0: 
-                srftemp[iter] = format((( srftemp[iter] * 10 - 31880 ) / 42), '.2f')
-                temparray.append(srftemp[iter])
-                
+        temparray = [ temps.T_TURFIO ]
+        # a hotswap reading of exactly 0 means nothing's there
+        for adc, temp in zip(raw[1:], temps[1:]): 
+            if adc != 0: 
+                temparray.append(format(temp, '.2f'))
             else:
                 temparray.append('NaN')
                 
-            
-            
-            print("{}: {}C".format('TURFIO Slot 0', format(tfiotemp, '.2f')))
+        print("{}: {}C".format('TURFIO Slot 0', format(temps.T_TURFIO, '.2f')))
+        print("")
+        for iter in range(1, len(temparray)): 
+            print("SURF Slot {}: {}C".format(iter, temparray[iter]))
             print("")
-            for iter in range(len(srftemp)): 
-                print("SURF Slot {}: {}C".format(iter + 1, temparray[iter]))
-                print("")
                 
         return temparray
     
     def sfTemp(self): 
 
-        def SFTempFunc(val): 
-            return (val * 509.3140064) / 2 ** 16 - 280.23087870
-        
-        decimal_values = []
-        for iter in range(0,4,2): 
-            decimal_values.append(int.from_bytes(self.pkt[iter:iter+2]))
-        
-        for iter in range(0,len(decimal_values),2) : 
-            rpuTemp = (SFTempFunc(decimal_values[iter]))
-            apuTemp = (SFTempFunc(decimal_values[iter+1]))
+        temps = HskSchema.lookup('eTemps', 'SURF').decode(self.pkt)
+        # first sensor is reported as the RPU here, see packet_parser
+        rpuTemp, apuTemp = temps[0], temps[1]
         
         print("RPU: {}C".format(format(rpuTemp, '.2f')))
         print("APU: {}C".format(format(apuTemp, '.2f')))
@@ -117,43 +103,31 @@ class HskParser:
     
     def tfVolts(self):
         
-        def vSFeq(num): 
-            return ((num + 0.5) * 5.104) / 1000
-        
-        voltsTF = int.from_bytes(self.pkt[0:2])
+        volts = HskSchema.lookup('eVolts', 'TURFIO').decode(self.pkt)
 
-        voltsTF = (voltsTF * 26.35) / 2 ** 12
         print('')
         print('TURFIO')
-        print('Vin: {}V'.format(format(voltsTF, '.2f')))
-
-        voltsSFin = []
-        voltsSFout = []
-
-        endVal = len(self.pkt)
-        for iter in range(2,endVal,4): 
-            voltsSFin.append(int.from_bytes(self.pkt[iter:iter+2]))
-            voltsSFout.append(int.from_bytes(self.pkt[iter+2:iter+4]))
+        print('Vin: {}V'.format(format(volts.Vin, '.2f')))
 
-        for iter in range(len(voltsSFin)): 
-            voltsSFin[iter] = (vSFeq(voltsSFin[iter]))
-            voltsSFout[iter] = (vSFeq(voltsSFout[iter]))
+        for iter in range((len(volts) - 1) // 2): 
+            vin, vout = volts[1+2*iter], volts[2+2*iter]
+            if vout is None: 
+                break
             print('')
             print('SURF Slot {}'.format(iter))
-            print('Vin: {}V'.format(format(voltsSFin[iter], '.2f')))
-            print('Vout: {}V'.format(format(voltsSFout[iter], '.2f')))
+            print('Vin: {}V'.format(format(vin, '.2f')))
+            print('Vout: {}V'.format(format(vout, '.2f')))
     
     def sfVolts(self): 
         
-        def vSFRF(num): 
-            return (num / 2 ** 16) * 3
-
-        print('0.85V: {}V'.format(self.rounding(vSFRF(int.from_bytes(self.pkt[0:2])))))
-        print('1.8V: {}V'.format(self.rounding(vSFRF(int.from_bytes(self.pkt[2:4])))))
-        print('PS_MGTRAVTT (nominal 1.8V): {}V'.format(format(vSFRF(int.from_bytes(self.pkt[4:6])), '.2f')))
-        print('PS_MGTRAVCC (nominal 0.85V): {}V'.format(format(vSFRF(int.from_bytes(self.pkt[6:8])), '.2f')))
-        print('MGTAVTT (nominal 1.2V): {}V'.format(format(vSFRF(int.from_bytes(self.pkt[8:10])), '.2f')))
-        print('DDR_1V2 (nominal 1.2V): {}V'.format(self.rounding(vSFRF(int.from_bytes(self.pkt[10:12])))))
+        volts = HskSchema.lookup('eVolts', 'SURF').decode(self.pkt)
+
+        print('0.85V: {}V'.format(self.rounding(volts.V0P85)))
+        print('1.8V: {}V'.format(self.rounding(volts.V1P8)))
+        print('PS_MGTRAVTT (nominal 1.8V): {}V'.format(format(volts.PS_MGTRAVTT, '.2f')))
+        print('PS_MGTRAVCC (nominal 0.85V): {}V'.format(format(volts.PS_MGTRAVCC, '.2f')))
+        print('MGTAVTT (nominal 1.2V): {}V'.format(format(volts.MGTAVTT, '.2f')))
+        print('DDR_1V2 (nominal 1.2V): {}V'.format(self.rounding(volts.DDR_1V2)))
 
         
     # Random utils in case
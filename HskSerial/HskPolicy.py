@@ -0,0 +1,86 @@
+# Timeout and retry policies for housekeeping requests.
+#
+# Every link keeps a HskRttEstimator: a smoothed round-trip time and
+# variance per destination (the usual TCP-style EWMA), giving a timeout
+# of srtt + 4*rttvar, clamped. A destination we've never heard from
+# borrows the link-wide estimate, and if there isn't one of those yet
+# it gets the initial timeout.
+#
+# The HskRetryPolicy then says how many times to try and how much to
+# stretch the timeout each time. Commands which change state on the
+# board (NON_IDEMPOTENT) only ever get one try: if eRestart times out we
+# can't tell whether it happened, and sending it again might restart
+# the board twice.
+#
+# hsk.rtt = HskRttEstimator(initial=0.2, minTimeout=0.02)
+# hsk.retry = HskRetryPolicy(retries=1)
+# pkt = hsk.request(0x80, 'eTemps')
+
+class HskRttEstimator:
+    """ Per-destination smoothed RTT estimate driving adaptive timeouts. """
+    # the usual gains
+    ALPHA = 1/8
+    BETA = 1/4
+
+    def __init__(self, initial=1.0, minTimeout=0.05, maxTimeout=5.0):
+        self.initial = initial
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        # dest -> [srtt, rttvar], None is link-wide
+        self.est = {}
+
+    def _update(self, key, rtt):
+        e = self.est.get(key)
+        if e is None:
+            self.est[key] = [rtt, rtt/2]
+        else:
+            e[1] = (1-self.BETA)*e[1] + self.BETA*abs(e[0] - rtt)
+            e[0] = (1-self.ALPHA)*e[0] + self.ALPHA*rtt
+
+    def update(self, dest, rtt):
+        """ Feed in an observed round trip (seconds) to dest. """
+        self._update(dest, rtt)
+        self._update(None, rtt)
+
+    def srtt(self, dest):
+        """ Smoothed RTT to dest, or None if we've never seen one. """
+        e = self.est.get(dest)
+        return e[0] if e is not None else None
+
+    def timeout(self, dest):
+        """ Timeout to use for a request to dest. """
+        e = self.est.get(dest, self.est.get(None))
+        if e is None:
+            return self.initial
+        return min(self.maxTimeout, max(self.minTimeout, e[0] + 4*e[1]))
+
+    def reset(self, dest=None):
+        """ Forget everything (or just dest). """
+        if dest is None:
+            self.est = {}
+        else:
+            self.est.pop(dest, None)
+
+# command names which are never retried
+NON_IDEMPOTENT = frozenset(( 'eFwNext', 'eLoadSoft', 'eSoftNext', 'eSoftNextReboot',
+                             'eDownloadMode', 'eRestart', 'ePMBus', 'eReloadFirmware' ))
+
+class HskRetryPolicy:
+    """ How many times to retry a request, and how to back off the timeout. """
+    def __init__(self, retries=2, backoff=2.0, maxTimeout=5.0, once=NON_IDEMPOTENT):
+        """ once is the command names which only get one try. """
+        self.retries = retries
+        self.backoff = backoff
+        self.maxTimeout = maxTimeout
+        self.once = once
+
+    def attempts(self, cmd=None):
+        """ How many tries cmd (a command name) gets. """
+        return 1 if cmd in self.once else self.retries+1
+
+    def timeouts(self, first, cmd=None):
+        """ Generator of the timeout for each attempt at cmd (a command name). """
+        t = first
+        for i in range(self.attempts(cmd)):
+            yield min(t, self.maxTimeout)
+            t *= self.backoff
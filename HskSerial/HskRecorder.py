@@ -0,0 +1,372 @@
+# Telemetry recorder: an append-only binary log of housekeeping frames.
+#
+# rec = HskRecorder('crate.hsklog')
+# hsk.addTap(rec)
+# ... do stuff ...
+# rec.close()
+#
+# log = HskLogReader('crate.hsklog')
+# for t, direction, pkt in log.packets(src=0x40, cmd='eTemps', start=t0):
+#     print(t, pkt.pretty())
+#
+# Layout (all little-endian):
+#
+# file header   : 'HSKLOG\x00\x02' + u64 creation time (ns since epoch)
+# record header : u8 type, u8 direction, u16 length, u64 time (ns)
+#   'P' record  : header + the frame (length bytes)
+#   'I' record  : header (length = frames) + u64 first time + u64 last time
+#                 + u16 number of (src, cmd) pairs
+#                 + one (u8 src, u8 cmd, u16 frames) per pair
+#                 + one (u64 offset, u64 time, u8 src, u8 cmd, u8 dir)
+#                 per 'P' record since the previous index
+#   'D' record  : header + u64 index blocks + u64 frames they cover
+#                 + one (u64 offset, u64 first time, u64 last time,
+#                 u64 position of its first frame) per 'I' record
+# footer        : 'HSKEND\x00\x02' + u64 offset of the 'D' record
+#
+# Frames are stored as they are before COBS encoding/after decoding
+# (header, data and checksum): the length prefix makes the COBS
+# escaping pointless on disk. Times come from time.monotonic_ns(),
+# offset to wall-clock at the time the recorder was opened, so they
+# never go backwards within a session but are still comparable between
+# sessions.
+#
+# Opening a log only reads the footer and the 'D' record's header:
+# looking up a time bisects the directory in place and then reads the
+# one index block it lands in. Looking up a (src, cmd) skips any index
+# block whose summary doesn't have it, so it's still a walk over the
+# blocks in the time range, but not over their entries. Positions are
+# in file order, which is time order as long as times don't go
+# backwards (they don't, unless you give record() your own).
+#
+# The footer and directory are only written by close(); re-opening a
+# log strips them and carries on appending. A log without one (crash,
+# power cut) is still readable, it just gets scanned (record headers
+# only) to rebuild the directory, and the recorder fixes it up the next
+# time it's opened.
+from bisect import bisect_left, bisect_right
+import mmap
+import os
+import struct
+import threading
+import time
+
+from HskSerial import HskPacket
+
+MAGIC = b'HSKLOG\x00\x02'
+ENDMAGIC = b'HSKEND\x00\x02'
+# version 1 logs have no block summaries or directory
+OLDMAGIC = b'HSKLOG\x00\x01'
+fileHeader = struct.Struct('<8sQ')
+recordHeader = struct.Struct('<BBHQ')
+indexHeader = struct.Struct('<QQH')
+indexKey = struct.Struct('<BBH')
+indexEntry = struct.Struct('<QQBBB')
+directoryHeader = struct.Struct('<QQ')
+directoryEntry = struct.Struct('<QQQQ')
+footer = struct.Struct('<8sQ')
+
+PACKET = ord('P')
+INDEX = ord('I')
+DIRECTORY = ord('D')
+
+def _checkMagic(magic, name):
+    if magic == OLDMAGIC:
+        raise IOError("%s is an old (version 1) housekeeping log" % name)
+    if magic != MAGIC:
+        raise IOError("%s is not a housekeeping log" % name)
+
+class HskRecorder:
+    """ Appends housekeeping frames to a log. Use it as a tap: hsk.addTap(recorder). """
+    def __init__(self, path, indexEvery=256):
+        # an index block's frame count has to fit in the u16 record length
+        self.indexEvery = min(indexEvery, 0xFFFF)
+        self.lock = threading.Lock()
+        self.entries = []
+        # packed directory entries for the index blocks so far, and how many frames they cover
+        self.directory = bytearray()
+        self.indexed = 0
+        self.f = open(path, 'ab+')
+        self.f.seek(0, os.SEEK_END)
+        if self.f.tell() == 0:
+            self.f.write(fileHeader.pack(MAGIC, time.time_ns()))
+        else:
+            self._reopen()
+        # monotonic -> wall-clock offset
+        self.t0 = time.time_ns() - time.monotonic_ns()
+
+    def _reopen(self):
+        self.f.seek(0)
+        magic, _ = fileHeader.unpack(self.f.read(fileHeader.size))
+        _checkMagic(magic, self.f.name)
+        end = self.f.seek(0, os.SEEK_END)
+        if end >= fileHeader.size + footer.size:
+            self.f.seek(end - footer.size)
+            magic, dirOff = footer.unpack(self.f.read(footer.size))
+            if magic == ENDMAGIC:
+                self.f.seek(dirOff + recordHeader.size)
+                nblocks, self.indexed = directoryHeader.unpack(self.f.read(directoryHeader.size))
+                self.directory = bytearray(self.f.read(nblocks*directoryEntry.size))
+                # drop the directory and footer, we'll write new ones
+                self.f.truncate(dirOff)
+                self.f.seek(0, os.SEEK_END)
+                return
+        # no footer: index whatever the previous writer didn't get to
+        idx = HskLogReader(self.f.name)
+        self.directory = bytearray(idx.dirBuf[idx.dirBase:idx.dirBase + idx.nblocks*directoryEntry.size])
+        self.indexed = idx.indexed
+        self.entries = idx.unindexed
+        idx.close()
+        # and chop off any torn record at the end
+        self.f.truncate(idx.end)
+        self.f.seek(0, os.SEEK_END)
+
+    def __call__(self, direction, frame):
+        self.record(direction, frame)
+
+    def record(self, direction, frame, t=None):
+        """ Append one frame. t is in ns (defaults to now). """
+        if t is None:
+            t = self.t0 + time.monotonic_ns()
+        src = frame[0] if len(frame) > 0 else 0
+        cmd = frame[2] if len(frame) > 2 else 0
+        with self.lock:
+            off = self.f.tell()
+            self.f.write(recordHeader.pack(PACKET, direction, len(frame), t))
+            self.f.write(frame)
+            self.entries.append((off, t, src, cmd, direction))
+            if len(self.entries) >= self.indexEvery:
+                self._writeIndex(t)
+
+    def _writeIndex(self, t):
+        if not self.entries:
+            return
+        off = self.f.tell()
+        times = [ e[1] for e in self.entries ]
+        keys = {}
+        for e in self.entries:
+            keys[e[2], e[3]] = keys.get((e[2], e[3]), 0) + 1
+        tmin, tmax = min(times), max(times)
+        body = bytearray(indexHeader.pack(tmin, tmax, len(keys)))
+        for (src, cmd), n in sorted(keys.items()):
+            body += indexKey.pack(src, cmd, n)
+        for e in self.entries:
+            body += indexEntry.pack(*e)
+        self.f.write(recordHeader.pack(INDEX, 0, len(self.entries), t))
+        self.f.write(body)
+        self.f.flush()
+        self.directory += directoryEntry.pack(off, tmin, tmax, self.indexed)
+        self.indexed += len(self.entries)
+        self.entries = []
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            if self.f.closed:
+                return
+            t = self.t0 + time.monotonic_ns()
+            self._writeIndex(t)
+            dirOff = self.f.tell()
+            self.f.write(recordHeader.pack(DIRECTORY, 0, 0, t))
+            self.f.write(directoryHeader.pack(len(self.directory)//directoryEntry.size, self.indexed))
+            self.f.write(self.directory)
+            self.f.write(footer.pack(ENDMAGIC, dirOff))
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+class _Column:
+    """ One field of a reader's block directory as a sequence, so bisect can search it in place. """
+    def __init__(self, reader, field):
+        self.reader = reader
+        self.field = field
+
+    def __len__(self):
+        return self.reader.nblocks
+
+    def __getitem__(self, k):
+        return self.reader.block(k)[self.field]
+
+class HskLogReader:
+    """ mmaps a housekeeping log and looks things up through its index, reading index blocks as they're needed. """
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        size = os.fstat(self.f.fileno()).st_size
+        if size < fileHeader.size:
+            raise IOError("%s is too short to be a housekeeping log" % path)
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.created = fileHeader.unpack_from(self.mm, 0)
+        _checkMagic(magic, path)
+        # entries after the last index block (only if there's no footer)
+        self.unindexed = []
+        # end of the last complete record
+        self.end = size - footer.size
+        # the block directory lives in dirBuf at dirBase: the mmap if
+        # there's a footer, otherwise rebuilt by _scan
+        magic, dirOff = footer.unpack_from(self.mm, size - footer.size) if size >= fileHeader.size + footer.size else (None, 0)
+        if magic == ENDMAGIC:
+            self.dirBuf = self.mm
+            self.dirBase = dirOff + recordHeader.size + directoryHeader.size
+            self.nblocks, self.indexed = directoryHeader.unpack_from(self.mm, dirOff + recordHeader.size)
+        else:
+            self._scan(size)
+        self.firstTimes = _Column(self, 1)
+        self.lastTimes = _Column(self, 2)
+        self.firsts = _Column(self, 3)
+        # (block number, its entries): the last block we read
+        self.cached = (None, None)
+
+    def _scan(self, size):
+        # no footer, walk the record headers. stop at a torn final record.
+        mm = self.mm
+        directory = bytearray()
+        indexed = 0
+        pending = []
+        off = fileHeader.size
+        while off + recordHeader.size <= size:
+            rtype, direction, length, t = recordHeader.unpack_from(mm, off)
+            body = off + recordHeader.size
+            if rtype == PACKET:
+                end = body + length
+                if end > size:
+                    break
+                pending.append((off, t,
+                                mm[body] if length > 0 else 0,
+                                mm[body+2] if length > 2 else 0,
+                                direction))
+            elif rtype == INDEX:
+                if body + indexHeader.size > size:
+                    break
+                tmin, tmax, nkeys = indexHeader.unpack_from(mm, body)
+                end = body + indexHeader.size + nkeys*indexKey.size + length*indexEntry.size
+                if end > size:
+                    break
+                directory += directoryEntry.pack(off, tmin, tmax, indexed)
+                indexed += length
+                pending = []
+            elif rtype == DIRECTORY:
+                # closed once, then the footer never made it
+                if body + directoryHeader.size > size:
+                    break
+                nblocks, _ = directoryHeader.unpack_from(mm, body)
+                end = body + directoryHeader.size + nblocks*directoryEntry.size
+                if end > size:
+                    break
+            else:
+                break
+            off = end
+        self.end = off
+        self.dirBuf = directory
+        self.dirBase = 0
+        self.nblocks = len(directory)//directoryEntry.size
+        self.indexed = indexed
+        self.unindexed = pending
+
+    def block(self, k):
+        """ (offset, first time, last time, position of its first frame) for index block k. """
+        return directoryEntry.unpack_from(self.dirBuf, self.dirBase + k*directoryEntry.size)
+
+    def blockKeys(self, k):
+        """ dict of (src, cmd) -> number of frames in index block k. """
+        base = self.block(k)[0] + recordHeader.size
+        nkeys = indexHeader.unpack_from(self.mm, base)[2]
+        base += indexHeader.size
+        return { (s, c) : n for s, c, n in indexKey.iter_unpack(self.mm[base:base + nkeys*indexKey.size]) }
+
+    def blockEntries(self, k):
+        """ The (offset, time, src, cmd, direction) entries of index block k (nblocks is the unindexed tail). """
+        if k == self.nblocks:
+            return self.unindexed
+        if self.cached[0] != k:
+            off = self.block(k)[0]
+            count = recordHeader.unpack_from(self.mm, off)[2]
+            nkeys = indexHeader.unpack_from(self.mm, off + recordHeader.size)[2]
+            base = off + recordHeader.size + indexHeader.size + nkeys*indexKey.size
+            self.cached = (k, list(indexEntry.iter_unpack(self.mm[base:base + count*indexEntry.size])))
+        return self.cached[1]
+
+    def __len__(self):
+        return self.indexed + len(self.unindexed)
+
+    def entry(self, i):
+        """ The i'th (offset, time, src, cmd, direction) in the log. """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("no frame %d in the log" % i)
+        if i >= self.indexed:
+            return self.unindexed[i - self.indexed]
+        k = bisect_right(self.firsts, i, 0, self.nblocks) - 1
+        return self.blockEntries(k)[i - self.block(k)[3]]
+
+    def _frameAt(self, off):
+        _, _, length, _ = recordHeader.unpack_from(self.mm, off)
+        start = off + recordHeader.size
+        return self.mm[start:start+length]
+
+    def frame(self, i):
+        """ The i'th frame. """
+        return self._frameAt(self.entry(i)[0])
+
+    def seekTime(self, t):
+        """ Position of the first frame at or after t (ns). """
+        k = bisect_left(self.lastTimes, t, 0, self.nblocks)
+        first = self.block(k)[3] if k < self.nblocks else self.indexed
+        return first + bisect_left([ e[1] for e in self.blockEntries(k) ], t)
+
+    def _select(self, src=None, cmd=None, start=None, stop=None, direction=None):
+        # (position, entry) for everything matching, reading only the blocks that might
+        if isinstance(cmd, str):
+            cmd = HskPacket.cmds[cmd]
+        k0 = 0 if start is None else bisect_left(self.lastTimes, start, 0, self.nblocks)
+        for k in range(k0, self.nblocks + 1):
+            if k < self.nblocks:
+                _, tmin, _, first = self.block(k)
+                if stop is not None and tmin >= stop:
+                    return
+                if (src is not None or cmd is not None) and not any((src is None or s == src) and
+                                                                    (cmd is None or c == cmd)
+                                                                    for s, c in self.blockKeys(k)):
+                    continue
+            else:
+                first = self.indexed
+            for j, e in enumerate(self.blockEntries(k)):
+                if ((start is None or e[1] >= start) and (stop is None or e[1] < stop) and
+                    (src is None or e[2] == src) and (cmd is None or e[3] == cmd) and
+                    (direction is None or e[4] == direction)):
+                    yield first + j, e
+
+    def select(self, src=None, cmd=None, start=None, stop=None, direction=None):
+        """ Positions of the frames matching src/cmd/direction with start <= time < stop. """
+        return [ i for i, _ in self._select(src, cmd, start, stop, direction) ]
+
+    def frames(self, **kwargs):
+        """ Generator of (time, direction, frame) for the frames select() picks. """
+        for _, e in self._select(**kwargs):
+            yield e[1], e[4], self._frameAt(e[0])
+
+    def packets(self, **kwargs):
+        """ Generator of (time, direction, HskPacket). Frames which fail their checksum are skipped. """
+        for t, direction, rx in self.frames(**kwargs):
+            try:
+                pkt = HskPacket.fromFrame(rx)
+            except IOError:
+                continue
+            yield t, direction, pkt
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
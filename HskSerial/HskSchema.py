@@ -0,0 +1,133 @@
+# Declarative payload layouts for housekeeping responses.
+#
+# Every (command, device type) we know how to decode gets a HskSchema:
+# a list of big-endian 16-bit fields, each with a linear scale/offset
+# to get to real units. The struct.Struct and the record type are built
+# once when the schema is registered (along with a straight-line
+# converter), so decoding a payload is one unpack_from plus a
+# multiply-add per field.
+#
+# rec = lookup('eTemps', 'TURFIO').decode(pkt.data)
+# print(rec.T_TURFIO, rec.T_SURF1HS)
+#
+# Payloads which come up short (e.g. a VDAQ TURFIO's eVolts only has 6
+# SURFs) decode as many whole fields as are there and leave the rest as
+# None.
+from collections import namedtuple
+import struct
+
+class HskSchema:
+    """ Fixed layout of a housekeeping payload: big-endian fields with scale/offset conversions. """
+    def __init__(self, name, fields, fmt='H'):
+        """ fields is a list of (field name, channel name template, scale, offset).
+            The channel template can use {n} for the board number. """
+        self.name = name
+        self.fmt = fmt
+        self.fieldNames = tuple(f[0] for f in fields)
+        self.channels = tuple(f[1] for f in fields)
+        self.scales = tuple(f[2] for f in fields)
+        self.offsets = tuple(f[3] for f in fields)
+        self.record = namedtuple(name, self.fieldNames, defaults=(None,)*len(fields))
+        self.fieldSize = struct.calcsize('>'+fmt)
+        # full-length struct, plus short ones built on demand
+        self.full = struct.Struct('>%d%s' % (len(fields), fmt))
+        self.structs = { len(fields) : self.full }
+        self._fullConvert = self._compile()
+
+    def _compile(self):
+        # build a straight-line converter for a full-length payload,
+        # which is a lot quicker than zipping through the scale/offsets
+        n = len(self.fieldNames)
+        args = ', '.join('a%d' % i for i in range(n))
+        exprs = ', '.join('a%d*%r+%r' % (i, self.scales[i], self.offsets[i]) for i in range(n))
+        src = ("def convert(raw):\n"
+               "    %s, = raw\n"
+               "    return _new(_record, (%s,))\n" % (args, exprs))
+        env = { '_new' : tuple.__new__, '_record' : self.record }
+        exec(src, env)
+        return env['convert']
+
+    def _struct(self, nfields):
+        s = self.structs.get(nfields)
+        if s is None:
+            s = struct.Struct('>%d%s' % (nfields, self.fmt))
+            self.structs[nfields] = s
+        return s
+
+    def raw(self, data):
+        """ Unpack the raw ADC values. """
+        if len(data) >= self.full.size:
+            return self.full.unpack_from(data)
+        return self._struct(len(data) // self.fieldSize).unpack_from(data)
+
+    def convert(self, raw):
+        """ Convert raw ADC values into a record. """
+        if len(raw) == len(self.fieldNames):
+            return self._fullConvert(raw)
+        return self.record(*[ v*s+o for v, s, o in zip(raw, self.scales, self.offsets) ])
+
+    def decode(self, data):
+        """ Unpack and convert data into a record. """
+        if len(data) >= self.full.size:
+            return self._fullConvert(self.full.unpack_from(data))
+        return self.convert(self.raw(data))
+
+    def encode(self, values):
+        """ The inverse of decode: pack a record (or any sequence of values in real units) into a payload. """
+        raw = [ min(0xFFFF, max(0, round((v-o)/s))) for v, s, o in zip(values, self.scales, self.offsets) ]
+        return self._struct(len(raw)).pack(*raw)
+
+    def pretty(self, data, n=None):
+        """ Decode into a dict of channel name -> value. """
+        return { c.format(n=n) : v for c, v in zip(self.channels, self.decode(data)) if v is not None }
+
+# conversions. all of these are linear in the ADC value.
+# SURF/TURF sysmon
+SYSMON_T = (509.3140064/(2**16), -280.2308787)
+# TURFIO die temp
+TURFIO_T = (503.975/(2**12), -273.15)
+# SURF hotswap temp via the TURFIO: (adc*10-31880)/42
+HOTSWAP_T = (10/42, -31880/42)
+# TURFIO input voltage
+TURFIO_VIN = (26.35/(2**12), 0)
+# SURF hotswap in/out voltage via the TURFIO: (adc+0.5)*5.104/1000
+HOTSWAP_V = (5.104/1000, 0.5*5.104/1000)
+# SURF sysmon supply
+SYSMON_V = (3/(2**16), 0)
+
+schemas = {}
+
+def register(cmd, devtype, schema):
+    schemas[(cmd, devtype)] = schema
+    return schema
+
+def lookup(cmd, devtype):
+    """ Returns the schema for (command name, device type), or None. """
+    return schemas.get((cmd, devtype))
+
+register('eTemps', 'TURF',
+         HskSchema('TurfTemps',
+                   [ ('T_APU', 'T_APU_TURF') + SYSMON_T,
+                     ('T_RPU', 'T_RPU_TURF') + SYSMON_T ]))
+register('eTemps', 'SURF',
+         HskSchema('SurfTemps',
+                   [ ('T_APU', 'T_APU_SURF_{n}') + SYSMON_T,
+                     ('T_RPU', 'T_RPU_SURF_{n}') + SYSMON_T ]))
+register('eTemps', 'TURFIO',
+         HskSchema('TurfioTemps',
+                   [ ('T_TURFIO', 'T_TURFIO_{n}') + TURFIO_T ] +
+                   [ ('T_SURF%dHS' % i, 'T_SURF%dHS_{n}' % i) + HOTSWAP_T for i in range(1, 8) ]))
+register('eVolts', 'TURFIO',
+         HskSchema('TurfioVolts',
+                   [ ('Vin', 'V_TURFIO_{n}') + TURFIO_VIN ] +
+                   [ f for i in range(1, 8) for f in
+                     (('SURF%d_Vin' % i, 'V_SURF%dIN_{n}' % i) + HOTSWAP_V,
+                      ('SURF%d_Vout' % i, 'V_SURF%dOUT_{n}' % i) + HOTSWAP_V) ]))
+register('eVolts', 'SURF',
+         HskSchema('SurfVolts',
+                   [ ('V0P85', 'V_0P85_SURF_{n}') + SYSMON_V,
+                     ('V1P8', 'V_1P8_SURF_{n}') + SYSMON_V,
+                     ('PS_MGTRAVTT', 'V_PS_MGTRAVTT_SURF_{n}') + SYSMON_V,
+                     ('PS_MGTRAVCC', 'V_PS_MGTRAVCC_SURF_{n}') + SYSMON_V,
+                     ('MGTAVTT', 'V_MGTAVTT_SURF_{n}') + SYSMON_V,
+                     ('DDR_1V2', 'V_DDR_1V2_SURF_{n}') + SYSMON_V ]))
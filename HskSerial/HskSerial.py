@@ -4,7 +4,10 @@ from serial import Serial
 from cobs import cobs
 import sys
 import socket
-from HskPacketParser import HskParser
+import time
+import HskSchema
+from HskPolicy import HskRttEstimator, HskRetryPolicy
+from HskStats import HskLinkStats
 
 
 
@@ -43,30 +46,8 @@ class HskPacket:
         "eReloadFirmware" : 0xCA
         }
 
-    #  cmd, src range
-    prettifiers = {
-            ('eTemps', 'TURF') : lambda d, a : {
-                'T_APU_TURF' : getT(d[0],d[1],'TURF'),
-                'T_RPU_TURF' : getT(d[2],d[3],'TURF')
-                },
-            ('eTemps', 'SURF') : lambda d, a : {
-                'T_APU_SURF_' + str(surfNum(a)) : getT(d[0], d[1],'SURF'),
-                'T_RPU_SURF_' + str(surfNum(a)) : getT(d[2], d[3],'SURF')
-                },
-            ('eTemps', 'TURFIO') : lambda d, a : {
-                'T_TURFIO_'  + str(turfioNum(a)) : getT(d[0], d[1], 'TURFIO'),
-                'T_SURF1HS_' + str(turfioNum(a)) : getT(d[2], d[3], 'SURFSWAP'),
-                'T_SURF2HS_' + str(turfioNum(a)) : getT(d[4], d[5], 'SURFSWAP'),
-                'T_SURF3HS_' + str(turfioNum(a)) : getT(d[6], d[7], 'SURFSWAP'),
-                'T_SURF4HS_' + str(turfioNum(a)) : getT(d[8], d[9], 'SURFSWAP'),
-                'T_SURF5HS_' + str(turfioNum(a)) : getT(d[10],d[11],'SURFSWAP'),
-                'T_SURF6HS_' + str(turfioNum(a)) : getT(d[12],d[13],'SURFSWAP'),
-                'T_SURF7HS_' + str(turfioNum(a)) : getT(d[14],d[15],'SURFSWAP')
-                }
-    }
-
-
-
+    #  cmd, src range -> HskSchema (see HskSchema.py)
+    prettifiers = HskSchema.schemas
 
     strings = dict(zip(cmds.values(),cmds.keys()))
 
@@ -112,12 +93,25 @@ class HskPacket:
         return myStr
 
 
+    def schema(self):
+        """ Returns the HskSchema for this packet's payload, or None. """
+        if self.cmd not in self.strings:
+            return None
+        return self.prettifiers.get((self.strings[self.cmd], deviceType(self.src)))
+
+    def record(self):
+        """ Decodes the payload into a typed record (namedtuple), or None if there's no schema for it. """
+        schema = self.schema()
+        if schema is not None:
+            return schema.decode(self.data)
+
     def prettyDict(self):
-            pretty_tuple =(self.strings[self.cmd], deviceType(self.src))
-            if pretty_tuple in self.prettifiers:
-                return self.prettifiers[pretty_tuple](self.data, self.src)
+        schema = self.schema()
+        if schema is not None:
+            return schema.pretty(self.data, boardNum(self.src))
         
-    def encode(self):
+    def frame(self):
+        """ The packet bytes before COBS encoding (header, data, checksum). """
         pkt = bytearray(4)
         pkt[0] = self.src
         pkt[1] = self.dest
@@ -125,37 +119,363 @@ class HskPacket:
         pkt[3] = len(self.data)
         pkt += self.data
         pkt.append((256-(sum(pkt[4:]))) & 0xFF)
-        return cobs.encode(pkt)
+        return pkt
+
+    def encode(self):
+        return cobs.encode(self.frame())
+
+    @classmethod
+    def fromFrame(cls, rx):
+        """ Build a packet from a COBS-decoded frame (bytes/bytearray/memoryview), checking it first. """
+        if len(rx) < 5:
+            raise IOError("received data only %d bytes" % len(rx))
+        if sum(rx[4:]) & 0xFF:
+            raise HskChecksumError("checksum failure: " + tohex(bytes(rx)))
+        return cls(rx[1],
+                   rx[2],
+                   data=rx[4:-1],
+                   src=rx[0])
+
+class HskChecksumError(IOError):
+    """ A frame came in fine but its checksum didn't add up. """
+    pass
+
+# Incremental framer for byte streams (i.e. serial). Bulk data gets
+# dumped into a reusable buffer with feed() (or straight into
+# writable() followed by commit()), and frames() splits it on the
+# zero delimiters and COBS-decodes each frame in place, handing back
+# memoryviews into the buffer. Those views are only good until the
+# next feed/commit.
+class HskFramer:
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # undecoded data lives in buf[head:tail]
+        self.head = 0
+        self.tail = 0
+
+    def writable(self):
+        """ Returns the free space at the end of the buffer, compacting or resyncing if needed. """
+        if self.tail == len(self.buf):
+            if self.head:
+                n = self.tail - self.head
+                self.buf[0:n] = self.buf[self.head:self.tail]
+                self.head = 0
+                self.tail = n
+            else:
+                # a full buffer with no delimiter is garbage: toss it and resync
+                self.head = 0
+                self.tail = 0
+        return self.view[self.tail:]
+
+    def commit(self, n):
+        """ Mark n bytes written into writable() as valid. """
+        self.tail += n
+
+    def feed(self, data):
+        """ Copy data into the buffer. """
+        data = memoryview(data)
+        while len(data):
+            space = self.writable()
+            n = min(len(space), len(data))
+            space[0:n] = data[0:n]
+            self.commit(n)
+            data = data[n:]
+
+    def nextFrame(self):
+        """ Returns the next COBS-decoded frame in the buffer, or None if there isn't a complete one. """
+        while True:
+            end = self.buf.find(b'\x00', self.head, self.tail)
+            if end < 0:
+                if self.head == self.tail:
+                    self.head = 0
+                    self.tail = 0
+                return None
+            start = self.head
+            self.head = end + 1
+            # back-to-back delimiters are just idle
+            if end == start:
+                continue
+            return self.decode(start, end)
+
+    def frames(self):
+        """ Generator of COBS-decoded frames currently in the buffer. """
+        while True:
+            rx = self.nextFrame()
+            if rx is None:
+                return
+            yield rx
+
+    def decode(self, start, end):
+        """ COBS-decode buf[start:end] in place, returns a memoryview of the result. """
+        buf = self.buf
+        r = start
+        w = start
+        while r < end:
+            code = buf[r]
+            r += 1
+            n = code - 1
+            if r + n > end:
+                raise cobs.DecodeError("not enough input bytes for length code")
+            # decoding never outruns the input, so w <= r always
+            if w != r:
+                buf[w:w+n] = buf[r:r+n]
+            w += n
+            r += n
+            if code < 0xFF and r < end:
+                buf[w] = 0
+                w += 1
+        return self.view[start:w]
 
 class HskBase:
+    # tap directions
+    TX = 0
+    RX = 1
+
     def __init__(self, srcId):
         self.src = srcId
+        self.defaultTimeout = None
+        # callables tap(direction, frame) which see every frame
+        # going by, before COBS encoding/after COBS decoding
+        self.taps = []
+        # adaptive timeouts and retries for request()/poll()
+        self.rtt = HskRttEstimator()
+        self.retry = HskRetryPolicy()
+        # counters/latency histograms, see HskStats.py
+        self.stats = HskLinkStats()
         self._writeImpl = lambda x : None
-        self._readImpl = lambda : none
+        self._readImpl = lambda : None
+        self._timeoutImpl = lambda t : None
+        # returns one COBS-decoded frame, or b'' on timeout
+        self._frameImpl = self._decodeImpl
 
-    def send(self, pkt, override=False):
-        """ Send a housekeeping packet. Uses HskSerial.src as source unless override is true or no source was provided """
+    def _decodeImpl(self):
+        crx = self._readImpl().strip(b'\x00')
+        if not len(crx):
+            return b''
+        return cobs.decode(crx)
+
+    def addTap(self, tap):
+        """ Add a tap(direction, frame) called for every frame sent/received. """
+        self.taps.append(tap)
+
+    def removeTap(self, tap):
+        self.taps.remove(tap)
+
+    def _tap(self, direction, frame):
+        for tap in self.taps:
+            tap(direction, frame)
+
+    def _encode(self, pkt, override):
         if not isinstance(pkt, HskPacket):
             raise TypeError("pkt must be of type HskPacket")
-        if not override:
+        if not override and self.src is not None:
             pkt.src = self.src
-        self._writeImpl(pkt.encode()+b'\x00')
+        tx = pkt.frame()
+        if self.taps:
+            self._tap(self.TX, tx)
+        ctx = cobs.encode(tx)+b'\x00'
+        self.stats.sent(tx, len(ctx))
+        return ctx
+
+    def send(self, pkt, override=False):
+        """ Send a housekeeping packet. Uses HskSerial.src as source unless override is true or no source was provided """
+        self._writeImpl(self._encode(pkt, override))
+
+    def sendMany(self, pkts, override=False):
+        """ Send several housekeeping packets with as few writes as the link allows. """
+        self._writeManyImpl([ self._encode(pkt, override) for pkt in pkts ])
+
+    def _writeManyImpl(self, frames):
+        # COBS frames are self-delimiting, so a byte stream takes them all at once
+        self._writeImpl(b''.join(frames))
+
+    def transaction(self):
+        """ Start a HskTransaction: queue up commands with add(), then run() them all at once. """
+        return HskTransaction(self)
 
     def receive(self):
-        """ Receive a housekeeping packet. No timeout right now. """
-        crx = self._readImpl().strip(b'\x00')
-        rx = cobs.decode(crx)
+        """ Receive a housekeeping packet. Raises TimeoutError if the link timeout expires. """
+        try:
+            rx = self._frameImpl()
+        except cobs.DecodeError:
+            self.stats.decodeError()
+            raise
+        if not len(rx):
+            raise TimeoutError("no packet received before timeout")
+        # frames are short enough that COBS adds 1 byte, plus the delimiter
+        self.stats.received(rx, len(rx)+2)
+        if self.taps:
+            self._tap(self.RX, rx)
         # checky checky
-        if len(rx) < 5:
-            raise IOError("received data only %d bytes" % len(rx))
-        if sum(rx[4:]) & 0xFF:
-            raise IOError("checksum failure: " + tohex(rx))
-        return HskPacket(rx[1],
-                         rx[2],
-                         data=rx[4:-1],
-                         src=rx[0])
+        return HskPacket.fromFrame(rx)
+
+    def packets(self):
+        """ Generator of received housekeeping packets. Stops at the first timeout. """
+        while True:
+            try:
+                yield self.receive()
+            except TimeoutError:
+                return
+
+    def request(self, dest, cmd, data=None, retry=None):
+        """ Send cmd to dest and wait for the reply, using the link's rtt estimator
+            for the timeout and its retry policy. Anything else that shows up while
+            waiting is dropped. Raises TimeoutError if every attempt times out.
+            retry = None retries unless the policy says cmd isn't safe to send twice
+            (eRestart etc.), False never retries and True always does. """
+        pkt = dest if isinstance(dest, HskPacket) else HskPacket(dest, cmd, data=data)
+        first = self.rtt.timeout(pkt.dest)
+        if retry is False:
+            timeouts = [ first ]
+        else:
+            timeouts = list(self.retry.timeouts(first, None if retry else HskPacket.strings.get(pkt.cmd)))
+        try:
+            for attempt, timeout in enumerate(timeouts):
+                start = time.monotonic()
+                deadline = start + timeout
+                self.send(pkt)
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats.timeout(pkt.dest, pkt.cmd)
+                        break
+                    self._timeoutImpl(remaining)
+                    try:
+                        rx = self.receive()
+                    except TimeoutError:
+                        self.stats.timeout(pkt.dest, pkt.cmd)
+                        break
+                    except (IOError, cobs.DecodeError):
+                        continue
+                    if rx.src == pkt.dest and rx.cmd == pkt.cmd:
+                        rtt = time.monotonic() - start
+                        self.stats.rtt(pkt.dest, pkt.cmd, rtt)
+                        # only first attempts are unambiguous RTT samples
+                        if attempt == 0:
+                            self.rtt.update(pkt.dest, rtt)
+                        return rx
+        finally:
+            self._timeoutImpl(self.defaultTimeout)
+        raise TimeoutError("no reply from %2.2x to %s after %d tries" %
+                           (pkt.dest, HskPacket.strings.get(pkt.cmd, pkt.cmd), len(timeouts)))
+
+    def poll(self, dests, cmd, data=None, timeout=None):
+        """ Pipelined poll: send cmd to every address in dests back-to-back, then
+            match replies by source address as they arrive. Each board gets
+            timeout seconds (default: from the rtt estimator) from when its
+            request went out. Returns a dict of address -> HskPacket, with None
+            for boards that never answered. """
+        if isinstance(cmd, str):
+            cmd = HskPacket.cmds[cmd]
+        replies = dict.fromkeys(dests)
+        deadlines = {}
+        sent = {}
+        for dest in dests:
+            self.send(HskPacket(dest, cmd, data=data))
+            sent[dest] = time.monotonic()
+            deadlines[dest] = sent[dest] + (timeout if timeout is not None else self.rtt.timeout(dest))
+        try:
+            while deadlines:
+                remaining = min(deadlines.values()) - time.monotonic()
+                if remaining <= 0:
+                    now = time.monotonic()
+                    for k in [ k for k, v in deadlines.items() if v <= now ]:
+                        self.stats.timeout(k, cmd)
+                        del deadlines[k]
+                    continue
+                self._timeoutImpl(remaining)
+                try:
+                    pkt = self.receive()
+                except TimeoutError:
+                    continue
+                except (IOError, cobs.DecodeError):
+                    # garbage on the line, keep listening
+                    continue
+                if pkt.src in deadlines and pkt.cmd == cmd:
+                    replies[pkt.src] = pkt
+                    del deadlines[pkt.src]
+                    rtt = time.monotonic() - sent[pkt.src]
+                    self.rtt.update(pkt.src, rtt)
+                    self.stats.rtt(pkt.src, cmd, rtt)
+        finally:
+            self._timeoutImpl(self.defaultTimeout)
+        return replies
 
         
+class HskTransaction:
+    """ A batch of commands to one or more boards, written in one go with the replies collected together.
+
+        tr = hsk.transaction()
+        for addr in surfs:
+            tr.add(addr, 'eIdentify')
+            tr.add(addr, 'eTemps')
+            tr.add(addr, 'eVolts')
+        replies = tr.run()
+
+        replies lines up with the add() calls: an HskPacket, or None if
+        nothing came back. Replies are matched by (src, cmd), so the same
+        command to the same board twice is fine - they're taken in order. """
+    def __init__(self, link):
+        self.link = link
+        self.pkts = []
+
+    def add(self, dest, cmd, data=None):
+        """ Queue cmd for dest. Returns its position in run()'s result. """
+        pkt = dest if isinstance(dest, HskPacket) else HskPacket(dest, cmd, data=data)
+        self.pkts.append(pkt)
+        return len(self.pkts)-1
+
+    def __len__(self):
+        return len(self.pkts)
+
+    def run(self, timeout=None):
+        """ Send everything and collect the replies. Each command gets timeout seconds
+            (default: from the link's rtt estimator) per command queued ahead of it at
+            the same board, since a board answers one at a time. """
+        link = self.link
+        replies = [None]*len(self.pkts)
+        # (dest, cmd) -> positions still waiting, oldest first
+        waiting = {}
+        deadlines = {}
+        depth = {}
+        start = time.monotonic()
+        link.sendMany(self.pkts)
+        for i, pkt in enumerate(self.pkts):
+            waiting.setdefault((pkt.dest, pkt.cmd), []).append(i)
+            depth[pkt.dest] = depth.get(pkt.dest, 0) + 1
+            t = timeout if timeout is not None else link.rtt.timeout(pkt.dest)
+            deadlines[i] = start + depth[pkt.dest]*t
+        try:
+            while deadlines:
+                remaining = min(deadlines.values()) - time.monotonic()
+                if remaining <= 0:
+                    now = time.monotonic()
+                    for i in [ i for i, v in deadlines.items() if v <= now ]:
+                        pkt = self.pkts[i]
+                        link.stats.timeout(pkt.dest, pkt.cmd)
+                        waiting[(pkt.dest, pkt.cmd)].remove(i)
+                        del deadlines[i]
+                    continue
+                link._timeoutImpl(remaining)
+                try:
+                    rx = link.receive()
+                except TimeoutError:
+                    continue
+                except (IOError, cobs.DecodeError):
+                    continue
+                pos = waiting.get((rx.src, rx.cmd))
+                if not pos:
+                    continue
+                i = pos.pop(0)
+                replies[i] = rx
+                del deadlines[i]
+                # replies queue up behind each other, so these go in the stats but not the rtt estimator
+                link.stats.rtt(rx.src, rx.cmd, time.monotonic() - start)
+        finally:
+            link._timeoutImpl(link.defaultTimeout)
+        return replies
+
 class HskEthernet(HskBase):
     TH_PORT = 21608
     def __init__(self,
@@ -169,8 +489,95 @@ class HskEthernet(HskBase):
 
         self.hs = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.hs.bind(self.localIpPort)
+        # a lost datagram shouldn't hang receive() forever
+        self.defaultTimeout = 5
+        self.hs.settimeout(self.defaultTimeout)
         self._writeImpl = lambda x : self.hs.sendto(x, self.remoteIpPort)
-        self._readImpl = lambda : self.hs.recv(1024)
+        # one packet per datagram
+        self._writeManyImpl = lambda frames : [ self._writeImpl(f) for f in frames ]
+        self._readImpl = self._recvImpl
+        self._timeoutImpl = self.hs.settimeout
+
+    def _recvImpl(self):
+        try:
+            return self.hs.recv(1024)
+        except socket.timeout:
+            return b''
+
+    def fanout(self, cmd, endpoints=None, data=None, dest=0x40, broadcast=None, window=1.0):
+        """ Send one command to a bunch of boards from this socket and collect the replies.
+            endpoints is a list of IPs (all commanded as dest), a list of (ip, dest)
+            or a dict of ip -> dest. Alternatively (or as well) give a broadcast
+            address, and one datagram goes there instead. Replies are collected for
+            up to window seconds, or until every endpoint has answered.
+            A reply only counts if it's cmd from the housekeeping address that IP was
+            sent (dest, for a broadcast).
+            Returns (replies, missed): a dict of ip -> HskPacket and a list of the
+            endpoints which didn't answer. """
+        if isinstance(cmd, str):
+            cmd = HskPacket.cmds[cmd]
+        if endpoints is None:
+            endpoints = {}
+        elif not isinstance(endpoints, dict):
+            endpoints = dict(e if isinstance(e, tuple) else (e, dest) for e in endpoints)
+        if broadcast is None and not endpoints:
+            raise ValueError("need endpoints or a broadcast address")
+        # one encoding per distinct housekeeping address
+        frames = {}
+        for d in ({dest} if broadcast is not None else set(endpoints.values())):
+            pkt = HskPacket(d, cmd, data=data)
+            if self.src is not None:
+                pkt.src = self.src
+            tx = pkt.frame()
+            frames[d] = (tx, cobs.encode(tx)+b'\x00')
+        if broadcast is not None:
+            self.hs.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sends = [ (broadcast, dest) ]
+        else:
+            sends = list(endpoints.items())
+        # only what actually goes out gets tapped
+        for ip, d in sends:
+            tx, ctx = frames[d]
+            self.hs.sendto(ctx, (ip, self.TH_PORT))
+            self.stats.sent(tx, len(ctx))
+            if self.taps:
+                self._tap(self.TX, tx)
+
+        replies = {}
+        deadline = time.monotonic() + window
+        try:
+            while True:
+                # with a broadcast and no list we don't know who's out there, so wait it out
+                if endpoints and all(ip in replies for ip in endpoints):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.hs.settimeout(remaining)
+                try:
+                    crx, (ip, port) = self.hs.recvfrom(1024)
+                except socket.timeout:
+                    break
+                try:
+                    rx = cobs.decode(crx.strip(b'\x00'))
+                except cobs.DecodeError:
+                    self.stats.decodeError(len(crx))
+                    continue
+                self.stats.received(rx, len(crx))
+                if self.taps:
+                    self._tap(self.RX, rx)
+                try:
+                    pkt = HskPacket.fromFrame(rx)
+                except IOError:
+                    continue
+                # a broadcast commanded dest everywhere, otherwise each IP got its own
+                expected = dest if broadcast is not None else endpoints.get(ip)
+                if pkt.cmd == cmd and pkt.src == expected and ip not in replies:
+                    replies[ip] = pkt
+        finally:
+            self.hs.settimeout(self.defaultTimeout)
+        missed = [ ip for ip in endpoints if ip not in replies ]
+        return replies, missed
     
 # build up and send the command given the destination, type,
 # and the data to deliver if any.
@@ -186,8 +593,24 @@ class HskSerial(Serial, HskBase):
         """ Create a housekeeping parser from a tty-like object. If srcId is provided, packets always come from that ID. """
         Serial.__init__(self, path, baudrate=baudrate, timeout=5)
         HskBase.__init__(self, srcId)
+        self.defaultTimeout = 5
         self._writeImpl = self.write
         self._readImpl = lambda : self.read_until(b'\x00')
+        self._timeoutImpl = lambda t : setattr(self, 'timeout', t)
+        # read_until goes a byte at a time, so frame in bulk instead
+        self.framer = HskFramer()
+        self._frameImpl = self._bulkFrameImpl
+
+    def _bulkFrameImpl(self):
+        while True:
+            rx = self.framer.nextFrame()
+            if rx is not None:
+                return rx
+            # out of frames, grab whatever's there (or block for 1 byte up to timeout)
+            data = self.read(max(1, self.in_waiting))
+            if not len(data):
+                return b''
+            self.framer.feed(data)
         
 
 #polyfill for python < 3.8
@@ -215,7 +638,7 @@ def getT(msb, lsb, kind = 'SURF'):
 def deviceType(addr):
     if addr == 0x60:
         return 'TURF'
-    elif addr in (0x40,0x48,0x50,0x50):
+    elif addr in (0x40,0x48,0x50,0x58):
         return 'TURFIO'
     elif addr >= 0x80:
         return 'SURF'
@@ -225,6 +648,13 @@ def surfNum(addr):
     return addr - 128
 
 def turfioNum(addr):
-    return (addr-64) >> 
+    return (addr-64) >> 3
+
+def boardNum(addr):
+    kind = deviceType(addr)
+    if kind == 'SURF':
+        return surfNum(addr)
+    elif kind == 'TURFIO':
+        return turfioNum(addr)
 
 
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# Loopback housekeeping simulator, for exercising HskSerial, HskEthernet
+# and PacketParser (and benchmarking sweeps/retry policies) without a
+# crate.
+#
+# sim = HskSimulator(crateAddresses('V', 'R'), latency=0.002, jitter=0.001, loss=0.01)
+# with sim.serial() as port:
+#     hsk = HskSerial(port.path)
+#     print(hsk.request(0x40, 'eTemps').pretty())
+#
+# with sim.ethernet('127.0.0.1') as ep:
+#     hsk = HskEthernet(localIp='127.0.0.1', remoteIp='127.0.0.1')
+#     print(hsk.request(0x40, 'eTemps').pretty())
+#
+# The serial side is a pty (so HskSerial/PacketParser just open
+# port.path), the Ethernet side a UDP socket on the TURFIO housekeeping
+# port. Either way every board in the simulator answers for itself, with
+# latency + uniform(0, jitter) seconds of delay. loss is the chance a
+# request goes unanswered, corrupt the chance a reply has a byte flipped
+# (so it fails its checksum). sim.counts says how much of each happened.
+#
+# Standalone:
+# python3 HskSimulator.py --crate VR --latency 0.002 --loss 0.01
+# python3 HskSimulator.py --crate HL --udp 127.0.0.1
+import heapq
+import os
+import random
+import select
+import socket
+import threading
+import time
+import tty
+
+from cobs import cobs
+from HskSerial import HskPacket, HskEthernet, HskFramer, deviceType, boardNum
+import HskSchema
+
+# plausible readings, in real units. anything not here is a temperature.
+NOMINAL = { 'Vin' : 12.0,
+            'V0P85' : 0.85,
+            'V1P8' : 1.8,
+            'PS_MGTRAVTT' : 1.8,
+            'PS_MGTRAVCC' : 0.85,
+            'MGTAVTT' : 1.2,
+            'DDR_1V2' : 1.2 }
+for i in range(1, 8):
+    NOMINAL['SURF%d_Vin' % i] = 12.0
+    NOMINAL['SURF%d_Vout' % i] = 11.9
+NOMINAL_T = 45.0
+
+def crateAddresses(crate, rack):
+    """ The TURFIO and SURF addresses PacketParser uses for crate ('H'/'V') and rack ('L'/'R'). """
+    import packet_parser as pp
+    if crate == 'H':
+        return [pp.turfioHR] + pp.surfsHR if rack == 'R' else [pp.turfioHL] + pp.surfsHL
+    return [pp.turfioVR] + pp.surfsVR if rack == 'R' else [pp.turfioVL] + pp.surfsVL
+
+class HskSimBoard:
+    """ One simulated board: works out the reply payload for each command. """
+    def __init__(self, addr, values=None, noise=0.01, version=1, restartTime=0.0, rng=None):
+        """ values overrides the NOMINAL readings (by schema field name), noise is the
+            relative jitter on each reading. After eRestart/eReloadFirmware the
+            board goes quiet for restartTime seconds. """
+        self.addr = addr
+        self.kind = deviceType(addr)
+        self.n = boardNum(addr)
+        self.values = dict(values) if values is not None else {}
+        self.noise = noise
+        self.version = version
+        self.restartTime = restartTime
+        self.rng = rng if rng is not None else random.Random()
+        self.downUntil = 0
+        # when the last reply went out
+        self.busyUntil = 0
+        n = self.n if self.n is not None else 0
+        self.identity = [ b'%16.16x' % (0x400000000000 + addr),
+                          b'00:0a:35:00:%2.2x:%2.2x' % (addr, n),
+                          b'2022.2',
+                          b'0.%d.0' % version,
+                          b'%7.7x' % (0xabc0000 + addr),
+                          b'2025-01-01' ]
+
+    def reading(self, field):
+        v = self.values.get(field, NOMINAL.get(field, NOMINAL_T))
+        return v*(1 + self.rng.uniform(-self.noise, self.noise))
+
+    def _readings(self, cmd):
+        schema = HskSchema.lookup(cmd, self.kind)
+        if schema is None:
+            return b''
+        return schema.encode([ self.reading(f) for f in schema.fieldNames ])
+
+    def _identify(self):
+        if self.kind == 'SURF':
+            return b'\x00'.join(self.identity)
+        return bytes([self.version, 0])
+
+    def respond(self, cmd, data):
+        """ Reply payload for cmd (a number) carrying data, or None if the board doesn't answer. """
+        now = time.monotonic()
+        if now < self.downUntil:
+            return None
+        name = HskPacket.strings.get(cmd)
+        if name == 'ePingPong':
+            return data
+        if name in ('eTemps', 'eVolts'):
+            return self._readings(name)
+        if name == 'eIdentify':
+            return self._identify()
+        if name in ('eRestart', 'eReloadFirmware'):
+            self.downUntil = now + self.restartTime
+        # everything else just gets acked
+        return b''
+
+class HskSimulator:
+    """ A set of simulated boards plus the latency/loss/corruption to inject. """
+    def __init__(self, boards, latency=0.0, jitter=0.0, loss=0.0, corrupt=0.0, seed=None):
+        """ boards is a list of addresses and/or HskSimBoards. """
+        self.rng = random.Random(seed)
+        self.boards = {}
+        for b in boards:
+            if not isinstance(b, HskSimBoard):
+                b = HskSimBoard(b, rng=self.rng)
+            self.boards[b.addr] = b
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.corrupt = corrupt
+        self.lock = threading.Lock()
+        self.counts = { 'requests' : 0, 'replies' : 0, 'lost' : 0,
+                        'corrupted' : 0, 'ignored' : 0 }
+
+    def handle(self, rx):
+        """ Takes a request frame (COBS decoded). Returns (time.monotonic() to send at, encoded reply) or None. """
+        with self.lock:
+            self.counts['requests'] += 1
+            try:
+                pkt = HskPacket.fromFrame(rx)
+            except IOError:
+                self.counts['ignored'] += 1
+                return None
+            board = self.boards.get(pkt.dest)
+            data = board.respond(pkt.cmd, pkt.data) if board is not None else None
+            if data is None:
+                self.counts['ignored'] += 1
+                return None
+            if self.loss and self.rng.random() < self.loss:
+                self.counts['lost'] += 1
+                return None
+            tx = HskPacket(pkt.src, pkt.cmd, data=data, src=pkt.dest).frame()
+            if self.corrupt and self.rng.random() < self.corrupt:
+                # the data or the checksum: the header isn't checksummed (a flipped
+                # length byte would sail through), and this way it still gets routed back
+                tx[self.rng.randrange(4, len(tx))] ^= 1 << self.rng.randrange(8)
+                self.counts['corrupted'] += 1
+            self.counts['replies'] += 1
+            # a board answers one thing at a time, so its replies stay in order
+            now = time.monotonic()
+            when = max(now + self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0),
+                       board.busyUntil)
+            board.busyUntil = when
+        return when, cobs.encode(bytes(tx)) + b'\x00'
+
+    def serial(self):
+        """ Start answering on a new pty. Returns the HskSimSerial (port.path is the tty to open). """
+        return HskSimSerial(self)
+
+    def ethernet(self, ip='127.0.0.1', port=HskEthernet.TH_PORT):
+        """ Start answering on a UDP socket. Returns the HskSimEthernet. """
+        return HskSimEthernet(self, ip, port)
+
+class HskSimEndpoint:
+    """ Common bits: a thread reading requests and a thread sending delayed replies. """
+    def __init__(self, sim):
+        self.sim = sim
+        self.running = True
+        self.cond = threading.Condition()
+        # heap of (when, seq, reply, peer)
+        self.queue = []
+        self.seq = 0
+        self.reader = threading.Thread(target=self._readLoop, daemon=True)
+        self.writer = threading.Thread(target=self._writeLoop, daemon=True)
+        self.reader.start()
+        self.writer.start()
+
+    def _handle(self, rx, peer=None):
+        r = self.sim.handle(rx)
+        if r is None:
+            return
+        when, tx = r
+        with self.cond:
+            heapq.heappush(self.queue, (when, self.seq, tx, peer))
+            self.seq += 1
+            self.cond.notify()
+
+    def _writeLoop(self):
+        with self.cond:
+            while self.running:
+                if not self.queue:
+                    self.cond.wait()
+                    continue
+                wait = self.queue[0][0] - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                _, _, tx, peer = heapq.heappop(self.queue)
+                try:
+                    self._write(tx, peer)
+                except OSError:
+                    pass
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.reader.join()
+        self.writer.join()
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+class HskSimSerial(HskSimEndpoint):
+    """ Simulator on a pty: open .path with HskSerial. """
+    def __init__(self, sim):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.framer = HskFramer()
+        HskSimEndpoint.__init__(self, sim)
+
+    def _readLoop(self):
+        while self.running:
+            r, _, _ = select.select([self.master], [], [], 0.1)
+            if not r:
+                continue
+            try:
+                self.framer.feed(os.read(self.master, 4096))
+            except OSError:
+                return
+            while True:
+                try:
+                    rx = self.framer.nextFrame()
+                except cobs.DecodeError:
+                    continue
+                if rx is None:
+                    break
+                self._handle(bytes(rx))
+
+    def _write(self, tx, peer):
+        os.write(self.master, tx)
+
+    def _close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+class HskSimEthernet(HskSimEndpoint):
+    """ Simulator on a UDP socket, replying to whoever asked. """
+    def __init__(self, sim, ip='127.0.0.1', port=HskEthernet.TH_PORT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((ip, port))
+        self.sock.settimeout(0.1)
+        self.address = self.sock.getsockname()
+        HskSimEndpoint.__init__(self, sim)
+
+    def _readLoop(self):
+        while self.running:
+            try:
+                data, peer = self.sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                rx = cobs.decode(data.strip(b'\x00'))
+            except cobs.DecodeError:
+                continue
+            self._handle(rx, peer)
+
+    def _write(self, tx, peer):
+        self.sock.sendto(tx, peer)
+
+    def _close(self):
+        self.sock.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulate a crate's housekeeping on a pty or UDP socket")
+    parser.add_argument("--crate", default="VR", help="crate and rack, e.g. HL, HR, VL, VR (default VR)")
+    parser.add_argument("--udp", metavar="IP", help="listen on UDP at IP instead of a pty")
+    parser.add_argument("--port", type=int, default=HskEthernet.TH_PORT, help="UDP port")
+    parser.add_argument("--latency", type=float, default=0.0, help="reply latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this (s)")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of requests not answered")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="fraction of replies corrupted")
+    parser.add_argument("--seed", type=int, help="random seed")
+    args = parser.parse_args()
+
+    sim = HskSimulator(crateAddresses(args.crate[0], args.crate[1:2]),
+                       latency=args.latency, jitter=args.jitter,
+                       loss=args.loss, corrupt=args.corrupt, seed=args.seed)
+    ep = sim.ethernet(args.udp, args.port) if args.udp else sim.serial()
+    print("simulating %s on %s" % (' '.join('%2.2x' % a for a in sim.boards),
+                                   "%s:%d" % ep.address if args.udp else ep.path))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    ep.stop()
+    print(sim.counts)
@@ -0,0 +1,161 @@
+# Link statistics for housekeeping traffic.
+#
+# Every link has a HskLinkStats (hsk.stats) counting, per
+# (board, command): packets and bytes each way, timeouts, checksum
+# failures and round-trip times (as a log-bucketed histogram, so
+# p50/p99 are cheap). COBS framing errors can't be pinned on a board,
+# so they're counted for the link as a whole.
+#
+# print(hsk.stats.dump())
+# print(hsk.stats.get(0x80, 'eTemps').rtt.quantile(0.99))
+import json
+import math
+import threading
+
+class HskHistogram:
+    """ Log-bucketed histogram (4 buckets per octave) of positive values, e.g. latencies in seconds. """
+    PER_OCTAVE = 4
+    # 1 us to ~ 1000 s
+    LOW = 1e-6
+    NBUCKETS = 4*30
+
+    def __init__(self):
+        self.buckets = [0]*self.NBUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, v):
+        if v <= self.LOW:
+            b = 0
+        else:
+            b = min(self.NBUCKETS-1, int(math.log2(v/self.LOW)*self.PER_OCTAVE))
+        self.buckets[b] += 1
+        self.count += 1
+        self.sum += v
+        self.min = v if self.min is None else min(self.min, v)
+        self.max = v if self.max is None else max(self.max, v)
+
+    def quantile(self, q):
+        """ Approximate q'th quantile (upper edge of the bucket it lands in), or None if empty. """
+        if not self.count:
+            return None
+        target = q*self.count
+        seen = 0
+        for b, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(self.max, self.LOW*2**((b+1)/self.PER_OCTAVE))
+        return self.max
+
+    def summary(self):
+        return { 'count' : self.count,
+                 'mean' : self.sum/self.count if self.count else None,
+                 'min' : self.min,
+                 'max' : self.max,
+                 'p50' : self.quantile(0.5),
+                 'p99' : self.quantile(0.99) }
+
+class HskCounters:
+    """ Counters for one (board, command). """
+    fields = ( 'sent', 'received', 'bytesSent', 'bytesReceived',
+               'timeouts', 'checksumErrors' )
+
+    def __init__(self):
+        for f in self.fields:
+            setattr(self, f, 0)
+        self.rtt = HskHistogram()
+
+    def summary(self):
+        d = { f : getattr(self, f) for f in self.fields }
+        d['rtt'] = self.rtt.summary()
+        return d
+
+class HskLinkStats:
+    """ Per-(board, command) counters and RTT histograms for a link. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        # link-wide, since we can't tell who sent garbage
+        self.decodeErrors = 0
+        self.shortFrames = 0
+        self.bytesReceived = 0
+
+    def _get(self, addr, cmd):
+        key = (addr, cmd)
+        c = self.counters.get(key)
+        if c is None:
+            c = HskCounters()
+            self.counters[key] = c
+        return c
+
+    def get(self, addr, cmd):
+        """ Counters for (addr, cmd). cmd can be a name. """
+        if isinstance(cmd, str):
+            from HskSerial import HskPacket
+            cmd = HskPacket.cmds[cmd]
+        with self.lock:
+            return self._get(addr, cmd)
+
+    # hooks the links call
+    def sent(self, frame, nbytes):
+        with self.lock:
+            c = self._get(frame[1], frame[2])
+            c.sent += 1
+            c.bytesSent += nbytes
+
+    def received(self, frame, nbytes):
+        with self.lock:
+            self.bytesReceived += nbytes
+            if len(frame) < 5:
+                self.shortFrames += 1
+                return
+            c = self._get(frame[0], frame[2])
+            c.bytesReceived += nbytes
+            if sum(frame[4:]) & 0xFF:
+                c.checksumErrors += 1
+            else:
+                c.received += 1
+
+    def decodeError(self, nbytes=0):
+        with self.lock:
+            self.decodeErrors += 1
+            self.bytesReceived += nbytes
+
+    def timeout(self, addr, cmd):
+        with self.lock:
+            self._get(addr, cmd).timeouts += 1
+
+    def rtt(self, addr, cmd, seconds):
+        with self.lock:
+            self._get(addr, cmd).rtt.record(seconds)
+
+    # user stuff
+    def snapshot(self):
+        """ Returns everything as a dict, keyed by 'addr/command'. """
+        # HskSerial imports us, so look this up late
+        from HskSerial import HskPacket
+        with self.lock:
+            boards = {}
+            for (addr, cmd), c in sorted(self.counters.items()):
+                key = "%2.2x/%s" % (addr, HskPacket.strings.get(cmd, "%2.2x" % cmd))
+                boards[key] = c.summary()
+            return { 'decodeErrors' : self.decodeErrors,
+                     'shortFrames' : self.shortFrames,
+                     'bytesReceived' : self.bytesReceived,
+                     'boards' : boards }
+
+    def dump(self, fp=None, indent=1):
+        """ Dump a snapshot as JSON, to fp if given, otherwise returned as a string. """
+        if fp is not None:
+            json.dump(self.snapshot(), fp, indent=indent)
+        else:
+            return json.dumps(self.snapshot(), indent=indent)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.decodeErrors = 0
+            self.shortFrames = 0
+            self.bytesReceived = 0
@@ -0,0 +1,225 @@
+# Background reader mode for HskSerial/HskEthernet.
+#
+# Normally send()/receive() are lock-step, so anything unexpected on the
+# link (an unsolicited packet, a late reply to a request that already
+# timed out) gets handed to whoever calls receive() next. HskReader
+# instead runs a reader thread that sorts incoming packets by
+# (src, cmd) into futures, so you can have lots of requests outstanding
+# at once:
+#
+# hsk = HskSerial('/dev/ttyUSB1')
+# with HskReader(hsk) as rdr:
+#     futs = { a : rdr.request(a, 'eTemps', timeout=0.5) for a in surfs }
+#     for a, f in futs.items():
+#         try:
+#             print(f.result().pretty())
+#         except TimeoutError:
+#             print("%2.2x didn't answer" % a)
+#
+# Don't call hsk.receive() yourself while a reader is running.
+from concurrent.futures import Future
+from collections import deque
+import heapq
+import queue
+import socket
+import threading
+import time
+
+from serial.threaded import ReaderThread, Protocol
+from cobs import cobs
+from HskSerial import HskSerial, HskEthernet, HskPacket, HskFramer
+
+class HskDemux:
+    """ Matches incoming packets to outstanding requests by (src, cmd). """
+    def __init__(self):
+        self.lock = threading.Condition()
+        # (src, cmd) -> deque of futures, oldest first
+        self.pending = {}
+        # heap of (deadline, seq, key, future)
+        self.deadlines = []
+        self.seq = 0
+        self.alive = True
+        # anything nobody asked for ends up here
+        self.unsolicited = queue.Queue()
+        self.expiry = threading.Thread(target=self._expire, daemon=True)
+        self.expiry.start()
+
+    def expect(self, src, cmd, timeout=None):
+        """ Returns a Future which completes with the next packet from src with command cmd. """
+        fut = Future()
+        fut.set_running_or_notify_cancel()
+        key = (src, cmd)
+        with self.lock:
+            if not self.alive:
+                raise RuntimeError("reader is not running")
+            self.pending.setdefault(key, deque()).append(fut)
+            if timeout is not None:
+                heapq.heappush(self.deadlines,
+                               (time.monotonic()+timeout, self.seq, key, fut))
+                self.seq += 1
+                self.lock.notify()
+        return fut
+
+    def dispatch(self, pkt):
+        """ Hand a received packet to the oldest request waiting on it. """
+        key = (pkt.src, pkt.cmd)
+        with self.lock:
+            waiting = self.pending.get(key)
+            fut = waiting.popleft() if waiting else None
+            if waiting is not None and not waiting:
+                del self.pending[key]
+        if fut is None:
+            self.unsolicited.put(pkt)
+        else:
+            fut.set_result(pkt)
+
+    def fail(self, exc):
+        """ Fail every outstanding request (the link went away). """
+        with self.lock:
+            self.alive = False
+            waiting = [ f for d in self.pending.values() for f in d ]
+            self.pending = {}
+            self.deadlines = []
+            self.lock.notify()
+        for fut in waiting:
+            fut.set_exception(exc)
+
+    def _forget(self, key, fut):
+        waiting = self.pending.get(key)
+        if waiting is None or fut not in waiting:
+            return False
+        waiting.remove(fut)
+        if not waiting:
+            del self.pending[key]
+        return True
+
+    def _expire(self):
+        with self.lock:
+            while self.alive:
+                if not self.deadlines:
+                    self.lock.wait()
+                    continue
+                remaining = self.deadlines[0][0] - time.monotonic()
+                if remaining > 0:
+                    self.lock.wait(remaining)
+                    continue
+                _, _, key, fut = heapq.heappop(self.deadlines)
+                # pull it out so a late reply goes to unsolicited instead
+                if self._forget(key, fut):
+                    fut.set_exception(TimeoutError("no reply from %2.2x to %s" %
+                                                   (key[0], HskPacket.strings.get(key[1], key[1]))))
+
+class HskSerialProtocol(Protocol):
+    """ serial.threaded Protocol which frames/decodes housekeeping packets into a HskDemux. """
+    def __init__(self, demux, link):
+        self.demux = demux
+        self.link = link
+        self.framer = HskFramer()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.framer.feed(data)
+        frames = self.framer.frames()
+        while True:
+            try:
+                rx = next(frames, None)
+            except cobs.DecodeError:
+                self.link.stats.decodeError()
+                frames = self.framer.frames()
+                continue
+            if rx is None:
+                break
+            self.link.stats.received(rx, len(rx)+2)
+            if self.link.taps:
+                self.link._tap(self.link.RX, rx)
+            try:
+                pkt = HskPacket.fromFrame(rx)
+            except IOError:
+                continue
+            self.demux.dispatch(pkt)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.demux.fail(exc if exc is not None else IOError("reader stopped"))
+
+class HskReader:
+    """ Runs a background reader on a HskSerial or HskEthernet and correlates replies to requests. """
+    def __init__(self, link):
+        self.link = link
+        self.demux = HskDemux()
+        self.unsolicited = self.demux.unsolicited
+        self.sendLock = threading.Lock()
+        self.alive = True
+        if isinstance(link, HskSerial):
+            self.thread = ReaderThread(link, lambda : HskSerialProtocol(self.demux, link))
+            self.thread.start()
+            self.thread.connect()
+        elif isinstance(link, HskEthernet):
+            # short timeout just so the thread notices stop()
+            link.hs.settimeout(0.25)
+            self.thread = threading.Thread(target=self._udpLoop, daemon=True)
+            self.thread.start()
+        else:
+            raise TypeError("link must be HskSerial or HskEthernet")
+
+    def _udpLoop(self):
+        exc = None
+        while self.alive:
+            try:
+                data = self.link.hs.recv(1024)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                exc = e
+                break
+            try:
+                rx = cobs.decode(data.strip(b'\x00'))
+            except cobs.DecodeError:
+                self.link.stats.decodeError(len(data))
+                continue
+            self.link.stats.received(rx, len(data))
+            if self.link.taps:
+                self.link._tap(self.link.RX, rx)
+            try:
+                pkt = HskPacket.fromFrame(rx)
+            except IOError:
+                continue
+            self.demux.dispatch(pkt)
+        self.demux.fail(exc if exc is not None else IOError("reader stopped"))
+
+    def request(self, dest, cmd, data=None, timeout=None):
+        """ Send cmd to dest, returning a Future for the reply. The Future raises TimeoutError after timeout seconds. """
+        pkt = dest if isinstance(dest, HskPacket) else HskPacket(dest, cmd, data=data)
+        # register before sending so a fast reply can't beat us
+        fut = self.demux.expect(pkt.dest, pkt.cmd, timeout=timeout)
+        start = time.monotonic()
+        fut.add_done_callback(lambda f : self._done(f, pkt, start))
+        with self.sendLock:
+            self.link.send(pkt)
+        return fut
+
+    def _done(self, fut, pkt, start):
+        if isinstance(fut.exception(), TimeoutError):
+            self.link.stats.timeout(pkt.dest, pkt.cmd)
+        elif fut.exception() is None:
+            self.link.stats.rtt(pkt.dest, pkt.cmd, time.monotonic() - start)
+
+    def stop(self):
+        """ Stop the reader thread. The link stays open and goes back to lock-step use. """
+        if not self.alive:
+            return
+        self.alive = False
+        if isinstance(self.thread, ReaderThread):
+            self.thread.stop()
+        else:
+            self.thread.join()
+        self.link._timeoutImpl(self.link.defaultTimeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,156 @@
+# Continuous crate watch: polls boards forever, remembers the last value
+# of every channel and only reports what changed (by more than a
+# deadband), what went out of limits and who stopped answering.
+#
+# w = HskWatcher(hsk, [0x40] + surfs, interval=10)
+# w.run()
+#
+# Requests are spread evenly over the interval (a board/command every
+# interval/N seconds) rather than fired in a burst, so the serial link
+# sees a steady trickle. If a sweep falls behind by more than an
+# interval it just picks up from now instead of trying to catch up.
+#
+# thresholds and deadband are dicts of channel name pattern (fnmatch
+# style, e.g. 'T_SURF?HS_*') -> (low, high) or deadband, first match
+# wins. Either limit can be None. report gets a HskWatchEvent per
+# change, the default prints them.
+from collections import namedtuple
+from fnmatch import fnmatchcase
+import threading
+import time
+
+from HskSerial import deviceType, boardNum
+import HskSchema
+
+DEFAULT_THRESHOLDS = { 'T_SURF?HS_*' : (None, 75.0),
+                       'T_APU_SURF_*' : (None, 85.0),
+                       'T_RPU_SURF_*' : (None, 85.0),
+                       'T_TURFIO_*' : (None, 85.0),
+                       'V_TURFIO_*' : (11.0, 13.0),
+                       'V_SURF?IN_*' : (11.0, 13.0) }
+
+DEFAULT_DEADBAND = { 'T_*' : 0.5,
+                     'V_*' : 0.05 }
+
+# kind is 'change', 'alarm', 'clear' (back inside limits), 'missing' or 'back'.
+# channel is None for missing/back, which are about (addr, cmd).
+HskWatchEvent = namedtuple('HskWatchEvent', 'time kind addr cmd channel old new limits')
+
+def _match(patterns, channel):
+    for p, v in patterns.items():
+        if fnmatchcase(channel, p):
+            return v
+    return None
+
+def printEvent(ev):
+    """ The default report: one line per event. """
+    t = time.strftime('%H:%M:%S', time.localtime(ev.time))
+    if ev.kind == 'change':
+        print('%s %s: %s -> %.2f' % (t, ev.channel, '-' if ev.old is None else '%.2f' % ev.old, ev.new))
+    elif ev.kind == 'alarm':
+        lo, hi = ev.limits
+        print('%s ALARM %s = %.2f (limits %s..%s)' % (t, ev.channel, ev.new, lo, hi))
+    elif ev.kind == 'clear':
+        print('%s ok    %s = %.2f' % (t, ev.channel, ev.new))
+    elif ev.kind == 'missing':
+        print('%s %2.2x stopped answering %s' % (t, ev.addr, ev.cmd))
+    elif ev.kind == 'back':
+        print('%s %2.2x is answering %s again' % (t, ev.addr, ev.cmd))
+
+class HskWatcher:
+    """ Polls (board, command) pairs on an even schedule and reports changes/threshold violations. """
+    def __init__(self, link, addrs, cmds=('eTemps', 'eVolts'), interval=10.0,
+                 thresholds=None, deadband=None, report=printEvent):
+        self.link = link
+        self.slots = [ (a, c) for a in addrs for c in cmds
+                       if HskSchema.lookup(c, deviceType(a)) is not None ]
+        self.interval = interval
+        self.thresholds = DEFAULT_THRESHOLDS if thresholds is None else thresholds
+        self.deadband = DEFAULT_DEADBAND if deadband is None else deadband
+        self.report = report
+        # channel -> last reported value, and the ones currently out of limits
+        self.last = {}
+        self.alarms = set()
+        self.missing = set()
+        # channel -> (limits, deadband), resolved once
+        self.rules = {}
+        self.stopped = threading.Event()
+
+    def _rule(self, channel):
+        r = self.rules.get(channel)
+        if r is None:
+            r = (_match(self.thresholds, channel), _match(self.deadband, channel) or 0)
+            self.rules[channel] = r
+        return r
+
+    def check(self, addr, cmd, data, now=None):
+        """ Compare a reply payload against what we had. Returns a list of HskWatchEvents. """
+        if now is None:
+            now = time.time()
+        schema = HskSchema.lookup(cmd, deviceType(addr))
+        n = boardNum(addr)
+        raw = schema.raw(data)
+        events = []
+        for c, adc, v in zip(schema.channels, raw, schema.convert(raw)):
+            # a reading of exactly 0 means nothing's there (e.g. an empty slot)
+            if adc == 0:
+                continue
+            channel = c.format(n=n)
+            limits, band = self._rule(channel)
+            old = self.last.get(channel)
+            if old is None or abs(v - old) > band:
+                self.last[channel] = v
+                events.append(HskWatchEvent(now, 'change', addr, cmd, channel, old, v, limits))
+            if limits is not None:
+                lo, hi = limits
+                bad = (lo is not None and v < lo) or (hi is not None and v > hi)
+                if bad and channel not in self.alarms:
+                    self.alarms.add(channel)
+                    events.append(HskWatchEvent(now, 'alarm', addr, cmd, channel, old, v, limits))
+                elif not bad and channel in self.alarms:
+                    self.alarms.discard(channel)
+                    events.append(HskWatchEvent(now, 'clear', addr, cmd, channel, old, v, limits))
+        return events
+
+    def poll(self, addr, cmd):
+        """ Ask one board for one command and check the answer. Returns a list of HskWatchEvents. """
+        try:
+            pkt = self.link.request(addr, cmd)
+        except TimeoutError:
+            if (addr, cmd) in self.missing:
+                return []
+            self.missing.add((addr, cmd))
+            return [ HskWatchEvent(time.time(), 'missing', addr, cmd, None, None, None, None) ]
+        events = []
+        if (addr, cmd) in self.missing:
+            self.missing.discard((addr, cmd))
+            events.append(HskWatchEvent(time.time(), 'back', addr, cmd, None, None, None, None))
+        return events + self.check(addr, cmd, pkt.data)
+
+    def run(self, duration=None, sweeps=None):
+        """ Poll until stop() (or for duration seconds, or sweeps full sweeps). """
+        if not self.slots:
+            return
+        spacing = self.interval/len(self.slots)
+        start = time.monotonic()
+        nextTime = start
+        sweep = 0
+        while not self.stopped.is_set():
+            for addr, cmd in self.slots:
+                wait = nextTime - time.monotonic()
+                if wait > 0 and self.stopped.wait(wait):
+                    return
+                if duration is not None and time.monotonic() - start >= duration:
+                    return
+                for ev in self.poll(addr, cmd):
+                    self.report(ev)
+                nextTime += spacing
+                # way behind (e.g. lots of timeouts): don't try to catch up
+                if time.monotonic() - nextTime > self.interval:
+                    nextTime = time.monotonic()
+            sweep += 1
+            if sweeps is not None and sweep >= sweeps:
+                return
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# microbenchmark: decoding a TURFIO eTemps payload the old way
+# (int.from_bytes slices + per-value conversion) versus a HskSchema.
+#
+# python3 bench_schema.py [iterations]
+import sys
+import timeit
+import HskSchema
+
+# the way tempTURFIO/prettifiers used to do it
+def oldDecode(d):
+    tfio = int.from_bytes(d[0:2], 'big')
+    out = [ ((tfio * 503.975) / 2 ** 12) - 273.15 ]
+    for i in range(2, 16, 2):
+        out.append((int.from_bytes(d[i:i+2], 'big') * 10 - 31880) / 42)
+    return out
+
+schema = HskSchema.lookup('eTemps', 'TURFIO')
+data = bytes([0x0a, 0x10, 0x0d, 0x10, 0x0d, 0x20, 0x0d, 0x30,
+              0x0d, 0x40, 0x0d, 0x50, 0x0d, 0x60, 0x0d, 0x70])
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+# make sure they agree before timing anything
+for a, b in zip(oldDecode(data), schema.decode(data)):
+    assert abs(a - b) < 1e-9, (a, b)
+
+tOld = min(timeit.repeat(lambda : oldDecode(data), number=n, repeat=3))
+tNew = min(timeit.repeat(lambda : schema.decode(data), number=n, repeat=3))
+tRaw = min(timeit.repeat(lambda : schema.raw(data), number=n, repeat=3))
+print("slices + from_bytes : %.3f us/packet" % (tOld/n*1e6))
+print("HskSchema.decode    : %.3f us/packet (%.1fx)" % (tNew/n*1e6, tOld/tNew))
+print("HskSchema.raw       : %.3f us/packet (%.1fx)" % (tRaw/n*1e6, tOld/tRaw))
@@ -1,5 +1,8 @@
 import time 
 from HskSerial import HskSerial, HskPacket
+from HskInventory import HskInventory, parseIdentify
+from HskWatch import HskWatcher
+import HskSchema
 
 # SURFs in Hpol LRACK --> SOCID
 surfsHL = [ 0x97, 0xa0, 0x99, 0x8d, 0x9d, 0x94, 0x8a ]
@@ -23,9 +26,16 @@ turfioVR = 0x40 # Vpol RRACK
 
 class PacketParser: 
 
-    def __init__(self, port, crate, rack): 
+    def __init__(self, port, crate, rack, pipelined = False, timeout = None, inventory = None): 
 
         self.dev = HskSerial(port)
+
+        # pipelined = True fires each command at every board back-to-back
+        # and sorts out the replies by source address as they come in.
+        # timeout is how long each board gets to answer in that mode
+        # (None = adaptive, from the link's rtt estimator).
+        self.pipelined = pipelined
+        self.timeout = timeout
         
         # Set up TURFIO/SURFs in target crate
         if crate == 'H': 
@@ -53,6 +63,17 @@ class PacketParser:
         # Misc. things that are useful
         self.crate = crate
 
+        # eIdentify results can be cached (see HskInventory.py). inventory = True
+        # uses the default file, or pass an HskInventory. None always asks the boards.
+        if inventory is True: 
+            inventory = HskInventory()
+        self.inventory = inventory
+        if self.inventory: 
+            self.dev.addTap(self.inventory)
+            self.inventory.locate(self.TF, '{}{} TURFIO'.format(crate, rack))
+            for iter in range(0, self.endVal): 
+                self.inventory.locate(self.SF[iter], '{}{} slot {}'.format(crate, rack, iter))
+
         # Updated SQFS version
         self.sqfsCurrent = b'0.2.9'
 
@@ -80,9 +101,18 @@ class PacketParser:
         tfIdentify()
 
 
+        status()
+        Identify, temperatures and voltages for every board in one batch
+
+        watch()
+        Keeps polling temperatures/voltages, printing only changes and anything out of limits
+
         sqfsAllUpdated()
         Returns information on if all the SURFs have successfully updated to the most recent version of SQFS
 
+        With inventory = True the eIdentify-based methods answer from the inventory cache
+        where they can, pass force = True to ask the boards again (sqfsAllUpdated always does by default)
+
         If you have any questions, email coakley.64@osu.edu
         """
         print(helpText)
@@ -90,11 +120,93 @@ class PacketParser:
     
     def packetsend(self, addr, cmd): 
         """Sends packets and receives response. Returns received packet"""
-        self.dev.send(HskPacket(addr, cmd))
-        pkt = self.dev.receive()
+        pkt = self.dev.request(addr, cmd)
         return pkt.data
 
+    def pollsend(self, addrs, cmd): 
+        """Sends cmd to every address in addrs. Returns dict of address -> received data (None if no answer)"""
+        if self.pipelined: 
+            replies = self.dev.poll(addrs, cmd, timeout = self.timeout)
+            return { addr : (pkt.data if pkt is not None else None) for addr, pkt in replies.items() }
+
+        replies = {}
+        for addr in addrs: 
+            try: 
+                replies[addr] = self.packetsend(addr, cmd)
+            except: 
+                replies[addr] = None
+        return replies
+
+    def transact(self, addrs, cmds): 
+        """Sends every cmd in cmds to every address in addrs. Returns dict of address -> dict of cmd -> received data (None if no answer)"""
+        if self.pipelined: 
+            tr = self.dev.transaction()
+            pos = { (addr, cmd) : tr.add(addr, cmd) for addr in addrs for cmd in cmds }
+            replies = tr.run(timeout = self.timeout)
+            return { addr : { cmd : (replies[pos[(addr, cmd)]].data if replies[pos[(addr, cmd)]] is not None else None)
+                              for cmd in cmds } for addr in addrs }
+
+        return { addr : { cmd : data for cmd, data in zip(cmds, self.transactOne(addr, cmds)) } for addr in addrs }
+
+    def transactOne(self, addr, cmds): 
+        out = []
+        for cmd in cmds: 
+            try: 
+                out.append(self.packetsend(addr, cmd))
+            except: 
+                out.append(None)
+        return out
+
+    def status(self): 
+        """Identify, temperatures and voltages for every board, in one go"""
+        cmds = [ 'eIdentify', 'eTemps', 'eVolts' ]
+        replies = self.transact([self.TF] + self.SF[0:self.endVal], cmds)
+
+        tf = replies[self.TF]
+        print("")
+        if tf['eTemps'] is None or tf['eVolts'] is None: 
+            print('TURFIO did not respond')
+            return
+        tftemp = self.tempTURFIO(tf['eTemps'])
+        voltsTF = HskSchema.lookup('eVolts', 'TURFIO').decode(tf['eVolts'])
+        if tf['eIdentify'] is not None: 
+            print('TURFIO HSK: v{}'.format(tf['eIdentify'][0]))
+        print('TURFIO: {}C, Vin: {}V'.format(format(tftemp[0], '.2f'), self.rounding(voltsTF.Vin)))
+
+        sfVolts = HskSchema.lookup('eVolts', 'SURF')
+        for iter in range(0, self.endVal): 
+            sf = replies[self.SF[iter]]
+            print("")
+            print('SURF {}'.format(self.surfID(iter)))
+            print('Hotswap: {}C, Vin: {}V, Vout: {}V'.format(tftemp[iter+1], 
+                                                             self.rounding(voltsTF[1+2*iter]), 
+                                                             self.rounding(voltsTF[2+2*iter])))
+            if sf['eIdentify'] is not None: 
+                print('PUEO SQFS Version: ', sf['eIdentify'].split(b'\x00')[3].decode("utf-8"))
+            else: 
+                print('No response to eIdentify')
+            if sf['eTemps'] is not None: 
+                rpuTemp, apuTemp = self.tempSURF(sf['eTemps'], self.SF[iter])
+                print('RPU: {}C, APU: {}C'.format(self.rounding(rpuTemp), self.rounding(apuTemp)))
+            else: 
+                print('No response to eTemps')
+            if sf['eVolts'] is not None: 
+                v = sfVolts.decode(sf['eVolts'])
+                print('0.85V: {}V, 1.8V: {}V, DDR_1V2: {}V'.format(self.rounding(v.V0P85), 
+                                                                   self.rounding(v.V1P8), 
+                                                                   self.rounding(v.DDR_1V2)))
+            else: 
+                print('No response to eVolts')
+
     
+    def identify(self, addrs, force = False): 
+        """Returns dict of address -> eIdentify info (see HskInventory.parseIdentify, None if no answer). Only stale boards get asked"""
+        query = lambda a : self.pollsend(a, 'eIdentify')
+        if not self.inventory: 
+            return { addr : (parseIdentify(addr, data) if data is not None else None) 
+                     for addr, data in query(addrs).items() }
+        return self.inventory.refresh(query, addrs, force = force)
+
     def surfID(self, num): 
         """Returns the SURF SOCID (matches whats on crate)"""
         return self.hextodec(self.SF[num])
@@ -103,57 +215,62 @@ class PacketParser:
         """Returns which TURFIOs/SURFs are online and responsive"""
 
         cmd = 'ePingPong'
+        replies = self.pollsend([self.TF] + self.SF[0:self.endVal], cmd)
         
-        try:
-            self.packetsend(self.TF, cmd)
+        if replies[self.TF] is not None:
             print('TURFIO says hi back!')
-        except: 
+        else: 
             print('TURFIO ignored you :(')
         
       
         for iter in range(0, self.endVal):
             print("")
-            try: 
-                self.packetsend(self.SF[iter], cmd)
+            if replies[self.SF[iter]] is not None: 
                 print('SURF {} says hi back!'.format(self.surfID(iter)))
                 
-            except: 
+            else: 
                 print('SURF {} ignored you :('.format(self.surfID(iter)))
 
 
     def tfIdentify(self): 
         """Currently just returns what HSK software version"""
 
-        cmd = 'eIdentify'
-        recpkt = self.packetsend(self.TF, cmd)
-        vSoftware = int.from_bytes(recpkt[0:1])
-        bitSF = int.from_bytes(recpkt[1:2])
-        print('TURFIO HSK: v{}'.format(vSoftware))
+        info = self.identify([self.TF])[self.TF]
+        if info is None: 
+            print('TURFIO did not respond to eIdentify')
+            return
+        print('TURFIO HSK: v{}'.format(info['hskVersion']))
         
 
-    def sfIdentify(self): 
-        cmd = 'eIdentify'
+    def sfIdentify(self, force = False): 
+        infos = self.identify(self.SF[0:self.endVal], force = force)
         for iter in range(0, self.endVal): 
-            recpkt = (self.packetsend(self.SF[iter], cmd)) 
-            splitvals = recpkt.split(b'\x00')
-            
+            info = infos[self.SF[iter]]
             print("SURF ", self.surfID(iter))
-            print('PS ID: ', splitvals[0].decode("utf-8"))
-            print('MAC Addr: ', splitvals[1].decode("utf-8"))
-            print('Petalinux Version: ', splitvals[2].decode("utf-8"))
-            print('PUEO SQFS Version: ', splitvals[3].decode("utf-8"))
-            print('Git Short Hash PUEO SQFS: ', splitvals[4].decode("utf-8"))
-            print('PUEO SQFS Build Date: ', splitvals[5].decode("utf-8"))
+            if info is None: 
+                print('No response')
+                print("")
+                continue
+            
+            print('PS ID: ', info['dna'])
+            print('MAC Addr: ', info['mac'])
+            print('Petalinux Version: ', info['petalinux'])
+            print('PUEO SQFS Version: ', info['sqfsVersion'])
+            print('Git Short Hash PUEO SQFS: ', info['sqfsHash'])
+            print('PUEO SQFS Build Date: ', info['sqfsDate'])
             print("")
 
-    def sqfsAllUpdated(self): 
-        cmd = 'eIdentify'
+    def sqfsAllUpdated(self, force = True): 
         good = 0
+        infos = self.identify(self.SF[0:self.endVal], force = force)
         for iter in range(0, self.endVal): 
-            recpkt = (self.packetsend(self.SF[iter], cmd)) 
-            splitvals = recpkt.split(b'\x00')
+            info = infos[self.SF[iter]]
+            if info is None: 
+                print("")
+                print('SURF {} did not respond'.format(self.SF[iter]))
+                continue
             
-            if splitvals[3] == self.sqfsCurrent: 
+            if info['sqfsVersion'] == self.sqfsCurrent.decode('utf-8'): 
                 good += 1
                 continue
             else: 
@@ -167,27 +284,33 @@ class PacketParser:
             print("") 
 
         
-    def softwareVersion(self, surf = True, turfio = True):
-        cmd = 'eIdentify'
+    def softwareVersion(self, surf = True, turfio = True, force = False):
         
         print('Software Version')
         print("")
 
+        addrs = ([self.TF] if turfio else []) + (self.SF[0:self.endVal] if surf else [])
+        infos = self.identify(addrs, force = force)
+
         if turfio == True:
-            pkttf = self.packetsend(self.TF, cmd)
-            vSoftware = int.from_bytes(pkttf[0:1])
-            print('TURFIO housekeeping: v{}'.format(vSoftware))
+            info = infos[self.TF]
+            if info is None: 
+                print('TURFIO did not respond to eIdentify')
+            else: 
+                print('TURFIO housekeeping: v{}'.format(info['hskVersion']))
             
 
         if surf == True: 
             for iter in range(0, self.endVal): 
-                recpkt = (self.packetsend(self.SF[iter], cmd)) 
-                splitvals = recpkt.split(b'\x00')
+                info = infos[self.SF[iter]]
                 print("")
                 print("SURF ", self.surfID(iter))
+                if info is None: 
+                    print('No response')
+                    continue
                 
-                print('Petalinux Version: ', splitvals[2].decode("utf-8"))
-                print('PUEO SQFS Version: ', splitvals[3].decode("utf-8"))
+                print('Petalinux Version: ', info['petalinux'])
+                print('PUEO SQFS Version: ', info['sqfsVersion'])
                 
                 print("")
              
@@ -200,7 +323,11 @@ class PacketParser:
         """Returns the TURFIO die temperature, as well as the SURF hotswap and die temperatures """
 
         print("")
-        pkttf = self.packetsend(self.TF, 'eTemps')
+        replies = self.pollsend([self.TF] + self.SF[0:self.endVal], 'eTemps')
+        pkttf = replies[self.TF]
+        if pkttf is None: 
+            print('TURFIO did not respond to eTemps')
+            return
         tftemp = self.tempTURFIO(pkttf) # just in case
 
 
@@ -208,7 +335,11 @@ class PacketParser:
         apuTemps = []
         for iter in range(0, self.endVal):
             
-            pktsf = self.packetsend(self.SF[iter], 'eTemps' )
+            pktsf = replies[self.SF[iter]]
+            if pktsf is None: 
+                rpuTemps.append(float('nan'))
+                apuTemps.append(float('nan'))
+                continue
             rpuTemp, apuTemp = self.tempSURF(pktsf, self.SF[iter])
             rpuTemps.append(rpuTemp)
             apuTemps.append(apuTemp)
@@ -228,97 +359,83 @@ class PacketParser:
 
     def tempTURFIO(self, recpacket, printall = False):
 
-        tfiotemp = int.from_bytes(recpacket[0:2])
-        srftemp = []
-        for iter in range(2,16,2): 
-            srftemp.append(int.from_bytes(recpacket[iter:iter+2]))
+        schema = HskSchema.lookup('eTemps', 'TURFIO')
+        raw = schema.raw(recpacket)
+        temps = schema.convert(raw)
 
-        temparray = []
-        tfiotemp = ((tfiotemp * 503.975) / 2 ** 12) -273.15
-        temparray.append(tfiotemp)
-        
-            
-        for iter in range(len(srftemp)): 
-            if srftemp[iter] != 0: 
-                srftemp[iter] = format((( srftemp[iter] * 10 - 31880) / 42), '.2f')
-                temparray.append(srftemp[iter])
-                
+        temparray = [ temps.T_TURFIO ]
+        # a hotswap reading of exactly 0 means nothing's there
+        for adc, temp in zip(raw[1:], temps[1:]): 
+            if adc != 0: 
+                temparray.append(format(temp, '.2f'))
             else:
                 temparray.append('NaN')
                 
-            
-            if printall == True: 
-                print("{}: {}C".format('TURFIO Slot 0', format(tfiotemp, '.2f')))
-                print("")
-                """for iter in range(len(srftemp)): 
-                    print("SURF Slot {}: {}C".format(iter + 1, temparray[iter]))
-                    print("")"""
+        if printall == True: 
+            print("{}: {}C".format('TURFIO Slot 0', format(temps.T_TURFIO, '.2f')))
+            print("")
                 
         return temparray
     
     def tempSURF(self, recpacket, surfid, printall = False): 
 
-        def SFTempFunc(val): 
-            return (val * 509.3140064) / 2 **16 - 280.23087870
-        
-        decimal_values = []
-        for iter in range(0,4,2): 
-            decimal_values.append(int.from_bytes(recpacket[iter:iter+2]))
-        
-        for iter in range(0,len(decimal_values),2) : 
-            rpuTemp = (SFTempFunc(decimal_values[iter]))
-            apuTemp = (SFTempFunc(decimal_values[iter+1]))
+        temps = HskSchema.lookup('eTemps', 'SURF').decode(recpacket)
+        # this has always reported the first sensor as the RPU,
+        # HskPacket.prettyDict calls it the APU
+        rpuTemp, apuTemp = temps[0], temps[1]
         
         if printall == True: 
-            for iter in range(0, len(decimal_values)): 
-                print('SURF {}'.format(self.hextodec(surfid)))
-                print("RPU: {}C".format(format(rpuTemp[iter], '.2f')))
-                print("APU: {}C".format(format(apuTemp[iter], '.2f')))
+            print('SURF {}'.format(self.hextodec(surfid)))
+            print("RPU: {}C".format(format(rpuTemp, '.2f')))
+            print("APU: {}C".format(format(apuTemp, '.2f')))
                 
         return rpuTemp, apuTemp
 
     
     def getVolts(self):
         
-        def vSFeq(num): 
-            return ((num + 0.5) * 5.104) / 1000
-
         cmd = 'eVolts'
-        pktTF = self.packetsend(self.TF, cmd)
-        voltsTF = int.from_bytes(pktTF[0:2])
-
-        voltsSFin = []
-        voltsSFout = []
-
-        endVal = self.endVal * 4 + 2
-        for iter in range(2,endVal,4): 
-            voltsSFin.append(int.from_bytes(pktTF[iter:iter+2]))
-            voltsSFout.append(int.from_bytes(pktTF[iter+2:iter+4]))
+        replies = self.pollsend([self.TF] + self.SF[0:self.endVal], cmd)
+        pktTF = replies[self.TF]
+        if pktTF is None: 
+            print('TURFIO did not respond to eVolts')
+            return
+        voltsTF = HskSchema.lookup(cmd, 'TURFIO').decode(pktTF)
 
-        voltsTF = (voltsTF * 26.35) / 2 ** 12
         print('')
         print('TURFIO')
-        print('Vin: {}V'.format(format(voltsTF, '.2f')))
+        print('Vin: {}V'.format(format(voltsTF.Vin, '.2f')))
         
-        def vSFRF(num): 
-            return (num / 2 ** 16) * 3
-        
-        for iter in range(len(voltsSFin)): 
-            voltsSFin[iter] = (vSFeq(voltsSFin[iter]))
-            voltsSFout[iter] = (vSFeq(voltsSFout[iter]))
+        sfSchema = HskSchema.lookup(cmd, 'SURF')
+        for iter in range(self.endVal): 
             print('')
             print('SURF {}'.format(self.hextodec(self.SF[iter])))
-            print('Vin: {}V'.format(format(voltsSFin[iter], '.2f')))
-            print('Vout: {}V'.format(format(voltsSFout[iter], '.2f')))
-
-            pktSF = self.packetsend(self.SF[iter], cmd)
+            print('Vin: {}V'.format(format(voltsTF[1+2*iter], '.2f')))
+            print('Vout: {}V'.format(format(voltsTF[2+2*iter], '.2f')))
 
-            print('0.85V: {}V'.format(self.rounding(vSFRF(int.from_bytes(pktSF[0:2])))))
-            print('1.8V: {}V'.format(self.rounding(vSFRF(int.from_bytes(pktSF[2:4])))))
-            print('PS_MGTRAVTT (nominal 1.8V): {}V'.format(format(vSFRF(int.from_bytes(pktSF[4:6])), '.2f')))
-            print('PS_MGTRAVCC (nominal 0.85V): {}V'.format(format(vSFRF(int.from_bytes(pktSF[6:8])), '.2f')))
-            print('MGTAVTT (nominal 1.2V): {}V'.format(format(vSFRF(int.from_bytes(pktSF[8:10])), '.2f')))
-            print('DDR_1V2 (nominal 1.2V): {}V'.format(self.rounding(vSFRF(int.from_bytes(pktSF[10:12])))))
+            pktSF = replies[self.SF[iter]]
+            if pktSF is None: 
+                print('No response')
+                continue
+            voltsSF = sfSchema.decode(pktSF)
+
+            print('0.85V: {}V'.format(self.rounding(voltsSF.V0P85)))
+            print('1.8V: {}V'.format(self.rounding(voltsSF.V1P8)))
+            print('PS_MGTRAVTT (nominal 1.8V): {}V'.format(format(voltsSF.PS_MGTRAVTT, '.2f')))
+            print('PS_MGTRAVCC (nominal 0.85V): {}V'.format(format(voltsSF.PS_MGTRAVCC, '.2f')))
+            print('MGTAVTT (nominal 1.2V): {}V'.format(format(voltsSF.MGTAVTT, '.2f')))
+            print('DDR_1V2 (nominal 1.2V): {}V'.format(self.rounding(voltsSF.DDR_1V2)))
+
+
+    def watch(self, interval = 10, cmds = ('eTemps', 'eVolts'), thresholds = None, deadband = None, duration = None): 
+        """Keeps polling every board, printing only changes, threshold violations and boards going quiet. Ctrl-C to stop"""
+        watcher = HskWatcher(self.dev, [self.TF] + self.SF[0:self.endVal], cmds, interval = interval, 
+                             thresholds = thresholds, deadband = deadband)
+        try: 
+            watcher.run(duration = duration)
+        except KeyboardInterrupt: 
+            pass
+        return watcher
 
         
     # Random utils in case
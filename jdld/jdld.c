@@ -25,6 +25,33 @@
  *   (meaning <size> is less than 1MB)
  *   otherwise it just writes D\n and goes to step Y
  *
+ * since 1.1 the mailbox can be split into N slots of 1M each, one after
+ * the other starting at jtag_mailbox (run jdld N, the default is 1 -
+ * and again, you MUST have all of it reserved). D#<slot>\n and
+ * D#<slot> <size>\n dump from that slot instead of slot 0, so
+ * jdownload can dow the next chunk into one slot while we're still
+ * copying out of another. N\n replies N <slots>.
+ *
+ * since 1.2 every D is answered K <crc32>\n (hex, same CRC as zlib) of
+ * the chunk it wrote, and a transfer can be picked up where it left off:
+ * R<filename>\n opens a file WITHOUT truncating it and replies
+ * K <size>\n, Q <offset> <length>\n replies K <crc32>\n of that range
+ * of the open file, S <offset>\n truncates the open file there and
+ * carries on writing from that point, and F\n just closes the file.
+ *
+ * since 1.3 there's H <blocksize>\n, which replies
+ * K <size> <crc32> <crc32> ...\n with the CRC32 of every blocksize block
+ * of the open file (the last one can be short), and P <offset>\n which
+ * moves the write position WITHOUT truncating, so jdownload can compare
+ * against its own blocks and only send the ones that changed.
+ *
+ * since 1.4 there's Z\n / Z#<slot>\n, which is D for a compressed
+ * chunk: the mailbox holds a 12 byte header ('JDZ1', then the raw and
+ * compressed lengths as little-endian u32s) followed by zlib data.
+ * it's inflated and written out like D <raw length> would, and the
+ * K <crc32> is of the inflated data. this needs zlib, so build with
+ * -lz.
+ *
  * each command from jdld is responded to with K\n if everything's OK,
  * or ?\n if it has no idea what the eff you're talking about (e.g.
  * O when a file's already open). It also responds with V followed by
@@ -46,8 +73,9 @@
 #include <string.h>
 #include <signal.h>
 #include <stdint.h>
+#include <zlib.h>
 
-#define VERSION "1.0"
+#define VERSION "1.4"
 
 // this is here to allow you to shutoff the actual mailbox dump
 // to test out commandy-stuff on a separate computer
@@ -64,9 +92,54 @@ const char *devmem = "/dev/null";
 #endif
 const off_t jtag_mailbox = 0x70000000;
 const ssize_t jtag_mailbox_size = (1<<20);
+#define MAX_SLOTS 16
+// compressed chunk header
+#define ZHDR_MAGIC "JDZ1"
+#define ZHDR_SIZE 12
 
 int stop_requested = 0;
 
+// standard reflected CRC32 (same as zlib's crc32), table-driven
+uint32_t crc_table[256];
+
+void crc32_init()
+{
+  uint32_t c;
+  int n, k;
+  for (n=0;n<256;n++) {
+    c = (uint32_t) n;
+    for (k=0;k<8;k++)
+      c = (c & 1) ? 0xEDB88320 ^ (c >> 1) : (c >> 1);
+    crc_table[n] = c;
+  }
+}
+
+// crc is the running CRC (start with 0)
+uint32_t crc32_update(uint32_t crc, const unsigned char *buf, size_t len)
+{
+  crc = ~crc;
+  while (len--)
+    crc = crc_table[(crc ^ *buf++) & 0xFF] ^ (crc >> 8);
+  return ~crc;
+}
+
+// CRC32 of len bytes of fd starting at off, -1 on read error
+int64_t crc32_file(int fd, off_t off, size_t len)
+{
+  static unsigned char buf[65536];
+  uint32_t crc = 0;
+  ssize_t rb;
+  while (len) {
+    rb = pread(fd, buf, len > sizeof(buf) ? sizeof(buf) : len, off);
+    if (rb <= 0)
+      return -1;
+    crc = crc32_update(crc, buf, rb);
+    off += rb;
+    len -= rb;
+  }
+  return crc;
+}
+
 // signal handler
 // we catch 'em all
 void sig_handler(int signo)
@@ -82,13 +155,16 @@ void sig_handler(int signo)
 
 // jdld obviously needs two fifos, an in and an out
 // jdld-cmd and jdld-rsp
-int main() {
+int main(int argc, char **argv) {
   uint64_t *mbox_vptr;
+  unsigned long nslots = 1;
   char *lbuf = NULL;
   FILE *cmd = NULL;
   FILE *rsp = NULL;
   int memfd = -1;
   int destfd = -1;
+  // inflated compressed chunks go here
+  unsigned char *zbuf = NULL;
   
   ssize_t nb;
   size_t mx = 80;
@@ -102,6 +178,16 @@ int main() {
   sigaction(SIGHUP, &act, NULL);
   sigaction(SIGQUIT, &act, NULL);
   
+  if (argc > 1) {
+    nslots = strtoul(argv[1], NULL, 0);
+    if (nslots < 1 || nslots > MAX_SLOTS) {
+      fprintf(stderr, "jdld: slots must be between 1 and %d\n", MAX_SLOTS);
+      exit(1);
+    }
+  }
+  printf("jdld: using %lu mailbox slot(s) at 0x%lx\n", nslots,
+	 (unsigned long) jtag_mailbox);
+  crc32_init();
   // screw you process umask
   umask(0000);
   // get the line buffer
@@ -110,6 +196,11 @@ int main() {
     perror("jdld: error allocating line buffer\n");
     exit(1);
   }
+  zbuf = (unsigned char *) malloc(jtag_mailbox_size);
+  if (zbuf == NULL) {
+    perror("jdld: error allocating inflate buffer\n");
+    exit(1);
+  }
   // get the inouts
   printf("jdld: creating command fifo at %s\n", command_fifo);
   if (mkfifo(command_fifo, 0666) != 0) {
@@ -154,6 +245,10 @@ int main() {
 	printf("jdld: got version request\n");
 	fprintf(rsp, "V %s\n", VERSION);
       }
+      else if (lbuf[0] == 'N') {
+	printf("jdld: got slot count request\n");
+	fprintf(rsp, "N %lu\n", nslots);
+      }
       else if (lbuf[0] == 'C') {
 	const char *fnp = &lbuf[1];
 	printf("jdld: got create command\n");
@@ -161,32 +256,208 @@ int main() {
 	  // strip the newline, you better not eff this up
 	  lbuf[nb - 1] = 0;
 	  printf("jdld: creating file %s\n", fnp);
-	  destfd = creat(fnp, 0666);
-	  fprintf(rsp, "K\n");
+	  // read/write so Q works
+	  destfd = open(fnp, O_RDWR | O_CREAT | O_TRUNC, 0666);
+	  fprintf(rsp, (destfd == -1) ? "?\n" : "K\n");
 	} else {
 	  printf("jdld: but a file is open??\n");
 	  fprintf(rsp, "?\n");
 	}
       }
+      else if (lbuf[0] == 'R') {
+	const char *fnp = &lbuf[1];
+	printf("jdld: got resume command\n");
+	if (destfd == -1) {
+	  off_t sz;
+	  lbuf[nb - 1] = 0;
+	  printf("jdld: reopening file %s\n", fnp);
+	  destfd = open(fnp, O_RDWR | O_CREAT, 0666);
+	  if (destfd == -1) {
+	    perror("jdld: open error");
+	    fprintf(rsp, "?\n");
+	    continue;
+	  }
+	  sz = lseek(destfd, 0, SEEK_END);
+	  fprintf(rsp, "K %ld\n", (long) sz);
+	} else {
+	  printf("jdld: but a file is open??\n");
+	  fprintf(rsp, "?\n");
+	}
+      }
+      else if (lbuf[0] == 'Q') {
+	char *endp;
+	unsigned long off, len;
+	int64_t crc;
+	printf("jdld: got checksum query\n");
+	off = strtoul(lbuf + 1, &endp, 0);
+	len = strtoul(endp, NULL, 0);
+	if (destfd == -1) {
+	  printf("jdld: but no file is open??\n");
+	  fprintf(rsp, "?\n");
+	  continue;
+	}
+	crc = crc32_file(destfd, off, len);
+	if (crc < 0) {
+	  printf("jdld: can't read %lu bytes at %lu\n", len, off);
+	  fprintf(rsp, "?\n");
+	} else {
+	  fprintf(rsp, "K %8.8lx\n", (unsigned long) crc);
+	}
+      }
+      else if (lbuf[0] == 'S') {
+	unsigned long off;
+	printf("jdld: got seek command\n");
+	off = strtoul(lbuf + 1, NULL, 0);
+	if (destfd == -1) {
+	  printf("jdld: but no file is open??\n");
+	  fprintf(rsp, "?\n");
+	  continue;
+	}
+	if (ftruncate(destfd, off) != 0 || lseek(destfd, off, SEEK_SET) != (off_t) off) {
+	  perror("jdld: seek error");
+	  fprintf(rsp, "?\n");
+	} else {
+	  fprintf(rsp, "K\n");
+	}
+      }
+      else if (lbuf[0] == 'H') {
+	unsigned long bs;
+	off_t sz, off;
+	int64_t crc;
+	printf("jdld: got block hash command\n");
+	bs = strtoul(lbuf + 1, NULL, 0);
+	if (bs == 0)
+	  bs = jtag_mailbox_size;
+	if (destfd == -1) {
+	  printf("jdld: but no file is open??\n");
+	  fprintf(rsp, "?\n");
+	  continue;
+	}
+	sz = lseek(destfd, 0, SEEK_END);
+	fprintf(rsp, "K %ld", (long) sz);
+	for (off=0;off<sz;off+=bs) {
+	  crc = crc32_file(destfd, off, (sz - off) < bs ? (sz - off) : bs);
+	  // can't really happen, but keep the line parseable
+	  if (crc < 0)
+	    crc = 0;
+	  fprintf(rsp, " %8.8lx", (unsigned long) crc);
+	}
+	fprintf(rsp, "\n");
+      }
+      else if (lbuf[0] == 'P') {
+	unsigned long off;
+	printf("jdld: got position command\n");
+	off = strtoul(lbuf + 1, NULL, 0);
+	if (destfd == -1) {
+	  printf("jdld: but no file is open??\n");
+	  fprintf(rsp, "?\n");
+	  continue;
+	}
+	if (lseek(destfd, off, SEEK_SET) != (off_t) off) {
+	  perror("jdld: seek error");
+	  fprintf(rsp, "?\n");
+	} else {
+	  fprintf(rsp, "K\n");
+	}
+      }
+      else if (lbuf[0] == 'F') {
+	printf("jdld: got close command\n");
+	if (destfd == -1) {
+	  fprintf(rsp, "?\n");
+	} else {
+	  close(destfd);
+	  destfd = -1;
+	  fprintf(rsp, "K\n");
+	}
+      }
+      else if (lbuf[0] == 'Z') {
+	char *args = &lbuf[1];
+	unsigned long slot = 0;
+	uint32_t raw_size = 0, comp_size = 0;
+	uLongf inflated = jtag_mailbox_size;
+	ssize_t wb = -1;
+	uint32_t crc = 0;
+	printf("jdld: got compressed chunk command\n");
+	if (*args == '#') {
+	  slot = strtoul(args + 1, &args, 0);
+	}
+	if (destfd == -1 || slot >= nslots || args[0] != 0x0A) {
+	  printf("jdld: but no file is open, or bad slot/command: %s", lbuf);
+	  fprintf(rsp, "?\n");
+	  continue;
+	}
+	#ifdef ACTUALLY_DO_THE_SCARY_THING
+	// HERE THERE BE DRAGONS (see D)
+	mbox_vptr = (uint64_t *) mmap( NULL, jtag_mailbox_size,
+				       PROT_READ, MAP_SHARED,
+				       memfd,
+				       jtag_mailbox + slot*jtag_mailbox_size);
+	if (mbox_vptr == MAP_FAILED) {
+	  perror("mmap failed");
+	  goto cleanup;
+	}
+	{
+	  const unsigned char *hdr = (const unsigned char *) mbox_vptr;
+	  memcpy(&raw_size, hdr + 4, 4);
+	  memcpy(&comp_size, hdr + 8, 4);
+	  if (memcmp(hdr, ZHDR_MAGIC, 4) ||
+	      raw_size > jtag_mailbox_size ||
+	      comp_size > jtag_mailbox_size - ZHDR_SIZE) {
+	    printf("jdld: bad compressed chunk header\n");
+	  } else if (uncompress(zbuf, &inflated, hdr + ZHDR_SIZE, comp_size) != Z_OK ||
+		     inflated != raw_size) {
+	    printf("jdld: compressed chunk didn't inflate to %u bytes\n", raw_size);
+	  } else {
+	    printf("jdld: inflated %u bytes to %u from slot %lu\n", comp_size, raw_size, slot);
+	    wb = write(destfd, zbuf, raw_size);
+	    if (wb != raw_size)
+	      perror("jdld: write error");
+	    crc = crc32_update(0, zbuf, raw_size);
+	  }
+	}
+	munmap(mbox_vptr, jtag_mailbox_size);
+	// END HERE THERE BE DRAGONS
+	#endif
+	// same rule as D: a short chunk is the last one
+	if (wb == raw_size && raw_size != jtag_mailbox_size) {
+	  close(destfd);
+	  printf("jdld: file complete, closing\n");
+	  destfd = -1;
+	}
+	if (wb == raw_size)
+	  fprintf(rsp, "K %8.8lx\n", (unsigned long) crc);
+	else
+	  fprintf(rsp, "?\n");
+      }
       else if (lbuf[0] == 'D') {
+	// D#<slot> picks the slot, otherwise it's slot 0
+	char *args = &lbuf[1];
+	unsigned long slot = 0;
 	printf("jdld: got chunk command\n");
+	if (*args == '#') {
+	  slot = strtoul(args + 1, &args, 0);
+	}
 	// file needs to be open
 	if (destfd == -1) {
 	  printf("jdld: but no file is open??\n");
 	  fprintf(rsp, "?\n");
 	  continue;
-	} else if (lbuf[1] != 0x0A && lbuf[1] != 0x20) {
-	  const char *unk = &lbuf[1];
-	  printf("jdld: incorrect D command, needs 0x0A or space: %s\n", unk);
+	} else if (slot >= nslots) {
+	  printf("jdld: but there's no slot %lu\n", slot);
+	  fprintf(rsp, "?\n");
+	  continue;
+	} else if (args[0] != 0x0A && args[0] != 0x20) {
+	  printf("jdld: incorrect D command, needs 0x0A or space: %s\n", args);
 	  fprintf(rsp, "?\n");
 	  continue;
 	} else {
 	  size_t chunk_size;
 	  ssize_t wb = 0;
-	  if (lbuf[1] == 0x0A) {
+	  uint32_t crc = 0;
+	  if (args[0] == 0x0A) {
 	    chunk_size = jtag_mailbox_size;
 	  } else {
-	    const char *sizeptr = lbuf + 1;
+	    const char *sizeptr = args;
 	    // strip the newline. again, don't eff this up.
 	    lbuf[nb - 1] = 0;
 	    chunk_size = strtoul(sizeptr, NULL, 0);
@@ -196,7 +467,7 @@ int main() {
 	      continue;
 	    }
 	  }
-	  printf("jdld: dumping %ld bytes\n", chunk_size);
+	  printf("jdld: dumping %ld bytes from slot %lu\n", chunk_size, slot);
 	  #ifdef ACTUALLY_DO_THE_SCARY_THING
 	  if (chunk_size > 0) {
 	    // HERE THERE BE DRAGONS
@@ -205,7 +476,7 @@ int main() {
 	    mbox_vptr = (uint64_t *) mmap( NULL, jtag_mailbox_size,
 					   PROT_READ, MAP_SHARED,
 					   memfd, 
-					   jtag_mailbox);
+					   jtag_mailbox + slot*jtag_mailbox_size);
 	    if (mbox_vptr == MAP_FAILED) {
 	      perror("mmap failed");
 	      goto cleanup;
@@ -221,6 +492,9 @@ int main() {
 		// you HAVE to continue here, you MUST munmap
 	      }
 	    }
+	    // checksum what JTAG actually gave us
+	    if (wb > 0)
+	      crc = crc32_update(0, (const unsigned char *) mbox_vptr, wb);
 	    munmap(mbox_vptr, jtag_mailbox_size);
 	    // END HERE THERE BE DRAGONS
 	  }
@@ -236,7 +510,7 @@ int main() {
 	    destfd = -1;
 	  }
 	  if (wb == chunk_size)
-	    fprintf(rsp, "K\n");
+	    fprintf(rsp, "K %8.8lx\n", (unsigned long) crc);
 	  else
 	    fprintf(rsp, "?\n");
 	}
@@ -263,6 +537,9 @@ int main() {
   if (lbuf != NULL) {
     free(lbuf);
   }
+  if (zbuf != NULL) {
+    free(zbuf);
+  }
   if (memfd != -1) {
     close(memfd);
   }
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+# jdbench: how fast do jdownload and jtransfer go, and where does the time go?
+#
+# they get run against a stand-in for the board instead of a real one.
+# FakeXsdb speaks the xsdbserver.tcl protocol (target, jtagterminal,
+# jdl_mwr, dow) and the jtag terminals it hands out are FakeTerminals: a
+# shell prompt with jdld behind jb, plus enough of xxd -r -p, base64 -d
+# and sha256sum for jtransfer. Everything going either way goes through
+# a Link, which holds it for the latency plus however long its bytes take
+# at the link's bandwidth, so
+#
+# jdbench.py --size 8M --jtag 1e6 --uart 50e3 --latency 0.002 \
+#    --chunk 262144 --chunk 1048576 --line 16:1 --line 1024:8
+#
+# runs every jdownload --config (plain, dow, pipeline, compress) at each
+# --chunk size (JDLD_CHUNK_SIZE, the fake jdld's mailbox slots follow it)
+# and jtransfer at each --line BYTES:WINDOW, and prints MB/s along with
+# where the time went: JtagDownload.timings for jdownload, and for
+# jtransfer the time to the prompt, sending lines, and finishing up as
+# the terminal saw it. Files land in a scratch directory and get checked
+# against what was sent.
+#
+# The default bandwidths are guesses, not measurements: put in what you
+# see on the real thing.
+
+import argparse
+import base64
+import filecmp
+import hashlib
+import os
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import jdownload
+from jdownload import JtagDownload, JtagDownloadError, JDLD_MAILBOX, JDLD_ZHDR, JDLD_ZMAGIC
+from jtagsession import PROFILES
+from xsdbclient import XsdbClient, XsdbError
+
+prog = "jdbench"
+
+JTRANSFER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jtransfer', 'jtransfer.py')
+
+# jdownload option sets: name -> JtagDownload keywords
+CONFIGS = { 'plain'    : { },
+            'dow'      : { 'stream' : False },
+            'pipeline' : { 'pipeline' : True },
+            'compress' : { 'pipeline' : True, 'compress' : True } }
+
+class Link:
+    """ a slow connection: every message takes latency (s) plus its size over bandwidth (bytes/s, 0 is infinite) """
+    def __init__(self, bandwidth=0, latency=0):
+        self.bandwidth = bandwidth
+        self.latency = latency
+
+    def delay(self, nbytes):
+        t = self.latency + (nbytes/self.bandwidth if self.bandwidth > 0 else 0)
+        if t > 0:
+            time.sleep(t)
+
+class FakeTerminal(threading.Thread):
+    """ one jtag terminal connection: a shell at a prompt, jdld after jb. remote files
+        all go in root (only their basename is kept) """
+    JDLD_VERSION = b'V 1.4'
+
+    def __init__(self, root, link, mode='surf', mailbox=None, chunkSize=jdownload.JDLD_CHUNK_SIZE, slots=2):
+        super().__init__(daemon=True)
+        self.root = root
+        self.link = link
+        self.profile = PROFILES[mode] if isinstance(mode, str) else mode
+        self.prompt = self.profile.beginPrompt + self.profile.prompt
+        self.nl = self.profile.newline
+        self.mailbox = mailbox if mailbox is not None else {}
+        self.chunkSize = chunkSize
+        self.slots = slots
+        # shell, jdld, or input (a file coming in on stdin)
+        self.state = 'shell'
+        self.buf = bytearray()
+        self.f = None
+        self.lines = []
+        self.decode = None
+        self.inputFile = None
+        # (what, time) as things happen, for working out where the time went
+        self.marks = []
+        self.srv = socket.socket()
+        self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.srv.bind(('localhost', 0))
+        self.srv.listen(1)
+        self.port = self.srv.getsockname()[1]
+
+    def mark(self, what):
+        self.marks.append((what, time.monotonic()))
+
+    def path(self, fn):
+        return os.path.join(self.root, os.path.basename(fn.decode()))
+
+    def run(self):
+        try:
+            conn, _ = self.srv.accept()
+        except OSError:
+            return
+        self.mark('connect')
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    break
+                if not data:
+                    break
+                self.link.delay(len(data))
+                out = self.handle(data)
+                if out:
+                    self.link.delay(len(out))
+                    conn.sendall(out)
+        if self.f is not None:
+            self.f.close()
+        self.mark('close')
+
+    def stop(self):
+        self.srv.close()
+
+    def handle(self, data):
+        """ everything that comes back for data """
+        self.buf.extend(data)
+        out = bytearray()
+        while True:
+            # ^D only means something at the start of a line
+            if self.buf[:1] == b'\x04':
+                del self.buf[:1]
+                out += self.eof()
+                continue
+            idx = self.buf.find(b'\n')
+            if idx < 0:
+                break
+            ln = bytes(self.buf[:idx])
+            del self.buf[:idx+1]
+            if self.state == 'jdld':
+                out += self.jdld(ln) + b'\r\n'
+            elif self.state == 'input':
+                self.lines.append(ln)
+                out += ln + self.nl
+            else:
+                out += self.shell(ln)
+        return out
+
+    def eof(self):
+        if self.state == 'jdld':
+            self.state = 'shell'
+            return b'jc: exiting\r\n' + self.prompt
+        if self.state == 'input':
+            self.mark('eof')
+            self.state = 'shell'
+            with open(self.inputFile, 'wb') as f:
+                f.write(self.decode(b''.join(self.lines)))
+            self.lines = []
+            return self.prompt
+        # ^D at the prompt would log us out, and nobody wants that
+        return b''
+
+    def shell(self, ln):
+        echo = ln + self.nl + self.profile.endcmd
+        if ln == b'jb':
+            self.state = 'jdld'
+            return ln + b'\r\n'
+        m = re.match(rb'(xxd -r -p - |base64 -d > )(\S+)$', ln)
+        if m:
+            self.mark('command')
+            self.state = 'input'
+            self.inputFile = self.path(m.group(2))
+            if m.group(1).startswith(b'xxd'):
+                self.decode = lambda x : bytes.fromhex(x.decode())
+            else:
+                self.decode = base64.b64decode
+            return echo
+        m = re.match(rb'sha256sum (\S+)$', ln)
+        if m:
+            try:
+                with open(self.path(m.group(1)), 'rb') as f:
+                    out = b'%s  %s' % (hashlib.sha256(f.read()).hexdigest().encode(), m.group(1))
+            except OSError:
+                out = b'sha256sum: %s: No such file or directory' % m.group(1)
+            return echo + out + self.nl + self.prompt
+        if ln:
+            return echo + b'sh: %s: not found' % ln.split()[0] + self.nl + self.prompt
+        return echo + self.prompt
+
+    def slot(self, n, length):
+        """ what's in mailbox slot n """
+        addr = int(JDLD_MAILBOX, 0) + n*self.chunkSize
+        return self.mailbox.get(addr, b'')[:length]
+
+    def jdld(self, ln):
+        """ jdld's response to ln (no line ending) """
+        cmd = ln[:1]
+        try:
+            if ln == b'V':
+                return self.JDLD_VERSION
+            if ln == b'N':
+                return b'N %d' % self.slots
+            if cmd == b'C' or cmd == b'R':
+                if self.f is not None:
+                    return b'?'
+                fn = self.path(ln[1:])
+                if cmd == b'C' or not os.path.exists(fn):
+                    open(fn, 'wb').close()
+                self.f = open(fn, 'r+b')
+                if cmd == b'C':
+                    return b'K'
+                self.f.seek(0, 2)
+                return b'K %d' % self.f.tell()
+            if self.f is None:
+                return b'?'
+            if cmd == b'Q':
+                off, length = map(int, ln[2:].split())
+                self.f.seek(off)
+                data = self.f.read(length)
+                self.f.seek(0, 2)
+                return b'K %8.8x' % zlib.crc32(data) if len(data) == length else b'?'
+            if cmd == b'S':
+                self.f.truncate(int(ln[2:]))
+                self.f.seek(int(ln[2:]))
+                return b'K'
+            if cmd == b'H':
+                bs = int(ln[2:])
+                self.f.seek(0)
+                data = self.f.read()
+                return b'K %d' % len(data) + b''.join(b' %8.8x' % zlib.crc32(data[i:i+bs])
+                                                     for i in range(0, len(data), bs))
+            if cmd == b'P':
+                self.f.seek(int(ln[2:]))
+                return b'K'
+            if cmd == b'F':
+                self.f.close()
+                self.f = None
+                return b'K'
+            if cmd == b'D' or cmd == b'Z':
+                m = re.match(rb'[DZ](?:#(\d+))?(?: (\d+))?$', ln)
+                n = int(m.group(1)) if m.group(1) else 0
+                if n >= self.slots:
+                    return b'?'
+                if cmd == b'Z':
+                    magic, rawLen, zLen = JDLD_ZHDR.unpack(self.slot(n, JDLD_ZHDR.size))
+                    if magic != JDLD_ZMAGIC:
+                        return b'?'
+                    data = zlib.decompress(self.slot(n, JDLD_ZHDR.size + zLen)[JDLD_ZHDR.size:])
+                else:
+                    rawLen = int(m.group(2)) if m.group(2) else self.chunkSize
+                    data = self.slot(n, rawLen)
+                self.f.write(data)
+                # a short chunk is the last one
+                if rawLen != self.chunkSize:
+                    self.f.close()
+                    self.f = None
+                return b'K %8.8x' % zlib.crc32(data)
+        except (ValueError, AttributeError, struct.error, zlib.error, OSError):
+            pass
+        return b'?'
+
+class FakeXsdb(threading.Thread):
+    """ stand-in for xsdb running xsdbserver.tcl: enough Tcl for jdownload, with memory
+        writes going over the jtag link. terminals get chunkSize/slots as they are when started """
+    def __init__(self, root, jtag, uart, chunkSize=jdownload.JDLD_CHUNK_SIZE, slots=2):
+        super().__init__(daemon=True)
+        self.root = root
+        self.jtag = jtag
+        self.uart = uart
+        self.chunkSize = chunkSize
+        self.slots = slots
+        self.mailbox = {}
+        self.terminal = None
+        self.srv = socket.socket()
+        self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.srv.bind(('localhost', 0))
+        self.srv.listen(4)
+        self.port = self.srv.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.srv.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        self.srv.close()
+        if self.terminal is not None:
+            self.terminal.stop()
+
+    def serve(self, conn):
+        with conn, conn.makefile('rb') as f:
+            while True:
+                ln = f.readline()
+                if not ln:
+                    return
+                nbytes = len(ln)
+                ln = ln.decode('utf-8', 'replace').rstrip('\r\n')
+                try:
+                    if ln.startswith('jdl_mwr '):
+                        _, addr, n = ln.split()
+                        data = f.read(int(n))
+                        nbytes += len(data)
+                        self.mailbox[int(addr, 0)] = data
+                        rsp = 'okay done'
+                    else:
+                        rsp, n = self.tcl(ln)
+                        nbytes += n
+                except (ValueError, OSError) as e:
+                    rsp = 'error %s' % e
+                self.jtag.delay(nbytes)
+                conn.sendall(rsp.encode('utf-8') + XsdbClient.EOM)
+
+    def tcl(self, cmd):
+        """ (reply, bytes that went over jtag) for a Tcl command """
+        if cmd.startswith('target'):
+            return 'okay ', 0
+        if cmd == 'info commands jdl_mwr':
+            return 'okay jdl_mwr', 0
+        if cmd == 'jtagterminal -socket':
+            if self.terminal is not None:
+                self.terminal.stop()
+            self.terminal = FakeTerminal(self.root, self.uart, 'surf', self.mailbox, self.chunkSize, self.slots)
+            self.terminal.start()
+            return 'okay %d' % self.terminal.port, 0
+        if cmd == 'jtagterminal -stop':
+            if self.terminal is not None:
+                self.terminal.stop()
+                self.terminal = None
+            return 'okay ', 0
+        m = re.match(r'dow -data (\S+) (\S+); set done "done"$', cmd)
+        if m:
+            with open(m.group(1), 'rb') as f:
+                data = f.read()
+            self.mailbox[int(m.group(2), 0)] = data
+            return 'okay done', len(data)
+        return 'error invalid command name "%s"' % cmd.split(' ')[0], 0
+
+def makeFile( fn, size, kind ):
+    """ random (incompressible), zeros, or mixed: 64k blocks of each, like a mostly-empty image """
+    with open(fn, 'wb') as f:
+        for off in range(0, size, 65536):
+            n = min(65536, size - off)
+            if kind == 'zeros' or (kind == 'mixed' and (off//65536) % 2):
+                f.write(bytes(n))
+            else:
+                f.write(os.urandom(n))
+
+def parseSize( s ):
+    """ 4M, 256k, 1000 -> bytes """
+    m = re.match(r'(\d+)([kKmM]?)$', s)
+    if not m:
+        raise argparse.ArgumentTypeError("%s isn't a size" % s)
+    return int(m.group(1)) * { '' : 1, 'k' : 1024, 'K' : 1024, 'm' : 1024*1024, 'M' : 1024*1024 }[m.group(2)]
+
+def benchDownload( xsdb, localFile, chunkSize, config, verify ):
+    """ one jdownload run, returns (seconds, JtagDownload.timings) """
+    jdownload.JDLD_CHUNK_SIZE = chunkSize
+    xsdb.chunkSize = chunkSize
+    remote = os.path.join(xsdb.root, 'jdownload.bin')
+    xsct = XsdbClient('localhost', xsdb.port)
+    try:
+        dl = JtagDownload(xsct, localFile, remote, verify=verify, name=prog, **CONFIGS[config])
+        start = time.monotonic()
+        dl.run()
+        secs = time.monotonic() - start
+    finally:
+        xsct.close()
+    if not filecmp.cmp(localFile, remote, shallow=False):
+        raise JtagDownloadError("%s came out different" % remote)
+    os.unlink(remote)
+    return secs, dl.timings
+
+def benchTransfer( root, uart, localFile, line, window, b64 ):
+    """ one jtransfer run, returns (seconds, phases) """
+    term = FakeTerminal(root, uart, 'pynq')
+    term.start()
+    remote = os.path.join(root, 'jtransfer.bin')
+    cmd = [ sys.executable, JTRANSFER, localFile, remote, str(term.port),
+            '--line', str(line), '--window', str(window) ] + (['--base64'] if b64 else [])
+    start = time.monotonic()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    secs = time.monotonic() - start
+    term.join(5)
+    term.stop()
+    if proc.returncode:
+        raise RuntimeError("jtransfer failed: %s" % proc.stdout.decode(errors='replace').strip().split('\n')[-1])
+    if not filecmp.cmp(localFile, remote, shallow=False):
+        raise RuntimeError("%s came out different" % remote)
+    os.unlink(remote)
+    marks = dict(term.marks)
+    phases = { 'startup' : marks['connect'] - start,
+               'prompt' : marks['command'] - marks['connect'],
+               'lines' : marks['eof'] - marks['command'],
+               'finish' : start + secs - marks['eof'] }
+    return secs, phases
+
+def best( runs, fn ):
+    """ fastest of runs tries of fn """
+    return min((fn() for _ in range(runs)), key=lambda r : r[0])
+
+def report( what, size, secs, phases ):
+    print("%-36s %8.3f MB/s %8.2f s   %s" %
+          (what, size/secs/1e6, secs, '  '.join('%s %.2f' % p for p in phases.items())))
+
+def main():
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--size", type=parseSize, default=parseSize('4M'),
+                        help="file size for jdownload (default 4M)")
+    parser.add_argument("--tsize", type=parseSize, default=parseSize('64k'),
+                        help="file size for jtransfer (default 64k, it's slow)")
+    parser.add_argument("--data", choices=['random', 'zeros', 'mixed'], default='mixed',
+                        help="what's in the files (default mixed: half zeros, half random)")
+    parser.add_argument("--jtag", type=float, default=1e6,
+                        help="bytes/s for memory writes through xsdb (default 1e6)")
+    parser.add_argument("--uart", type=float, default=50e3,
+                        help="bytes/s each way through the jtag terminal (default 50e3)")
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="seconds added to every message either way (default 0.001)")
+    parser.add_argument("--chunk", type=parseSize, action='append', default=[],
+                        help="jdownload chunk size, repeatable (default 1M)")
+    parser.add_argument("--config", choices=list(CONFIGS), action='append', default=[],
+                        help="jdownload options to try, repeatable (default all of them)")
+    parser.add_argument("--slots", type=int, default=2,
+                        help="mailbox slots the fake jdld has (default 2)")
+    parser.add_argument("--verify", action='store_true',
+                        help="run jdownload with --verify too")
+    parser.add_argument("--line", action='append', default=[],
+                        help="jtransfer BYTES:WINDOW, repeatable (default 16:1, 256:8, 1024:4)")
+    parser.add_argument("--base64", action='store_true',
+                        help="run jtransfer with --base64")
+    parser.add_argument("--only", choices=['jdownload', 'jtransfer'],
+                        help="just benchmark this one")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="run everything this many times and report the fastest (default 1)")
+    args = parser.parse_args()
+
+    chunks = args.chunk if args.chunk else [ jdownload.JDLD_CHUNK_SIZE ]
+    configs = args.config if args.config else list(CONFIGS)
+    lines = args.line if args.line else [ '16:1', '256:8', '1024:4' ]
+    try:
+        lines = [ tuple(int(x) for x in l.split(':')) for l in lines ]
+        if any(len(l) != 2 for l in lines):
+            raise ValueError
+    except ValueError:
+        print("%s: --line is BYTES:WINDOW" % prog)
+        exit(1)
+
+    jtag = Link(args.jtag, args.latency)
+    uart = Link(args.uart, args.latency)
+    root = tempfile.mkdtemp(prefix=prog)
+    failed = 0
+    try:
+        print("%s: jtag %.0f B/s, uart %.0f B/s, latency %.1f ms, %s data" %
+              (prog, args.jtag, args.uart, args.latency*1e3, args.data))
+        if args.only != 'jtransfer':
+            localFile = os.path.join(root, 'local.bin')
+            makeFile(localFile, args.size, args.data)
+            xsdb = FakeXsdb(root, jtag, uart, slots=args.slots)
+            xsdb.start()
+            try:
+                for chunkSize in chunks:
+                    for config in configs:
+                        what = "jdownload %s chunk %d" % (config, chunkSize)
+                        try:
+                            secs, phases = best(args.repeat, lambda : benchDownload(xsdb, localFile, chunkSize,
+                                                                                    config, args.verify))
+                        except (JtagDownloadError, XsdbError, OSError) as e:
+                            failed += 1
+                            print("%-36s FAILED %s" % (what, e))
+                            continue
+                        report(what, args.size, secs, phases)
+            finally:
+                xsdb.stop()
+        if args.only != 'jdownload':
+            localFile = os.path.join(root, 'tlocal.bin')
+            makeFile(localFile, args.tsize, args.data)
+            for line, window in lines:
+                what = "jtransfer line %d window %d%s" % (line, window, ' base64' if args.base64 else '')
+                try:
+                    secs, phases = best(args.repeat, lambda : benchTransfer(root, uart, localFile, line, window,
+                                                                            args.base64))
+                except (RuntimeError, OSError, KeyError) as e:
+                    failed += 1
+                    print("%-36s FAILED %s" % (what, e))
+                    continue
+                report(what, args.tsize, secs, phases)
+    finally:
+        shutil.rmtree(root)
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
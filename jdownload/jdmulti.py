@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# jdmulti: jdownload the same file to a bunch of boards at once.
+#
+# every target gets its own xsdb (so its own hw_server connection, target
+# selection and jtag terminal) and its own JtagDownload, all running at
+# the same time, so pushing software to a whole crate takes as long as
+# the slowest board instead of all of them added up.
+#
+# jdmulti.py image.bin /tmp/image.bin --pipeline \
+#    --target "surf1,-url tcp:crate1:3121,jtag_cable_serial == \"A\"" \
+#    --target "surf2,-url tcp:crate1:3121,jtag_cable_serial == \"B\"" \
+#    --target "surf3,4567"
+#
+# a target is NAME,CONNECT[,FILTER]: CONNECT is what goes after xsdb's
+# connect command (each target gets a fresh xsdb), or just a port number
+# if there's already an xsdbserver.tcl running for it. FILTER is an
+# extra xsdb target filter picking the board on that connection.
+# --targets FILE reads the same thing one per line (# comments).
+
+pb = None
+try:
+    import progressbar2 as pb
+except ImportError:
+    pass
+if pb is None:
+    try:
+        import progressbar as pb
+    except ImportError:
+        pass
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from xsdbclient import XsdbClient, XsdbError
+from jdownload import JtagDownload, JtagDownloadError
+from jtagsession import PROFILES
+
+prog = "jdmulti"
+
+def parseTarget( spec ):
+    """ NAME,CONNECT[,FILTER] -> (name, connect, filter) """
+    parts = [ p.strip() for p in spec.split(',', 2) ]
+    if len(parts) < 2 or not parts[0]:
+        raise ValueError("target %s isn't NAME,CONNECT[,FILTER]" % spec)
+    return parts[0], parts[1], parts[2] if len(parts) > 2 else ''
+
+class MultiProgress:
+    """ adds up the progress of every transfer into one bar """
+    def __init__(self, names, total):
+        self.lock = threading.Lock()
+        self.done = { n : 0 for n in names }
+        self.bar = None
+        if pb is not None:
+            self.bar = pb.ProgressBar( widgets=[ '%d targets:' % len(names),
+                                                 ' ', pb.Percentage(),
+                                                 ' ', pb.Bar(),
+                                                 ' ', pb.AdaptiveETA(),
+                                                 ' ', pb.AdaptiveTransferSpeed() ],
+                                       max_value=total*len(names),
+                                       redirect_stdout=True).start()
+
+    def callback(self, name):
+        def update(x):
+            with self.lock:
+                self.done[name] = x
+                if self.bar is not None:
+                    self.bar.update(sum(self.done.values()))
+        return update
+
+    def finish(self):
+        if self.bar is not None:
+            self.bar.finish()
+
+def transfer( target, args, progress ):
+    """ run one target's download. returns (chunks, seconds), raises on failure """
+    name, connect, tfilter = target
+    start = time.monotonic()
+    if connect.isdigit():
+        xsct = XsdbClient('localhost', int(connect))
+    else:
+        xsct = XsdbClient.launch(args.xsdb, connect)
+    try:
+        dl = JtagDownload(xsct, args.localFile, args.remoteFile,
+                          mode=args.mode,
+                          target=tfilter,
+                          stream=not args.dow,
+                          pipeline=args.pipeline,
+                          resume=args.resume,
+                          delta=args.delta,
+                          compress=args.compress,
+                          slots=args.slots,
+                          safeStart=args.safeStart,
+                          verify=args.verify,
+                          verbose=args.verbose,
+                          name=name,
+                          progress=progress)
+        chunks = dl.run()
+    finally:
+        xsct.close()
+    return chunks, time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("localFile", help="local filename to transfer")
+    parser.add_argument("remoteFile", help="remote filename")
+    parser.add_argument("--target", action='append', default=[],
+                        help="NAME,CONNECT[,FILTER] (repeat for each board)")
+    parser.add_argument("--targets", help="file with one NAME,CONNECT[,FILTER] per line")
+    parser.add_argument("--jobs", "-j", type=int, default=0,
+                        help="at most this many transfers at once (default: all of them)")
+    parser.add_argument("--xsdb", help="xsdb binary",
+                        default="xsdb")
+    parser.add_argument("--verbose", "-v", action="count", default=0,
+                        help="Increase verbosity")
+    parser.add_argument("--mode", help="either pynq or surf (default)",
+                        default="surf")
+    parser.add_argument("--safeStart",action='store_true',
+                        help="Try to read out all characters possible before starting (takes 5+ seconds)")
+    parser.add_argument("--dow", action='store_true',
+                        help="send chunks with dow from tempfiles instead of mwr over the xsdb socket")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="prepare the next chunk during each dow and check jdld's acks lazily")
+    parser.add_argument("--resume", action='store_true',
+                        help="keep the chunks of remoteFile which are already right and send the rest (needs jdld 1.2)")
+    parser.add_argument("--delta", action='store_true',
+                        help="only send the chunks which differ from what's already in remoteFile (needs jdld 1.3)")
+    parser.add_argument("--compress", action='store_true',
+                        help="zlib-compress chunks which shrink, jdld inflates them (needs jdld 1.4)")
+    parser.add_argument("--slots", type=int, default=0,
+                        help="with --pipeline, use at most this many jdld mailbox slots (default: all it has)")
+    parser.add_argument("--verify", action='store_true',
+                        help="afterwards, check the remote file with jdld's CRCs and sha256sum")
+    args = parser.parse_args()
+
+    specs = list(args.target)
+    if args.targets:
+        with open(args.targets) as f:
+            specs += [ l.strip() for l in f if l.strip() and not l.strip().startswith('#') ]
+    try:
+        targets = [ parseTarget(s) for s in specs ]
+    except ValueError as e:
+        print("%s: %s" % (prog, e))
+        exit(1)
+    if not targets:
+        print("%s: no targets!" % prog)
+        exit(1)
+    names = [ t[0] for t in targets ]
+    if len(set(names)) != len(names):
+        print("%s: target names have to be unique" % prog)
+        exit(1)
+    if args.mode not in PROFILES:
+        print("%s: don't know mode %s" % (prog, args.mode))
+        exit(1)
+    if not os.path.exists(args.localFile):
+        print("%s: can't find %s to send" % (prog, args.localFile))
+        exit(1)
+    lfilesz = os.path.getsize(args.localFile)
+
+    progress = MultiProgress(names, lfilesz)
+    jobs = args.jobs if args.jobs > 0 else len(targets)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = { t[0] : pool.submit(transfer, t, args, progress.callback(t[0])) for t in targets }
+        results = {}
+        for name, fut in futures.items():
+            # anything one board throws (a garbled reply, a dropped connection)
+            # is just that board failing, everyone else still gets reported
+            try:
+                results[name] = fut.result()
+            except Exception as e:
+                results[name] = e
+    progress.finish()
+
+    # summary
+    width = max(len(n) for n in names)
+    failed = 0
+    for name in names:
+        r = results[name]
+        if isinstance(r, Exception):
+            failed += 1
+            # our own errors say what happened, anything else needs its type to make sense
+            if not isinstance(r, (JtagDownloadError, XsdbError)):
+                r = '%s: %s' % (type(r).__name__, r)
+            print("%-*s  FAILED  %s" % (width, name, r))
+        else:
+            chunks, secs = r
+            print("%-*s  ok      %d chunks in %.1f s (%.2f MB/s)" %
+                  (width, name, chunks, secs, lfilesz/secs/1e6 if secs > 0 else 0))
+    print("%s: %d of %d targets succeeded" % (prog, len(names) - failed, len(names)))
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 
-# you need pysct for this
-# https://github.com/raczben/pysct
+# this talks to xsdb through xsdbserver.tcl (see xsdbclient.py), either
+# one you're running already (--port) or one it starts itself. pysct
+# (https://github.com/raczben/pysct) still works with --pysct, but then
+# chunks go through tempfiles and dow instead of straight into mwr.
 # you also need progressbar2 because I said so
 # - OK you need SOME form of progressbar
 #   I don't know if I'm using any progressbar2
 #   -exclusive features. Deal with it.
+#
+# the transfer itself is JtagDownload, so other scripts (jdmulti.py)
+# can import this and run it against several targets:
+#
+# xsct = XsdbClient.launch('xsdb', '-url tcp:crate1:3121')
+# dl = JtagDownload(xsct, 'image.bin', '/tmp/image.bin', pipeline=True)
+# dl.run()
 
 # I'm deferring pysct's import until after argparse
 # to allow for passing the path to it
 #from pysct.core import Xsct
+from xsdbclient import XsdbClient, XsdbError
+from jtagsession import JtagTerminalSession, PROFILES
 
 pb = None
 try:
@@ -22,13 +33,19 @@ if pb is None:
     except ImportError:
         pass
 
-import socket
 import sys
 import argparse
 import os
+import zlib
+import struct
+import hashlib
+import re
+import time
 from sys import platform
 from tempfile import NamedTemporaryFile
 from math import ceil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 translate_path = lambda x : x
 # cygwin needs the pycygwin module for cygpath
@@ -42,296 +59,661 @@ if platform == 'cygwin':
     translate_path = lambda x : cygpath(x, mode='windows').replace("\\","/")
 elif platform == 'win32' or platform == 'msys':
     translate_path = lambda x : x.replace("\\","/")
-    
-JDLD_VERSION = b'V 1.0'
+
+JDLD_VERSION = b'V 1.4'
+# versions we can talk to. 1.0 has no mailbox slots, 1.1 no CRCs/resume,
+# 1.2 no block hashes (delta), 1.3 no compressed chunks
+JDLD_VERSIONS = [ b'V 1.0', b'V 1.1', b'V 1.2', b'V 1.3', b'V 1.4' ]
 JDLD_OK = b'K'
 JDLD_CHUNK_SIZE = 1024*1024
 JDLD_MAILBOX = "0x70000000"
 endfile = b'\x04'
+# compressed chunk header: magic, raw length, compressed length
+JDLD_ZHDR = struct.Struct('<4sII')
+JDLD_ZMAGIC = b'JDZ1'
+
+prog = "jdownload"
+bridge = b'jb'
+finish = b'\x04'
+
+# what-freaking-ever (the prompts etc. are jtagsession.PROFILES)
+modes = list(PROFILES)
 
 # stupid utility crap
-def startStopUart( xsct, en ):
+def startStopUart( xsct, en, target='' ):
+    """ start (returning its port) or stop the jtag terminal. target is an extra
+        xsdb target filter (e.g. jtag_cable_serial == "...") to pick the board """
     if en:
         cmd = 'jtagterminal -socket'
     else:
         cmd = 'jtagterminal -stop'
-    resp = xsct.do('target -set -filter { name =~ "Cortex-A53 #0" }')
+    extra = ' && ' + target if target else ''
+    resp = xsct.do('target -set -filter { name =~ "Cortex-A53 #0"%s }' % extra)
     resp = xsct.do(cmd)
     if en:
         termPort = int(resp)
     else:
         termPort = None
-    resp = xsct.do('target -set -filter { name =~ "PSU" }')
+    resp = xsct.do('target -set -filter { name =~ "PSU"%s }' % extra)
     return termPort
 
-def getLine( sock ):
-    msg = b''
-    while True:
-        try:
-            data = sock.recv(500)
-            msg += data
-            if v > 1:
-                print('%s: got %d bytes, up to %d' %
-                      (prog, len(data), len(msg)))
-            if msg[-1:] == b'\n':
+def openTerminal( xsct, mode='surf', target='', host='localhost', safeStart=False, verbose=0, name=prog ):
+    """ start the jtag terminal, connect and find the prompt. returns the JtagTerminalSession,
+        which can be used for as many JtagDownloads as you want """
+    # spawn the terminal (this also bounces us back to PSU as a target)
+    termPort = startStopUart(xsct, True, target)
+    if verbose > 0:
+        print('%s: connecting to %s port %d' % (name, host, termPort))
+    try:
+        session = JtagTerminalSession(host, termPort, mode, verbose=verbose, name=name)
+    except OSError:
+        startStopUart(xsct, False, target)
+        raise
+    if not session.sync(safeStart):
+        closeTerminal(xsct, session, target)
+        raise JtagDownloadError("did not find prompt, maybe try --safeStart?")
+    if verbose > 0:
+        print("%s: found prompt, continuing" % name)
+    return session
+
+def closeTerminal( xsct, session, target='' ):
+    session.close()
+    startStopUart(xsct, False, target)
+
+def prepareChunk( f, n, compress=False, tempfile=True, sha=None ):
+    """ read chunk n from f. returns (payload, chunk length, CRC32, compressed?) where payload
+        is what goes in the mailbox: the name of a tempfile holding it, or if not tempfile
+        the bytes themselves. if compress, that's a compressed chunk if it's worth it.
+        the chunk also goes into sha (a hashlib object) if given, so read them in order """
+    f.seek(n*JDLD_CHUNK_SIZE)
+    chunk = f.read(JDLD_CHUNK_SIZE)
+    if sha is not None:
+        sha.update(chunk)
+    if not len(chunk):
+        return None, 0, 0, False
+    data = chunk
+    if compress:
+        z = zlib.compress(chunk)
+        # not worth it if it barely shrinks (jdld has to inflate it too)
+        if JDLD_ZHDR.size + len(z) < len(chunk)*7//8:
+            data = JDLD_ZHDR.pack(JDLD_ZMAGIC, len(chunk), len(z)) + z
+    if not tempfile:
+        return data, len(chunk), zlib.crc32(chunk), data is not chunk
+    # try using the tempfile in a context manager
+    # goddamnit screw you windows
+    tf = NamedTemporaryFile(delete=False)
+    tf.write(data)
+    tf.flush()
+    tf.close()
+    return tf.name, len(chunk), zlib.crc32(chunk), data is not chunk
+
+def badRanges( changed, blockSize, size ):
+    """ merge the numbers of blocks which differ into (start, end) byte ranges """
+    ranges = []
+    for n in changed:
+        start, end = n*blockSize, min(size, (n+1)*blockSize)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+class JtagDownloadError(Exception):
+    """ a transfer went wrong. jdld and the terminal have been shut down already. """
+    pass
+
+class JtagDownload:
+    """ one file to one target: xsdb fills jdld's mailbox, the jtag terminal tells jdld what to do with it """
+    def __init__(self, xsct, localFile, remoteFile, mode='surf', target='', stream=True,
+                 pipeline=False, resume=False, delta=False, compress=False, slots=0,
+                 safeStart=False, verify=False, host='localhost', verbose=0, name=prog, progress=None,
+                 session=None):
+        """ xsct is an XsdbClient (or pysct Xsct, with stream=False). target is an extra xsdb
+            target filter. verify reads the file back afterwards (jdld CRCs and sha256sum).
+            progress gets called with how many bytes are done. name prefixes all the messages.
+            session is an already open terminal (from openTerminal) to use instead of our own """
+        self.xsct = xsct
+        self.localFile = localFile
+        self.remoteFile = remoteFile
+        self.mode = mode
+        # do a bunch of stuff that'll except out if user is a jerk
+        self.prompt = PROFILES[mode].prompt
+        self.target = target
+        self.stream = stream
+        self.pipeline = pipeline
+        self.resume = resume
+        self.delta = delta
+        self.compress = compress
+        self.maxSlots = slots
+        self.safeStart = safeStart
+        self.verify = verify
+        self.host = host
+        self.v = verbose
+        self.name = name
+        self.progress = progress
+        self.session = session
+        # what to send jdld if we bail. nothing until jdld's running,
+        # a ^D at the prompt would log us out
+        self.abort = None
+        self.chunkCount = 0
+        self.localSize = 0
+        # seconds spent in each phase of the last run(): terminal (starting/stopping
+        # it), setup (jdld startup, create, resume/delta), prepare (reading and
+        # compressing chunks), mailbox (mwr/dow), acks (waiting on jdld), verify
+        self.timings = {}
+        self.lastTick = None
+        # CRC32 of each local chunk and (with verify) the SHA-256 of the whole
+        # file, picked up as the chunks get read so verify needn't read it again
+        self.localCrcs = {}
+        self.sha = None
+
+    def tick( self, phase ):
+        """ charge the time since the last tick to phase """
+        now = time.monotonic()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self.lastTick
+        self.lastTick = now
+
+    def getLine( self ):
+        ln = self.session.readLine()
+        if ln is None:
+            print("%s: never received a line before timeout??" % self.name)
+            print("{!r}".format(bytes(self.session.buf)))
+        return ln
+
+    def collectAcks( self, pending, keep ):
+        """ read jdld responses until at most keep chunks in pending are unacknowledged.
+            pending is (chunk number, CRC32) - jdld 1.2+ sends back the CRC it saw.
+            a CRC of None is a P (position) command, which doesn't count towards keep """
+        while sum(1 for p in pending if p[1] is not None) > keep:
+            ln = self.session.readLine()
+            if ln is None:
+                raise JtagDownloadError("never received ack for chunk %d before timeout??" % pending[0][0])
+            rsp = ln.rstrip(b'\r\n').split(b' ')
+            if rsp[0] != JDLD_OK:
+                raise JtagDownloadError("jdld did not respond OK to chunk %d (%s)!" % (pending[0][0], ln[:-2]))
+            if len(rsp) > 1 and pending[0][1] is not None and int(rsp[1], 16) != pending[0][1]:
+                raise JtagDownloadError("chunk %d arrived corrupted (CRC %s, expected %8.8x), rerun with --resume" %
+                                        (pending[0][0], rsp[1].decode(), pending[0][1]))
+            pending.popleft()
+
+    def command( self, cmd, what ):
+        """ send jdld a command which just gets K back """
+        self.session.send(cmd)
+        ln = self.getLine()
+        if ln is None or ln[:-2] != JDLD_OK:
+            raise JtagDownloadError("jdld did not respond OK to %s (%s)" % (what, ln[:-2] if ln else None))
+
+    def verifiedLength( self, f, remoteSize, localSize ):
+        """ ask jdld for the CRC of each chunk already in the remote file, returns how many bytes match """
+        off = 0
+        while off < remoteSize:
+            f.seek(off)
+            chunk = f.read(JDLD_CHUNK_SIZE)
+            # only whole chunks, or the whole file
+            if off + len(chunk) > remoteSize or (len(chunk) < JDLD_CHUNK_SIZE and off + len(chunk) != localSize):
+                break
+            crc = zlib.crc32(chunk)
+            self.session.send(b'Q %d %d\n' % (off, len(chunk)))
+            ln = self.getLine()
+            if ln is None or ln[:2] != b'K ' or int(ln[2:-2], 16) != crc:
                 break
-        except socket.timeout:
-            print("%s: never received a line before timeout??" % prog)
-            print("{!r}".format(msg))
-            # send EOT to be safe
-            sock.sendall(endfile)
+            # this one's staying, so it's the start of the file for verify
+            self.localCrcs[off // JDLD_CHUNK_SIZE] = crc
+            if self.sha is not None:
+                self.sha.update(chunk)
+            off += len(chunk)
+            if len(chunk) < JDLD_CHUNK_SIZE:
+                break
+        f.seek(0)
+        return off
+
+    def remoteHashes( self ):
+        """ ask jdld for the CRC of every chunk of the remote file, returns (remote size, CRCs)
+            or (None, None) if it won't """
+        self.session.send(b'H %d\n' % JDLD_CHUNK_SIZE)
+        ln = self.getLine()
+        if ln is None or ln[:2] != b'K ':
+            return None, None
+        vals = ln[2:-2].split()
+        return int(vals[0]), [ int(x, 16) for x in vals[1:] ]
+
+    def differingChunks( self, remoteSize, remoteCrcs ):
+        """ the chunks of our file (self.localCrcs has to be complete) which the remote CRCs don't match """
+        changed = []
+        for n in range(ceil(self.localSize/JDLD_CHUNK_SIZE)):
+            localLen = min(JDLD_CHUNK_SIZE, self.localSize - n*JDLD_CHUNK_SIZE)
+            remoteLen = min(JDLD_CHUNK_SIZE, remoteSize - n*JDLD_CHUNK_SIZE)
+            if n >= len(remoteCrcs) or remoteLen != localLen or remoteCrcs[n] != self.localCrcs[n]:
+                changed.append(n)
+        return changed
+
+    def changedChunks( self, f ):
+        """ ask jdld for the CRC of every chunk of the remote file, returns (remote size, chunks which differ).
+            this reads the whole local file, so it's where localCrcs (and sha) come from in delta mode """
+        remoteSize, remoteCrcs = self.remoteHashes()
+        if remoteSize is None:
+            return None, None
+        f.seek(0)
+        for n, chunk in enumerate(iter(lambda : f.read(JDLD_CHUNK_SIZE), b'')):
+            self.localCrcs[n] = zlib.crc32(chunk)
+            if self.sha is not None:
+                self.sha.update(chunk)
+        f.seek(0)
+        return remoteSize, self.differingChunks(remoteSize, remoteCrcs)
+
+    def remoteCrcs( self, jdldVersion ):
+        """ reopen the remote file and get jdld to CRC it, returns the chunks which don't match ours
+            (None if jdld's too old to ask). the local CRCs are the ones from sending it """
+        lfilesz = self.localSize
+        if jdldVersion < (1, 2):
+            return None
+        self.session.send(b'R' + bytes(self.remoteFile, encoding='utf-8') + b'\n')
+        ln = self.getLine()
+        if ln is None or ln[:2] != b'K ':
+            raise JtagDownloadError("jdld did not respond OK to reopening for verify (%s)" % (ln[:-2] if ln else None))
+        remoteSize = int(ln[2:-2])
+        if jdldVersion >= (1, 3):
+            _, crcs = self.remoteHashes()
+            if crcs is None:
+                raise JtagDownloadError("jdld did not respond OK to block hash")
+            changed = self.differingChunks(remoteSize, crcs)
+        else:
+            changed = []
+            for n in range(ceil(lfilesz/JDLD_CHUNK_SIZE)):
+                chunkLen = min(JDLD_CHUNK_SIZE, lfilesz - n*JDLD_CHUNK_SIZE)
+                if n*JDLD_CHUNK_SIZE + chunkLen > remoteSize:
+                    changed.append(n)
+                    continue
+                self.session.send(b'Q %d %d\n' % (n*JDLD_CHUNK_SIZE, chunkLen))
+                ln = self.getLine()
+                if ln is None or ln[:2] != b'K ' or int(ln[2:-2], 16) != self.localCrcs[n]:
+                    changed.append(n)
+        self.command(b'F\n', "close")
+        if remoteSize != lfilesz:
+            print("%s: remote file is %d bytes, should be %d" % (self.name, remoteSize, lfilesz))
+        return changed
+
+    def remoteSha256( self ):
+        """ sha256sum the remote file at the prompt, returns the hex digest or None """
+        rFn = bytes(self.remoteFile, encoding='utf-8')
+        # ~20 MB/s on the ARM, give it plenty
+        out = self.session.run(b'sha256sum ' + rFn, 60 + self.localSize/1e6)
+        if out is None:
+            print("%s: never got the prompt back after sha256sum" % self.name)
             return None
-    return msg
+        m = re.search(rb'([0-9a-f]{64})\s+' + re.escape(rFn), out)
+        return m.group(1).decode() if m else None
 
-def getExpected( sock, expect):
-    msg = b''
-    while True:
+    def run( self ):
+        """ do the transfer, returns how many chunks went. raises JtagDownloadError if it fails """
+        v = self.v
+        # check if this $#!+ exists
+        if not os.path.exists(self.localFile):
+            raise JtagDownloadError("can't find %s to send" % self.localFile)
+        if v > 1:
+            print("%s: running in %s mode - expect prompt %s" % (self.name, self.mode, self.prompt))
+        # get its file size
+        self.localSize = os.path.getsize(self.localFile)
+        # open the damn thing, but DON'T USE os.open it DOESN'T WORK on Windows
+        lfile = open(self.localFile, "rb")
+        self.prefetch = None
+        # prefetched chunk, if any, so it can be cleaned up
+        self.nextChunk = None
+        # a plain xsdbserver start can't take jdl_mwr, so it gets dow instead
+        if self.stream and isinstance(self.xsct, XsdbClient) and not self.xsct.canStream():
+            print("%s: xsdb server has no jdl_mwr (not xsdbserver.tcl?), using dow" % self.name)
+            self.stream = False
+        own = self.session is None
+        self.localCrcs = {}
+        self.sha = hashlib.sha256() if self.verify else None
+        self.timings = {}
+        self.lastTick = time.monotonic()
         try:
-            data = sock.recv(500)
-            msg += data
-            if v > 1:
-                print('%s: got %d bytes, up to %d' %
-                      (prog, len(data), len(msg)))
-            if msg == expect:
-                break
-        except socket.timeout:
-            print("%s: never received echo before timeout??" % prog)
-            print("{!r}".format(expect))
-            print("{!r}".format(msg))
-            # send EOT to be safe
-            sock.sendall(endfile)
-            return False
-    return True
-    
+            if own:
+                self.session = openTerminal(self.xsct, self.mode, self.target, self.host,
+                                            self.safeStart, v, self.name)
+                self.tick('terminal')
+            self._transfer(lfile)
+        except BaseException:
+            # leave jdld and the terminal the way we found them
+            try:
+                if self.abort is not None:
+                    self.session.send(self.abort)
+                if own and self.session is not None:
+                    closeTerminal(self.xsct, self.session, self.target)
+            except (OSError, XsdbError):
+                pass
+            raise
+        else:
+            if own:
+                closeTerminal(self.xsct, self.session, self.target)
+                self.tick('terminal')
+        finally:
+            if own:
+                self.session = None
+            if self.prefetch:
+                self.prefetch.shutdown()
+            if self.nextChunk is not None and not self.stream:
+                tfName, _, _, _ = self.nextChunk.result()
+                if tfName is not None and os.path.exists(tfName):
+                    os.unlink(tfName)
+            lfile.close()
+        return self.chunkCount
 
-prog = "jdownload"
-bridge = b'jb'
-finish = b'\x04'
+    def _transfer( self, lfile ):
+        v = self.v
+        sock = self.session
+        lfilesz = self.localSize
+        remoteFileBytes = bytes(self.remoteFile, encoding='utf-8')
+        self.abort = None
+        # the echoes are normal timeouts, the long waits are on xsdb
+        sock.settimeout(5)
 
-# what-freaking-ever
-modes = [ 'pynq', 'surf', 'turf' ]
-promptDict = { 'pynq' : b'xilinx@pynq:~$ ',
-               'surf' : b'root@SURFv6:~# ',
-               'turf' : b'root@TURFv6:~# '}
-beginPromptDict = { 'pynq' : b'\x1b[?2004h',
-                    'surf' : b'',
-                    'turf' : b'' }
-endcmdDict = { 'pynq' : b'\x1b[?2004l\r',
-               'surf' : b'',
-               'turf' : b'' }
-newlineDict = { 'pynq' : b'\r\n',
-                'surf' : b'\r\n',
-                'turf' : b'\r\n' }
-
-parser = argparse.ArgumentParser(prog=prog)
-parser.add_argument("localFile", help="local filename to transfer")
-parser.add_argument("remoteFile", help="remote filename")
-parser.add_argument("--xsdb", help="xsdb binary",
-                    default="xsdb")
-parser.add_argument("--port", help="if specified, use running xsdb at this port",
-                    default="")
-parser.add_argument("--connect", help="string to pass after connect if spawning xsct",
-                    default="")
-parser.add_argument("--verbose", "-v", action="count", default=0,
-                    help="Increase verbosity")
-parser.add_argument("--mode", help="either pynq or surf (default)",
-                    default="surf")
-parser.add_argument("--safeStart",action='store_true',
-                    help="Try to read out all characters possible before starting (takes 5+ seconds)")
-parser.add_argument("--pysct", help="path to pysct repository")
-
-args = parser.parse_args()
-if args.pysct:
-    sys.path.append(args.pysct)
-
-# now import
-from pysct.core import Xsct
-    
-v = args.verbose
-mode = args.mode
-
-# do a bunch of stuff that'll except out if user is a jerk
-prompt = promptDict[mode]
-beginPrompt = promptDict[mode]
-newline = newlineDict[mode]
-endcmd = endcmdDict[mode]
-
-if v > 1:
-    print("%s: running in %s mode - expect prompt %s" % (prog, mode, prompt))
-
-remoteFileBytes = bytes(args.remoteFile, encoding='utf-8')
-
-print(args.xsdb)
-host = 'localhost'
-
-# check if this $#!+ exists
-if not os.path.exists(args.localFile):
-    print("%s: can't find %s to send" % (prog, args.localFile))
-
-# get its file size
-lfilesz = os.path.getsize(args.localFile)    
-# open the damn thing, but DON'T USE os.open it DOESN'T WORK on Windows
-lfile = open(args.localFile, "rb")
-
-# connect to the xsct/xsdb server
-if args.port:
-    xsct = Xsct(host, int(args.port))
-else:
-    print("%s: launching xsdb/xsct is still a work in progress" % prog)
-    exit(1)
-
-# get a tempfile
-# let's try deferring the tempfile because windows is an asshole
-#tf = NamedTemporaryFile()
-
-# spawn the terminal (this also bounces us back to PSU as a target)
-termPort = startStopUart(xsct, True)
-
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_address = (host, termPort)
-if v > 0:
-    print('%s: connecting to %s port %d' % (prog, host, termPort))
-sock.connect(server_address)
+        # execute the bridge
+        sock.send(b'jb\n')
+        self.abort = endfile
+        if not sock.expect(b'jb\r\n'):
+            raise JtagDownloadError("no echo from the bridge: %r" % bytes(sock.buf))
+        sock.send(b'V\n')
+        ln = self.getLine()
+        if ln is None or ln[:-2] not in JDLD_VERSIONS:
+            raise JtagDownloadError("jdld says it is version %s?? I was expecting %s" %
+                                    (ln[:-2] if ln else None, JDLD_VERSION))
+        jdldVersion = tuple(int(x) for x in ln[2:-2].split(b'.'))
+        # how many mailbox slots: only worth using if we're not waiting on every ack
+        slots = 1
+        if jdldVersion >= (1, 1) and self.pipeline:
+            sock.send(b'N\n')
+            ln = self.getLine()
+            if ln is not None and ln[:2] == b'N ':
+                slots = int(ln[2:-2])
+            if self.maxSlots > 0:
+                slots = min(slots, self.maxSlots)
+        if v > 0:
+            print("%s: using %d mailbox slot(s)" % (self.name, slots))
+        if ((self.resume and jdldVersion < (1, 2)) or (self.delta and jdldVersion < (1, 3)) or
+            (self.compress and jdldVersion < (1, 4))):
+            raise JtagDownloadError("--resume needs jdld 1.2 or later, --delta 1.3, --compress 1.4")
+        # create the remote file (or reopen it)
+        if self.resume or self.delta:
+            crCommand = b'R' + remoteFileBytes + b'\n'
+        else:
+            crCommand = b'C' + remoteFileBytes + b'\n'
+        sock.send(crCommand)
+        ln = self.getLine()
+        if ln is None or ln[:1] != JDLD_OK:
+            print("%s: maybe a previous transfer is borked - open terminal, run jc, then send \"D 0\"" % self.name)
+            raise JtagDownloadError("jdld did not respond OK to file create (%s)" % (ln[:-2] if ln else None))
+        resumeFrom = 0
+        # the chunks to send, and where jdld's going to write next
+        chunks = range(0, lfilesz // JDLD_CHUNK_SIZE + 1)
+        position = 0
+        if self.delta:
+            remoteSize, chunks = self.changedChunks(lfile)
+            if chunks is None:
+                raise JtagDownloadError("jdld did not respond OK to block hash")
+            print("%s: %d of %d chunks differ" % (self.name, len(chunks), ceil(lfilesz/JDLD_CHUNK_SIZE)))
+            position = remoteSize
+            if remoteSize != lfilesz:
+                self.command(b'S %d\n' % lfilesz, "seek")
+                position = lfilesz
+        elif self.resume:
+            resumeFrom = self.verifiedLength(lfile, int(ln[2:-2]), lfilesz)
+            print("%s: %d of %d bytes already there" % (self.name, resumeFrom, lfilesz))
+            # chop off anything after that
+            self.command(b'S %d\n' % resumeFrom, "seek")
+            chunks = [] if resumeFrom == lfilesz else range(resumeFrom // JDLD_CHUNK_SIZE, lfilesz // JDLD_CHUNK_SIZE + 1)
+            position = resumeFrom
+        # NOW IT'S FUN TIME
+        self.tick('setup')
+        self.chunkCount = 0
+        # Up the timeout, since it takes ~13 seconds per chunk
+        if isinstance(self.xsct, XsdbClient):
+            self.xsct.settimeout(30)
+        else:
+            self.xsct._socket.settimeout(30)
+        updateFn = self.progress if self.progress is not None else lambda x : None
 
-try:
-    if v > 0:
-        print('%s: fetching prompt' % prog)
-    sock.sendall(b'\n')
-    sock.settimeout(5)
-    msg = b''
-    while True:
-        try:
-            data = sock.recv(500)
-            msg += data
-            if v > 1:
-                print('%s: got %d bytes, up to %d' % (prog, len(data), len(msg)))
-            if (msg[-len(prompt):None] == prompt):
-                if args.safeStart:
-                    if v > 0:
-                        print('%s: found prompt after %d bytes, continuing due to safeStart'
-                              % (prog, len(msg)))
+        # In pipelined mode the next chunk's tempfile gets written while
+        # the current one is going over JTAG, and we don't stop to read
+        # jdld's K after each D: the acks just pile up in the socket and
+        # get checked right before a mailbox slot is needed again. With
+        # more than one slot (jdld 1.1) chunks go round-robin through them,
+        # so jdld copies chunk N out of one while dow N+1 fills the next.
+        tempfile = not self.stream
+        # in delta mode changedChunks already hashed the whole file, otherwise
+        # everything from here on gets hashed as it's read
+        sha = None if self.delta else self.sha
+        prefetch = ThreadPoolExecutor(max_workers=1) if self.pipeline and len(chunks) else None
+        self.prefetch = prefetch
+        if prefetch:
+            self.nextChunk = prefetch.submit(prepareChunk, lfile, chunks[0], self.compress, tempfile, sha)
+        # commands we've sent but haven't seen K for
+        pending = deque()
+        # a short chunk closes the file, otherwise we have to
+        closed = False
+        for i, chunkNum in enumerate(chunks):
+            if v > 0:
+                print("%s: starting chunk %d..." % (self.name, chunkNum), end='')
+            updateFn(chunkNum*JDLD_CHUNK_SIZE)
+            if prefetch:
+                payload, chunkLen, chunkCrc, compressed = self.nextChunk.result()
+                if i + 1 < len(chunks):
+                    self.nextChunk = prefetch.submit(prepareChunk, lfile, chunks[i+1], self.compress, tempfile, sha)
                 else:
-                    if v > 0:
-                        print('%s: found prompt after %d bytes'
-                              % (prog, len(msg)))
-                        break            
-        except socket.timeout:
+                    self.nextChunk = None
+            else:
+                payload, chunkLen, chunkCrc, compressed = prepareChunk(lfile, chunkNum, self.compress, tempfile, sha)
+            self.tick('prepare')
+            self.localCrcs[chunkNum] = chunkCrc
+            slot = self.chunkCount % slots
+            if chunkNum*JDLD_CHUNK_SIZE != position:
+                sock.send(b'P %d\n' % (chunkNum*JDLD_CHUNK_SIZE))
+                pending.append((chunkNum, None))
+            if chunkLen > 0:
+                mbox = int(JDLD_MAILBOX, 0) + slot*JDLD_CHUNK_SIZE
+                try:
+                    # this slot has to be free: everything up to its last use acked
+                    self.collectAcks(pending, slots-1)
+                    self.tick('acks')
+                    if self.stream:
+                        resp = self.xsct.mwr(mbox, payload)
+                    else:
+                        xsctCmd = 'dow -data %s 0x%x; set done "done"' % (translate_path(payload), mbox)
+                        resp = self.xsct.do(xsctCmd)
+                except XsdbError as e:
+                    resp = str(e)
+                finally:
+                    if tempfile:
+                        os.unlink(payload)
+                self.tick('mailbox')
+                if resp != 'done':
+                    self.abort = b'D0\n'+endfile
+                    raise JtagDownloadError("got response %s ????" % resp)
             if v > 0:
-                print('%s: timed out waiting for more data' % prog)
-            break
-    # did we get our prompt
-    if v > 1:
-        print("%s: got %d bytes - " % (prog, len(msg)))
-        print("{!r}".format(msg))
-    if msg[-len(prompt):None] == prompt:
-        if v > 0:
-            print("%s: found prompt, continuing" % prog)
-    else:
-        print("%s: did not find prompt, maybe try --safeStart?" % prog)
-        print("%s: got %d bytes - " % (prog, len(msg)))
-        print("{!r}".format(msg))
-        print("expected {!r}".format(prompt))
-        startStopUart(xsct, False)
-        exit(1)
+                print("downloaded...", end='')
+            dCommand = b'Z' if compressed else b'D'
+            if slots > 1:
+                dCommand += b'#' + bytes(str(slot), encoding='utf-8')
+            # Z gets its length from the header
+            if compressed:
+                dCommand += b'\n'
+            elif chunkLen != JDLD_CHUNK_SIZE:
+                dCommand += b' '+bytes(str(chunkLen), encoding='utf-8')+b'\n'
+            else:
+                dCommand += b'\n'
+            sock.send(dCommand)
+            pending.append((chunkNum, chunkCrc))
+            position = chunkNum*JDLD_CHUNK_SIZE + chunkLen
+            self.collectAcks(pending, slots if self.pipeline else 0)
+            self.tick('acks')
+            if v > 0:
+                print("complete.")
+            self.chunkCount = self.chunkCount + 1
+            if chunkLen != JDLD_CHUNK_SIZE:
+                closed = True
+                break
 
-    # execute the bridge
-    sock.sendall(b'jb\n')
-    getExpected(sock, b'jb\r\n')
-    sock.sendall(b'V\n')
-    ln = getLine(sock)
-    if ln[:-2] != JDLD_VERSION:
-        print("%s: jdld says it is version %s??" % (prog, ln[:-2]))
-        print("%s: I was expecting %s" % (prog, JDLD_VERSION))
-        sock.sendall(endfile)
-        startStopUart(xsct, False)
-        exit(1)
-    # create the remote file
-    crCommand = b'C' + remoteFileBytes + b'\n'
-    sock.sendall(crCommand)
-    ln = getLine(sock)
-    if ln[:-2] != JDLD_OK:
-        print("%s: jdld did not respond OK to file create (%s)" % (prog, ln[:-2]))
-        print("%s: maybe a previous transfer is borked - open terminal, run jc, then send \"D 0\"" % prog)
-        sock.sendall(endfile)
-        sock.close()
-        startStopUart(xsct, False)
+        # last one
+        self.collectAcks(pending, 0)
+        if not closed:
+            sock.send(b'F\n')
+            self.getLine()
+        updateFn(lfilesz)
+        self.tick('acks')
+        # what's actually in the file now, according to jdld
+        changed = self.remoteCrcs(jdldVersion) if self.verify else None
+        sock.send(endfile)
+        self.abort = None
+        # clear out the prompt
+        if not sock.expect(b'jc: exiting\r\n' + sock.prompt):
+            raise JtagDownloadError("jdld didn't exit cleanly: %r" % bytes(sock.buf))
+        self.tick('verify' if self.verify else 'setup')
+        if self.verify:
+            sha = self.sha
+            remoteSha = self.remoteSha256()
+            if changed:
+                for start, end in badRanges(changed, JDLD_CHUNK_SIZE, lfilesz):
+                    print("%s: bytes %d-%d differ" % (self.name, start, end-1))
+            if remoteSha is None:
+                print("%s: couldn't get the remote SHA-256" % self.name)
+            elif remoteSha != sha.hexdigest():
+                print("%s: SHA-256 MISMATCH: remote %s local %s" % (self.name, remoteSha, sha.hexdigest()))
+            if changed or remoteSha != sha.hexdigest():
+                raise JtagDownloadError("verify failed, rerun with --delta to fix it up")
+            print("%s: verified: SHA-256 %s" % (self.name, remoteSha))
+            self.tick('verify')
+
+def main():
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("localFile", help="local filename to transfer")
+    parser.add_argument("remoteFile", help="remote filename")
+    parser.add_argument("--also", nargs=2, action='append', default=[], metavar=("LOCAL", "REMOTE"),
+                        help="another file to send afterwards over the same terminal (repeatable)")
+    parser.add_argument("--xsdb", help="xsdb binary",
+                        default="xsdb")
+    parser.add_argument("--port", help="if specified, use xsdb already running xsdbserver.tcl at this port "
+                        "(a plain xsdbserver start works too, but then chunks go through dow)",
+                        default="")
+    parser.add_argument("--connect", help="string to pass after connect if spawning xsdb",
+                        default="")
+    parser.add_argument("--target", default="",
+                        help="extra xsdb target filter to pick the board, e.g. 'jtag_cable_serial == \"1234\"'")
+    parser.add_argument("--verbose", "-v", action="count", default=0,
+                        help="Increase verbosity")
+    parser.add_argument("--mode", help="either pynq or surf (default)",
+                        default="surf")
+    parser.add_argument("--safeStart",action='store_true',
+                        help="Try to read out all characters possible before starting (takes 5+ seconds)")
+    parser.add_argument("--pysct", help="use pysct (at this path) to talk to xsct instead")
+    parser.add_argument("--dow", action='store_true',
+                        help="send chunks with dow from tempfiles instead of mwr over the xsdb socket")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="prepare the next chunk during each dow and check jdld's acks lazily")
+    parser.add_argument("--resume", action='store_true',
+                        help="keep the chunks of remoteFile which are already right and send the rest (needs jdld 1.2)")
+    parser.add_argument("--delta", action='store_true',
+                        help="only send the chunks which differ from what's already in remoteFile (needs jdld 1.3)")
+    parser.add_argument("--compress", action='store_true',
+                        help="zlib-compress chunks which shrink, jdld inflates them (needs jdld 1.4)")
+    parser.add_argument("--slots", type=int, default=0,
+                        help="with --pipeline, use at most this many jdld mailbox slots (default: all it has)")
+    parser.add_argument("--verify", action='store_true',
+                        help="afterwards, check the remote file with jdld's CRCs and sha256sum")
+
+    args = parser.parse_args()
+    if args.pysct:
+        sys.path.append(args.pysct)
+        # now import
+        from pysct.core import Xsct
+
+    v = args.verbose
+    if args.mode not in PROFILES:
+        print("%s: don't know mode %s" % (prog, args.mode))
         exit(1)
-    # NOW IT'S FUN TIME
-    chunkCount = 0
-    # Up the timeout, since it takes ~13 seconds per chunk
-    xsct._socket.settimeout(30)
-    # PRETTY PRETTY
-    if pb is not None:
-        bar_widget = None
-        try:
-            bar_widget = pb.GranularBar()
-        except:
-            bar_widget = pb.Bar()
-        widgets = widgets = [ args.remoteFile  + ":",
-                              ' ', pb.Percentage(),
-                              ' ', bar_widget,
-                              ' ', pb.AdaptiveETA(),
-                              ' ', pb.AdaptiveTransferSpeed() ]
-        bar = pb.ProgressBar( widgets=widgets,
-                              max_value=lfilesz,
-                              redirect_stdout=True).start()
-        updateFn = lambda x : bar.update(x)
-        finishFn = lambda : bar.finish()
-    else:
-        updateFn = lambda x : print(x)
-        finishFn = lambda : None
 
-    while True:
-        if v > 0:
-            print("starting chunk %d..." % chunkCount, end='')
-        updateFn(chunkCount*JDLD_CHUNK_SIZE)
-        chunk = lfile.read(JDLD_CHUNK_SIZE)
-        chunkLen = len(chunk)
-        if chunkLen > 0:
-            # try using the tempfile in a context manager
-            # goddamnit screw you windows
-            tf = NamedTemporaryFile(delete=False)
-            tf.write(chunk)
-            tf.flush()
-            fn = translate_path(tf.name)
-            tf.close()
-            xsctCmd = 'dow -data %s %s; set done "done"' % (fn, JDLD_MAILBOX)
-            resp = xsct.do(xsctCmd)
-            os.unlink(tf.name)
-            if resp != 'done':
-                print("%s: got response %s ????" % (prog, resp))
-                sock.sendall(b'D0\n'+endfile)
-                sock.close()
-                startStopUart(xsct, False)
-                exit(1)
-        if v > 0:
-            print("downloaded...", end='')
-        if chunkLen != JDLD_CHUNK_SIZE:
-            dCommand = b'D '+bytes(str(chunkLen), encoding='utf-8')+b'\n'
-        else:
-            dCommand = b'D\n'
-        sock.sendall(dCommand)
-        ln = getLine(sock)
-        if ln[:-2] != JDLD_OK:
-            print("%s: jdld did not respond OK to chunk download (%s)!" % (prog, ln[:-2]))
-            sock.sendall(endfile)
-            sock.close()
-            startStopUart(xsct, False)
+    print(args.xsdb)
+    host = 'localhost'
+
+    # connect to the xsct/xsdb server
+    if args.pysct:
+        if not args.port:
+            print("%s: pysct needs --port" % prog)
             exit(1)
-        if v > 0:
-            print("complete.")
-        chunkCount = chunkCount + 1
-        if chunkLen != JDLD_CHUNK_SIZE:
-            break
-
-    finishFn()
-    lfile.close()
-    print("%s: Download successful after %d chunks" % (prog, chunkCount))
-    sock.sendall(endfile)
-    # clear out the prompt
-    ln = getExpected(sock, b'jc: exiting\r\n'+prompt)
-    sock.close()
-    startStopUart(xsct, False)
-finally:
-    print("%s : exiting." % prog)
-    
+        xsct = Xsct(host, int(args.port))
+    else:
+        try:
+            if args.port:
+                xsct = XsdbClient(host, int(args.port))
+            else:
+                if v > 0:
+                    print("%s: launching %s" % (prog, args.xsdb))
+                xsct = XsdbClient.launch(args.xsdb, args.connect)
+        except (OSError, XsdbError) as e:
+            print("%s: can't talk to xsdb: %s" % (prog, e))
+            exit(1)
+
+    files = [ (args.localFile, args.remoteFile) ] + [ tuple(f) for f in args.also ]
+    session = None
+    try:
+        # one terminal for all of them
+        if len(files) > 1:
+            session = openTerminal(xsct, args.mode, args.target, host, args.safeStart, v)
+        for localFile, remoteFile in files:
+            # PRETTY PRETTY
+            if pb is not None and os.path.exists(localFile):
+                bar_widget = None
+                try:
+                    bar_widget = pb.GranularBar()
+                except:
+                    bar_widget = pb.Bar()
+                widgets = widgets = [ remoteFile  + ":",
+                                      ' ', pb.Percentage(),
+                                      ' ', bar_widget,
+                                      ' ', pb.AdaptiveETA(),
+                                      ' ', pb.AdaptiveTransferSpeed() ]
+                bar = pb.ProgressBar( widgets=widgets,
+                                      max_value=os.path.getsize(localFile),
+                                      redirect_stdout=True).start()
+                updateFn = lambda x : bar.update(x)
+                finishFn = lambda : bar.finish()
+            else:
+                updateFn = lambda x : print(x)
+                finishFn = lambda : None
+
+            # pysct only does dow, and only from files
+            dl = JtagDownload(xsct, localFile, remoteFile,
+                              mode=args.mode,
+                              target=args.target,
+                              stream=not args.pysct and not args.dow,
+                              pipeline=args.pipeline,
+                              resume=args.resume,
+                              delta=args.delta,
+                              compress=args.compress,
+                              slots=args.slots,
+                              safeStart=args.safeStart,
+                              verify=args.verify,
+                              host=host,
+                              verbose=v,
+                              progress=updateFn,
+                              session=session)
+            chunkCount = dl.run()
+            finishFn()
+            print("%s: Download of %s successful after %d chunks" % (prog, remoteFile, chunkCount))
+            if v > 0:
+                print("%s: %s" % (prog, ', '.join('%s %.2f s' % t for t in dl.timings.items())))
+    except (JtagDownloadError, XsdbError) as e:
+        print("%s: %s" % (prog, e))
+        exit(1)
+    finally:
+        if session is not None:
+            try:
+                closeTerminal(xsct, session, args.target)
+            except (OSError, XsdbError):
+                pass
+        if not args.pysct:
+            xsct.close()
+        print("%s : exiting." % prog)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# A jtag terminal connection that keeps track of the prompt, shared by
+# jdownload and jtransfer.
+#
+# s = JtagTerminalSession('localhost', port, 'surf')
+# if s.sync():
+#     print(s.run(b'uname -a'))
+#
+# Everything received goes into one bytearray and gets consumed off the
+# front as it's matched, and searches pick up where the last one left
+# off, so waiting on a long banner (or a lot of echoes) doesn't redo the
+# same comparisons every time another 500 bytes shows up.
+#
+# The session stays open as long as you like: sync() once, then send as
+# many files (or run as many commands) as you want through it.
+from collections import namedtuple
+import re
+import socket
+
+# what the shell looks like. prompt is what it ends with: bash 5.1+
+# (pynq) wraps it in bracketed paste on/off, the PetaLinux ones don't.
+PromptProfile = namedtuple('PromptProfile', 'prompt beginPrompt endcmd newline')
+
+PROFILES = { 'pynq' : PromptProfile(b'xilinx@pynq:~$ ', b'\x1b[?2004h', b'\x1b[?2004l\r', b'\r\n'),
+             'surf' : PromptProfile(b'root@SURFv6:~# ', b'', b'', b'\r\n'),
+             'turf' : PromptProfile(b'root@TURFv6:~# ', b'', b'', b'\r\n') }
+
+def profile(mode, prompt=None):
+    """ PROFILES[mode], with the prompt text swapped for prompt (no trailing space) if given """
+    p = PROFILES[mode]
+    if prompt is not None:
+        p = p._replace(prompt=bytes(prompt, encoding='utf-8') + b' ')
+    return p
+
+class JtagTerminalSession:
+    """ Socket to a jtag terminal with a receive buffer and prompt/echo matching. """
+    def __init__(self, host, port, mode='surf', timeout=5, verbose=0, name='jtagsession'):
+        """ mode is a PROFILES key or a PromptProfile. name prefixes messages """
+        self.profile = PROFILES[mode] if isinstance(mode, str) else mode
+        # what a prompt really ends with
+        self.prompt = self.profile.beginPrompt + self.profile.prompt
+        self.newline = self.profile.newline
+        self.endcmd = self.profile.endcmd
+        self.v = verbose
+        self.name = name
+        self.buf = bytearray()
+        self.sock = socket.create_connection((host, port))
+        self.sock.settimeout(timeout)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def fill(self, size=4096):
+        """ receive whatever's there into the buffer. False on timeout """
+        try:
+            data = self.sock.recv(size)
+        except socket.timeout:
+            return False
+        if not data:
+            raise ConnectionError("jtag terminal closed the connection")
+        self.buf.extend(data)
+        if self.v > 1:
+            print('%s: got %d bytes, up to %d' % (self.name, len(data), len(self.buf)))
+        return True
+
+    def take(self, n):
+        """ pull n bytes off the front of the buffer """
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def readUntil(self, match, lookback=256):
+        """ read until match (bytes, or a compiled regex which can't match more than
+            lookback bytes), returns everything up to and including it, or None on timeout
+            (what was read stays in the buffer) """
+        scanned = 0
+        while True:
+            if isinstance(match, bytes):
+                idx = self.buf.find(match, max(0, scanned - len(match) + 1))
+                end = idx + len(match) if idx >= 0 else -1
+            else:
+                m = match.search(self.buf, max(0, scanned - lookback))
+                end = m.end() if m else -1
+            if end >= 0:
+                return self.take(end)
+            scanned = len(self.buf)
+            if not self.fill():
+                return None
+
+    def readLine(self):
+        """ read through the next \\n, None on timeout """
+        return self.readUntil(b'\n')
+
+    def expect(self, expected):
+        """ the next bytes have to be exactly expected. True if they are, False if they're
+            not or don't show up (the buffer's left alone then) """
+        n = len(expected)
+        while True:
+            have = min(n, len(self.buf))
+            if self.buf[:have] != expected[:have]:
+                return False
+            if have == n:
+                del self.buf[:n]
+                return True
+            if not self.fill():
+                return False
+
+    # once there's a prompt, how long it has to stay quiet for us to believe it
+    # (there might be one already waiting, and then another for our newline)
+    SETTLE = 0.25
+
+    def sync(self, safeStart=False):
+        """ poke the shell and wait for a prompt. with safeStart keep reading everything
+            it has until it goes quiet. True if the last thing we got was a prompt """
+        if self.v > 0:
+            print('%s: fetching prompt' % self.name)
+        # note that it's also going to convert \n to \r\n
+        self.send(b'\n')
+        timeout = self.gettimeout()
+        try:
+            while True:
+                if not self.fill():
+                    if self.v > 0:
+                        print('%s: timed out waiting for more data' % self.name)
+                    break
+                if self.buf.endswith(self.prompt):
+                    if self.v > 0:
+                        print('%s: found prompt after %d bytes%s' %
+                              (self.name, len(self.buf), ', continuing due to safeStart' if safeStart else ''))
+                    if not safeStart:
+                        self.settimeout(self.SETTLE)
+        finally:
+            self.settimeout(timeout)
+        found = self.buf.endswith(self.prompt)
+        if not found:
+            print("%s: got %d bytes - " % (self.name, len(self.buf)))
+            print("{!r}".format(bytes(self.buf)))
+            print("expected {!r}".format(self.prompt))
+        elif self.v > 1:
+            print("%s: got %d bytes - " % (self.name, len(self.buf)))
+            print("{!r}".format(bytes(self.buf)))
+        self.buf.clear()
+        return found
+
+    def command(self, cmd):
+        """ send a command line and eat its echo. False if the echo's wrong """
+        self.send(cmd + b'\n')
+        # bash ends every command we send with endcmd
+        return self.expect(cmd + self.newline + self.endcmd)
+
+    def waitPrompt(self):
+        """ everything up to the next prompt (not including it), None on timeout """
+        out = self.readUntil(self.prompt)
+        return out[:-len(self.prompt)] if out is not None else None
+
+    def run(self, cmd, timeout=None):
+        """ run cmd at the prompt, returns everything up to the next prompt, None if it never
+            comes back. that includes the echo: long commands get wrapped by readline, so
+            it's not worth trying to match it exactly """
+        old = self.gettimeout()
+        if timeout is not None:
+            self.settimeout(timeout)
+        try:
+            self.send(cmd + b'\n')
+            return self.waitPrompt()
+        finally:
+            self.settimeout(old)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,116 @@
+# Minimal xsdb client for jdownload, so it doesn't need pysct.
+#
+# Talks to xsdbserver.tcl running inside xsdb: one line of Tcl per
+# request, answered with "okay <result>" or "error <message>" and a
+# \x1a terminator.
+#
+# xsdb = XsdbClient('localhost', 4567)
+# print(xsdb.do('targets'))
+# xsdb.mwr(0x70000000, data)
+#
+# XsdbClient.launch() starts xsdb with the server script itself and
+# connects to it.
+#
+# xsdb's own server (xsdbserver start) frames things the same way, so
+# this talks to that too, except for mwr(): jdl_mwr only exists in
+# xsdbserver.tcl, so check canStream() first.
+import os
+import socket
+import subprocess
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xsdbserver.tcl')
+
+class XsdbError(Exception):
+    """ xsdb didn't like a command (or never answered). """
+    pass
+
+class XsdbClient:
+    """ Sends Tcl commands to a running xsdbserver.tcl and parses the replies. """
+    EOM = b'\x1a'
+
+    def __init__(self, host='localhost', port=4567, timeout=10, proc=None):
+        """ proc is the xsdb subprocess if we started it, so close() can stop it """
+        self.proc = proc
+        self.rx = bytearray()
+        # whether the server has jdl_mwr, once we've asked
+        self.streams = None
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.settimeout(timeout)
+
+    @classmethod
+    def launch(cls, xsdb='xsdb', connect='', port=0, timeout=10, startup=30):
+        """ start xsdb running the server script and connect to it. connect is what goes
+            after xsdb's connect command. port 0 picks a free one. waits up to startup
+            seconds for xsdb to come up """
+        if not port:
+            s = socket.socket()
+            s.bind(('localhost', 0))
+            port = s.getsockname()[1]
+            s.close()
+        proc = subprocess.Popen([xsdb, SERVER_SCRIPT, str(port)] + connect.split())
+        giveUp = time.monotonic() + startup
+        while True:
+            try:
+                return cls('localhost', port, timeout, proc)
+            except OSError:
+                if proc.poll() is not None:
+                    raise XsdbError("xsdb exited (code %d) before starting the server" % proc.returncode)
+                if time.monotonic() > giveUp:
+                    proc.terminate()
+                    raise XsdbError("xsdb server didn't show up on port %d" % port)
+                time.sleep(0.2)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def _reply(self):
+        while True:
+            idx = self.rx.find(self.EOM)
+            if idx >= 0:
+                break
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                raise XsdbError("timed out waiting for xsdb")
+            if not data:
+                raise XsdbError("xsdb closed the connection")
+            self.rx.extend(data)
+        msg = self.rx[:idx].decode('utf-8', 'replace')
+        del self.rx[:idx+1]
+        status, _, result = msg.partition(' ')
+        if status == 'okay':
+            return result
+        raise XsdbError(result if status == 'error' else msg)
+
+    def do(self, cmd):
+        """ run a Tcl command in xsdb, returns its result (XsdbError if it fails) """
+        # one line per command
+        self.sock.sendall(cmd.replace('\n', ';').encode('utf-8') + b'\n')
+        return self._reply()
+
+    def canStream(self):
+        """ True if the server is xsdbserver.tcl, which takes jdl_mwr. anything else would
+            try to run the raw data as Tcl """
+        if self.streams is None:
+            self.streams = self.do('info commands jdl_mwr').strip() == 'jdl_mwr'
+        return self.streams
+
+    def mwr(self, addr, data):
+        """ write data to memory at addr, straight over the socket. returns 'done'.
+            needs xsdbserver.tcl (see canStream) """
+        if not self.canStream():
+            raise XsdbError("xsdb server has no jdl_mwr, is it running xsdbserver.tcl?")
+        pad = -len(data) % 4
+        if pad:
+            data = bytes(data) + b'\x00'*pad
+        self.sock.sendall(b'jdl_mwr 0x%x %d\n' % (addr, len(data)))
+        self.sock.sendall(data)
+        return self._reply()
+
+    def close(self):
+        self.sock.close()
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
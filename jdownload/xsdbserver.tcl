@@ -0,0 +1,64 @@
+# xsdbserver.tcl: tiny command server so jdownload can drive xsdb
+# without pysct.
+#
+# xsdb xsdbserver.tcl <port> [connect arguments]
+#
+# Each request is one line of Tcl, evaluated at global level. The reply
+# is "okay <result>" or "error <message>", terminated by \x1a.
+#
+# jdl_mwr <address> <nbytes> is special: it's followed by nbytes of raw
+# data (a multiple of 4) straight after the newline, which gets written
+# to memory starting at address with mwr. That way chunks never have to
+# go through a file. It replies "okay done".
+
+set jdl_eom "\x1a"
+
+proc jdl_reply {chan status result} {
+    global jdl_eom
+    puts -nonewline $chan "$status $result$jdl_eom"
+    flush $chan
+}
+
+proc jdl_mwr {chan addr nbytes} {
+    set data [read $chan $nbytes]
+    if {[string length $data] != $nbytes} {
+        error "short data: got [string length $data] of $nbytes bytes"
+    }
+    binary scan $data iu* words
+    mwr $addr $words [llength $words]
+    return "done"
+}
+
+proc jdl_handle {chan} {
+    if {[gets $chan line] < 0} {
+        if {[eof $chan]} {
+            close $chan
+        }
+        return
+    }
+    set line [string trimright $line "\r"]
+    if {[string match "jdl_mwr *" $line]} {
+        set rc [catch {jdl_mwr $chan [lindex $line 1] [lindex $line 2]} result]
+    } else {
+        set rc [catch {uplevel #0 $line} result]
+    }
+    if {$rc == 1} {
+        jdl_reply $chan error $result
+    } else {
+        jdl_reply $chan okay $result
+    }
+}
+
+proc jdl_accept {chan addr port} {
+    fconfigure $chan -translation binary -blocking 1 -buffering full
+    fileevent $chan readable [list jdl_handle $chan]
+}
+
+set jdl_port 4567
+if {[llength $argv] > 0} {
+    set jdl_port [lindex $argv 0]
+}
+connect {*}[lrange $argv 1 end]
+socket -server jdl_accept -myaddr localhost $jdl_port
+puts "xsdbserver: listening on port $jdl_port"
+vwait forever
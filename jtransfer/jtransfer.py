@@ -1,22 +1,42 @@
-
 # why did I ever create this program
 # - this script transfers a file via a jtagterminal spawned by
 #   Xilinx's debug stuff (xsct/xsdb).
+# - it needs jtagsession.py from jdownload/ for the terminal: either
+#   run it from the checkout (it looks in ../jdownload) or copy
+#   jtagsession.py next to it/somewhere on PYTHONPATH.
 
-import socket
 import sys
 import argparse
 import os
+import base64
+import hashlib
+import re
+from collections import deque
+
+# the terminal session lives with jdownload
+try:
+    from jtagsession import JtagTerminalSession, profile
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jdownload'))
+    try:
+        from jtagsession import JtagTerminalSession, profile
+    except ImportError:
+        sys.exit("jtransfer.py: can't find jtagsession.py: copy jdownload/jtagsession.py next to jtransfer.py")
 
 prog = "jtransfer.py"
 
 defaultHost = "localhost"
 defaultPrompt = "xilinx@pynq:~$"
+# the tty only holds a 4096 character line (and not a lot more than that
+# in flight before it starts dropping stuff), so stay under it
+maxLineChars = 4000
 
 parser = argparse.ArgumentParser(prog=prog)
 parser.add_argument("localFile", help="local filename to transfer")
 parser.add_argument("remoteFile", help="remote filename")
 parser.add_argument("port", help="JTAG terminal port",type=int)
+parser.add_argument("--also", nargs=2, action='append', default=[], metavar=("LOCAL", "REMOTE"),
+                    help="another file to send afterwards over the same terminal (repeatable)")
 parser.add_argument("--host", help="Host of the JTAG terminal (default: {})".format(defaultHost),
                     default=defaultHost)
 parser.add_argument("--prompt", help="bash prompt to expect (default: {})".format(defaultPrompt),
@@ -25,6 +45,16 @@ parser.add_argument("--safeStart",action='store_true',
                     help="Try to read out all characters possible before starting (takes 5+ seconds)")
 parser.add_argument("--verbose", "-v", action="count", default=0,
                     help="Increase verbosity")
+parser.add_argument("--line", type=int, default=16,
+                    help="bytes of the file per line sent (default 16)")
+parser.add_argument("--window", type=int, default=1,
+                    help="lines to send before waiting for the first one's echo (default 1, lock-step)")
+parser.add_argument("--base64", action='store_true',
+                    help="send base64 and decode with base64 -d instead of hex through xxd -r -p")
+parser.add_argument("--verify", action='store_true',
+                    help="check the file that landed with sha256sum, and find which parts are wrong if it doesn't match")
+parser.add_argument("--verifyBlock", type=int, default=65536,
+                    help="block size (bytes) for finding the bad parts (default 65536)")
 
 args = parser.parse_args()
 
@@ -32,173 +62,191 @@ v = args.verbose
 port = args.port
 host = args.host
 
-# check filename
-if not os.path.isfile(args.localFile):
-    print("%s: local file does not exist?" % prog)
-    exit(1)
-    
-localFileSize = os.path.getsize(args.localFile)
-localFile = open(args.localFile, "rb")
-
-
-newline = b'\r\n'
-# bash ends every command we send with this
-# it does NOT end every LINE we send with this
-endcmd = b'\x1b[?2004l\r'
-# prompt - note we're assuming home dir
-beginprompt = b'\x1b[?2004h'
-prompt = beginprompt + bytes(args.prompt, encoding='utf-8') + b' '
+files = [ (args.localFile, args.remoteFile) ] + [ tuple(f) for f in args.also ]
+# check filenames
+for localFile, _ in files:
+    if not os.path.isfile(localFile):
+        print("%s: local file %s does not exist?" % (prog, localFile))
+        exit(1)
+
+# base64 lines have to be whole 3-byte groups, or there'd be = in the middle
+if args.base64:
+    lineBytes = max(3, args.line - args.line % 3)
+    lineBytes = min(lineBytes, maxLineChars//4*3)
+    encode = base64.b64encode
+else:
+    lineBytes = min(max(1, args.line), maxLineChars//2)
+    encode = lambda x : bytes(x.hex(), 'utf-8')
+window = max(1, args.window)
+lineChars = len(encode(bytes(lineBytes))) + 1
+if window*lineChars > 4096:
+    print("%s: warning: %d lines of %d characters in flight might overflow the terminal" %
+          (prog, window, lineChars))
+
+# bash on the pynq: prompt is wrapped in bracketed paste on, every
+# command we send ends with bracketed paste off (but not every LINE)
+# - note we're assuming home dir
+shell = profile('pynq', args.prompt)
+newline = shell.newline
 # this is EOT
 endfile = b'\n\x04'
 
-# create TCP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_address = (host, port)
-if v > 0:
-    print('%s: connecting to %s port %d' % (prog, host, port))
-sock.connect(server_address)
-
 # the way jtransfer works is by using xxd in reverse
 # mode. the command line is
 # xxd -r -p - $fileName
 # then we send lines of 16 hex digits (32 characters)
 # syncing up requires looking for the prompt
 # then after sending the command, we look for the echo,
-# 
-try:
-    if v > 0:
-        print('%s: fetching prompt' % prog)
-    # note that it's also going to convert \n to \r\n
-    message = b'\n'
-    sock.sendall(message)
-    # this timeout sucks but it's kinda necessary
-    sock.settimeout(5)
-    msg = b''
-    while True:
-        try:        
-            data = sock.recv(500)
-            msg += data
-            if v > 1:
-                print('%s: got %d bytes, up to %d' %
-                      (prog, len(data), len(msg)))
-            if (msg[-len(prompt):None] == prompt):
-                if args.safeStart:
-                    if v > 0:
-                        print('%s: found prompt after %d bytes, continuing due to safeStart'
-                              % (prog, len(msg)))
-                else:
-                    if v > 0:
-                        print('%s: found prompt after %d bytes'
-                              % (prog, len(msg)))
-                        break            
-        except socket.timeout:
-            if v > 0:
-                print('%s: timed out waiting for more data' % prog)
-            break
-    # did we get our prompt
-    if v > 1:
-        print("%s: got %d bytes - " % (prog, len(msg)))
-        print("{!r}".format(msg))
-    if msg[-len(prompt):None] == prompt:
-        if v > 0:
-            print("%s: found prompt, continuing" % prog)
-    else:
-        print("%s: did not find prompt, maybe try --safeStart?" % prog)
-        print("%s: got %d bytes - " % (prog, len(msg)))
-        print("{!r}".format(msg))
-        exit(1)
-    # now we can shorten it
-    sock.settimeout(1)
+#
+# with --window N we don't wait for each line's echo before sending the
+# next: up to N lines are out at once, and the echoes get checked as
+# they come back (they come back in order, so it's just matching them
+# off the front). with --line the lines get longer, and --base64 sends
+# base64 to base64 -d instead of hex, which is 3/4 the characters of hex.
+
+def collectEchoes( session, outstanding, keep ):
+    """ read echoes until at most keep lines in outstanding (chunk number, expected echo) are unmatched """
+    while len(outstanding) > keep:
+        chunk, expect = outstanding[0]
+        if not session.expect(expect):
+            print("%s: echo for chunk %d doesn't match (or never came)!" % (prog, chunk))
+            print("{!r}".format(expect))
+            print("{!r}".format(bytes(session.buf[:len(expect)])))
+            return False
+        outstanding.popleft()
+    return True
+
+def badRanges( localHashes, remoteHashes, blockSize, size ):
+    """ merge the blocks whose hashes differ into (start, end) byte ranges """
+    ranges = []
+    for i, h in enumerate(localHashes):
+        if i < len(remoteHashes) and remoteHashes[i] == h:
+            continue
+        start, end = i*blockSize, min(size, (i+1)*blockSize)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def verifyRemote( session, localFile, rFn, localSha ):
+    """ compare sha256sum of the remote file with ours, and narrow it down if it's wrong """
+    rsp = session.run(b'sha256sum ' + rFn, 60)
+    m = re.search(rb'([0-9a-f]{64})\s+' + re.escape(rFn), rsp) if rsp is not None else None
+    if m is None:
+        print("%s: couldn't get the remote SHA-256" % prog)
+        return False
+    if m.group(1).decode() == localSha.hexdigest():
+        print("%s: verified: SHA-256 %s" % (prog, localSha.hexdigest()))
+        return True
+    print("%s: SHA-256 MISMATCH: remote %s local %s" % (prog, m.group(1).decode(), localSha.hexdigest()))
+    # hash each block out there: dumb but it works with busybox
+    bs = args.verifyBlock
+    localFileSize = os.path.getsize(localFile)
+    nblocks = (localFileSize + bs - 1)//bs
+    cmd = (b'i=0; while [ $i -lt %d ]; do dd if=%s bs=%d skip=$i count=1 2>/dev/null | sha256sum; i=$((i+1)); done'
+           % (nblocks, rFn, bs))
+    rsp = session.run(cmd, 60 + nblocks)
+    if rsp is None:
+        print("%s: never got the prompt back after hashing blocks" % prog)
+        return False
+    remoteHashes = [ h.decode() for h in re.findall(rb'([0-9a-f]{64})\s+-', rsp) ]
+    localHashes = []
+    with open(localFile, "rb") as f:
+        while True:
+            block = f.read(bs)
+            if not block:
+                break
+            localHashes.append(hashlib.sha256(block).hexdigest())
+    for start, end in badRanges(localHashes, remoteHashes, bs, localFileSize):
+        print("%s: bytes %d-%d differ" % (prog, start, end-1))
+    return False
+
+def sendFile( session, localFileName, remoteFile ):
+    """ send one file through the terminal (sitting at a prompt). True if it worked """
+    localFileSize = os.path.getsize(localFileName)
+    localFile = open(localFileName, "rb")
 
     # construct message
-    rFn = bytes(args.remoteFile, encoding='utf-8')
-    command = b'xxd -r -p - ' + rFn
-    # add newline...
-    message = command + b'\n'
-    # but expect \r\n plus newline + endcmd
-    expectedEcho = command + newline + endcmd
+    rFn = bytes(remoteFile, encoding='utf-8')
+    if args.base64:
+        command = b'base64 -d > ' + rFn
+    else:
+        command = b'xxd -r -p - ' + rFn
     if v > 0:
         print("%s: sending %s" % (prog, str(command)))
-    sock.sendall(message)
-
-    if v > 0:
-        print("%s: finding echo" % prog)
-    msg = b''
-    while True:
-        try:
-            data = sock.recv(500)
-            msg += data
-            if v > 1:
-                print('%s: got %d bytes, up to %d' %
-                      (prog, len(data), len(msg)))
-            if msg == expectedEcho:
-                break
-        except socket.timeout:
-            print("%s: never received echo before timeout??" % prog)
-            print("{!r}".format(expectedEcho))
-            print("{!r}".format(msg))
-            # send EOT to be safe
-            sock.sendall(endfile)
-            exit(1)
-    nchunks = int(localFileSize/16) + (1 if (localFileSize % 16) else 0)
+    # expect \r\n plus newline + endcmd back
+    if not session.command(command):
+        print("%s: never received echo before timeout??" % prog)
+        print("{!r}".format(command + newline + shell.endcmd))
+        print("{!r}".format(bytes(session.buf)))
+        # send EOT to be safe
+        session.send(endfile)
+        return False
+    nchunks = int(localFileSize/lineBytes) + (1 if (localFileSize % lineBytes) else 0)
     if v > 0:
-        print('%s: found echo, sending file (%d chunks)' % (prog, nchunks))    
-
+        print('%s: found echo, sending file (%d chunks)' % (prog, nchunks))
+
+    # lines sent but not echoed yet
+    outstanding = deque()
+    # what the whole file should hash to
+    localSha = hashlib.sha256()
+    # progress every line is a lot of printing with big windows
+    every = 1 if window == 1 else max(1, nchunks//100)
     curChunk = 0
     while True:
-        print('%s: chunk %d / %d' % (prog, curChunk, nchunks))
-        line = localFile.read(16)
+        if curChunk % every == 0:
+            print('%s: chunk %d / %d' % (prog, curChunk, nchunks))
+        line = localFile.read(lineBytes)
         if line == b'':
             break
-        hexStr = bytes(line.hex(), 'utf-8')
-        hexMsg = hexStr + b'\n'
-        expectedEcho = hexStr + newline
+        localSha.update(line)
+        lineStr = encode(line)
         if v > 2:
-            print('%s: sending %s' % (prog, line.hex()))
-        sock.sendall(hexMsg)
-        msg = b''
-        while True:
-            try:
-                data = sock.recv(500)
-                msg += data
-                if v > 1:
-                    print('%s: got %d bytes, up to %d' %
-                          (prog, len(data), len(msg)))
-                if msg == expectedEcho:
-                    if v > 2:
-                        print('{!r}'.format(msg))
-                    break
-            except socket.timeout:
-                print("%s: never received echo before timeout???" % prog)
-                print("{!r}".format(expectedEcho))
-                print("{!r}".format(msg))
-                # send EOT to be safe
-                sock.sendall(endfile)
-                exit(1)
+            print('%s: sending %s' % (prog, lineStr.decode()))
+        session.send(lineStr + b'\n')
+        outstanding.append((curChunk, lineStr + newline))
+        if not collectEchoes(session, outstanding, window-1):
+            # send EOT to be safe
+            session.send(endfile)
+            return False
         curChunk = curChunk + 1
+    localFile.close()
+    if not collectEchoes(session, outstanding, 0):
+        session.send(endfile)
+        return False
     if v > 0:
         print("%s: file send complete, sending EOT" % prog)
-    sock.sendall(endfile)
+    session.send(endfile)
+
+    if not session.expect(newline + session.prompt):
+        print("%s: never received prompt after EOT???" % prog)
+        print("{!r}".format(newline + session.prompt))
+        print("{!r}".format(bytes(session.buf)))
+        return False
+    print("%s: transfer of %s complete" % (prog, remoteFile))
+    if args.verify and not verifyRemote(session, localFileName, rFn, localSha):
+        return False
+    return True
 
-    msg = b''
-    expectedEcho = newline + prompt
-    while True:
-        try:        
-            data = sock.recv(500)
-            msg += data
-            if v > 1:
-                print('%s: got %d bytes, up to %d' %
-                      (prog, len(data), len(msg)))
-            if msg == expectedEcho:
-                break
-        except socket.timeout:
-            print("%s: never received prompt after EOT???" % prog)
-            print("{!r}".format(expectedEcho))
-            print("{!r}".format(msg))
+# create TCP socket
+if v > 0:
+    print('%s: connecting to %s port %d' % (prog, host, port))
+session = JtagTerminalSession(host, port, shell, verbose=v, name=prog)
+
+try:
+    # this timeout sucks but it's kinda necessary
+    if not session.sync(args.safeStart):
+        print("%s: did not find prompt, maybe try --safeStart?" % prog)
+        exit(1)
+    if v > 0:
+        print("%s: found prompt, continuing" % prog)
+    # now we can shorten it
+    session.settimeout(1)
+    for localFile, remoteFile in files:
+        if not sendFile(session, localFile, remoteFile):
             exit(1)
-    print("%s: transfer complete" % prog)
 finally:
     if v > 0:
         print('%s: closing socket' % prog)
-    sock.close()
-    
+    session.close()